@@ -1,46 +1,109 @@
-#!/usr/bin/python
-
-import argparse
+#!/usr/bin/python3
+
+# argparse, csv, json, multiprocessing, tempfile and NumPy are imported where
+# they are used, so that importing the encoder, or encoding a small payload
+# from the command line, doesn't pay for them.
+import binascii
+import collections
+import functools
+import hashlib
+import io
+import itertools
+import mmap
+import numbers
+import os
+import struct
 import sys
+import threading
+import time
+
 
+# The exceptions carry their message, str() of the exception, rather than
+# writing it out.  An encoding that keeps going past failures would
+# otherwise flood stderr, and a library shouldn't write to it anyway.
 
 # Exception for a word that is too large
 class EncoderDoubleWordTooLargeError(Exception):
 
     def __init__(self, value):
-        sys.stderr.write("The value %s is too large for a signed double word." + \
-            " It must be less than 4,294,967,295" % str(value))
+        self.value = value
+        Exception.__init__(self, ("The value %s is too large for an " +
+                                  "unsigned double word.  It must be less " +
+                                  "than 4,294,967,296") % str(value))
 
 
 # Exception for a word that is too small
 class EncoderDoubleWordTooSmallError(Exception):
 
     def __init__(self, value):
-        sys.stderr.write("The value %s is too small for an unsigned double word.  " + \
-            "It must be larger than -2,147,483,648\n" % str(value))
+        self.value = value
+        Exception.__init__(self, ("The value %s is too small for a signed " +
+                                  "double word.  It must be at least " +
+                                  "-2,147,483,648") % str(value))
 
 
 class MissingNibbleError(Exception):
 
     def __init__(self, byte_string):
-        sys.stderr.write("Something may have gone wrong here.  It seems that you " + \
-            "may be missing a nibble. The byte string is of length %d." + \
-            "  The string is %s\n" % (len(byte_string), byte_string))
+        self.byte_string = byte_string
+        Exception.__init__(self, ("Something may have gone wrong here.  It " +
+                                  "seems that you may be missing a nibble. " +
+                                  "The byte string is of length %d.  The " +
+                                  "string is %s") % (len(byte_string),
+                                                     byte_string))
 
 
 class UnableToFindOperandsError(Exception):
 
     def __init__(self, byte_string):
-        sys.stderr.write("We tried but we were unable to find a set of workable bytes for the value %s given the set of good bytes." % str(byte_string))
+        self.byte_string = byte_string
+        Exception.__init__(self, ("We tried but we were unable to find a " +
+                                  "set of workable bytes for the value %s " +
+                                  "given the set of good bytes.") %
+                           str(byte_string))
 
 
 class InvalidResultError(Exception):
-    def __init__(self, result, expected_result, target_word,
-                 operand_one, operand_two, operand_three):
-        sys.stderr.write("Our math borked.  We expected %d but got %d for target word %s.\n" % (int(result), int(expected_result), target_word))
-        sys.stderr.write("Operand One: %s\n" % operand_one)
-        sys.stderr.write("Operand Two: %s\n" % operand_two)
-        sys.stderr.write("Operand Three: %s\n" % operand_three)
+    def __init__(self, result, expected_result, target_word, *operands):
+        self.result = result
+        self.expected_result = expected_result
+        self.target_word = target_word
+        self.operands = operands
+        message = ("Our math borked.  We expected %d but got %d for target " +
+                   "word %s.") % (int(result), int(expected_result),
+                                  target_word)
+        for name, operand in zip(['One', 'Two', 'Three', 'Four'], operands):
+            message += "\nOperand %s: %s" % (name, operand)
+        Exception.__init__(self, message)
+
+
+# Raised when cross checking the engines, see EncoderCrossCheckEngine
+class EncoderEngineMismatchError(Exception):
+
+    def __init__(self, value, engine, operands, check_engine, check_operands):
+        self.value = value
+        self.operands = operands
+        self.check_operands = check_operands
+        Exception.__init__(self, ("The %s engine solved 0x%08x as %s but the " +
+                                  "%s engine solved it as %s") % (
+            engine, value, self.format_operands(operands), check_engine,
+            self.format_operands(check_operands)))
+
+    @staticmethod
+    def format_operands(operands):
+        if operands is None:
+            return 'nothing'
+        return ', '.join("0x{:08x}".format(operand) for operand in operands)
+
+
+# Raised by the EncoderEmulator for code it can't run, or a stub that doesn't
+# push the payload it should have
+class EncoderEmulatorError(Exception):
+    pass
+
+
+# Two character hex strings for every byte, e.g. HEX_BYTES[10] == '0a'
+HEX_BYTES = ["{:02x}".format(i) for i in range(0, 256)]
 
 
 class EncoderInstructions:
@@ -64,22 +127,79 @@ class EncoderInstructions:
     zero_out_eax_1 = '  AND EAX,0x554E4D4A'
     zero_out_eax_2 = '  AND EAX,0x2A313235'
 
+    # The op code and the ASM for each instruction of an EncodedProgram, by
+    # name.  Instructions with an operand have it appended when rendered.
+    op_code_bytes = {'nop': [nop_op_code],
+                     'sub_eax': [sub_eax_op_code],
+                     'push_esp': [push_esp_op_code],
+                     'pop_esp': [pop_esp_op_code],
+                     'push_eax': [push_eax_op_code],
+                     'pop_eax': [pop_eax_op_code],
+                     'zero_out_eax_1': zero_out_eax_1_op_code_bytes,
+                     'zero_out_eax_2': zero_out_eax_2_op_code_bytes}
+    asm = {'nop': nop,
+           'sub_eax': sub_eax,
+           'push_esp': push_esp,
+           'pop_esp': pop_esp,
+           'push_eax': push_eax,
+           'pop_eax': pop_eax,
+           'zero_out_eax_1': zero_out_eax_1,
+           'zero_out_eax_2': zero_out_eax_2}
+    # The same op codes as raw bytes
+    op_codes = {'nop': binascii.unhexlify(nop_op_code),
+                'sub_eax': binascii.unhexlify(sub_eax_op_code),
+                'push_esp': binascii.unhexlify(push_esp_op_code),
+                'pop_esp': binascii.unhexlify(pop_esp_op_code),
+                'push_eax': binascii.unhexlify(push_eax_op_code),
+                'pop_eax': binascii.unhexlify(pop_eax_op_code),
+                'zero_out_eax_1': binascii.unhexlify(zero_out_eax_1_op_code),
+                'zero_out_eax_2': binascii.unhexlify(zero_out_eax_2_op_code)}
+
+    # Returns the instruction as a list of bytes (strings)
+    # e.g. sub_eax 0x0a0b0c0d --> ['2d', '0d', '0c', '0b', '0a']
+    @classmethod
+    def get_op_code_bytes(cls, instruction):
+        if instruction.operand is None:
+            return cls.op_code_bytes[instruction.name]
+        operand = instruction.operand
+        # The operands are little endian in the instruction
+        return cls.op_code_bytes[instruction.name] + [
+            HEX_BYTES[operand & 0xFF], HEX_BYTES[(operand >> 8) & 0xFF],
+            HEX_BYTES[(operand >> 16) & 0xFF], HEX_BYTES[(operand >> 24) & 0xFF]]
+
+    # Returns the instruction as raw bytes
+    # e.g. sub_eax 0x0a0b0c0d --> b'\x2d\x0d\x0c\x0b\x0a'
+    @classmethod
+    def get_op_code(cls, instruction):
+        if instruction.operand is None:
+            return cls.op_codes[instruction.name]
+        return cls.op_codes[instruction.name] + struct.pack(
+            '<I', instruction.operand)
+
+    # Returns the instruction as a line of ASM
+    # e.g. sub_eax 0x0a0b0c0d --> '  SUB EAX,0x0a0b0c0d'
+    @classmethod
+    def get_asm(cls, instruction):
+        if instruction.operand is None:
+            return cls.asm[instruction.name]
+        return cls.asm[instruction.name] + "0x{:08x}".format(
+            instruction.operand)
+
 
 # Encapsulation of the double word under operation.  This is a value between
 # 0 and 0xFFFFFFFF
-class EncoderDoubleWord:
+class EncoderDoubleWord(object):
 
     # The value in the object will be stored as base 10.  Various accessors
-    # will return the value in desired formats
-    value = 0
+    # will return the value in desired formats.  There are a lot of these
+    # objects for a large input so we keep them as small as we can.
+    __slots__ = ('value',)
 
     # The initial value can be passed as a base 10 or 16.  The base 16 number
     # can be preceded with 0x or not. For example 0xAA and AA are fine.
     def __init__(self, value):
-        if str(value).isdigit() or str(value).startswith('-'):
-            self.value = value
-        elif value.startswith('0x'):
-            self.value = int(value, 0)
+        if isinstance(value, numbers.Integral):
+            self.value = int(value)
         else:
             self.value = int(value, 16)
 
@@ -101,41 +221,715 @@ class EncoderDoubleWord:
     # If pretty = True (False by default), 0x0000000a
     def get_all_digits_base_sixteen(self, pretty=False):
         if pretty:
-            return "0x" + self.get_all_digits_base_sixteen()
+            return "0x{:08x}".format(self.value)
         return "{:08x}".format(self.value)
 
     def get_all_digits_base_sixteen_reverse(self, pretty=False):
         if pretty:
-            return "0x" + self.get_all_digits_base_sixteen_reverse()
-        return ''.join(self.get_byte_array_reverse())
+            return "0x{:08x}".format(self.get_reverse())
+        return "{:08x}".format(self.get_reverse())
+
+    # Return double word as an array of 4 integers (bytes), MSB first
+    # e.g. 0x0000000a --> [0, 0, 0, 10]
+    def get_int_array(self):
+        value = self.value
+        return [(value >> 24) & 0xFF, (value >> 16) & 0xFF,
+                (value >> 8) & 0xFF, value & 0xFF]
+
+    # Return double word as an array of 4 integers (bytes), LSB first
+    # e.g. 0x0000000a --> [10, 0, 0, 0]
+    def get_int_array_reverse(self):
+        value = self.value
+        return [value & 0xFF, (value >> 8) & 0xFF,
+                (value >> 16) & 0xFF, (value >> 24) & 0xFF]
 
     # Return double word as an array of 4 strings (bytes)
     # e.g. ['00','00','00','0a']
     def get_byte_array(self):
-        n = 2
-        return [self.get_all_digits_base_sixteen()[i:i+n]
-                for i in range(0, len(self.get_all_digits_base_sixteen()), n)]
+        return [HEX_BYTES[i] for i in self.get_int_array()]
 
     # Return double word as an array of 4 strings (bytes) reversed
     # e.g. ['00','00','00','0a'] --> ['0a','00','00','00']
     def get_byte_array_reverse(self):
-        return self.get_byte_array()[::-1]
+        return [HEX_BYTES[i] for i in self.get_int_array_reverse()]
+
+    # Returns the double word with the byte order swapped as an integer
+    # e.g. 0x01020304 --> 0x04030201
+    def get_reverse(self):
+        value = self.value
+        return (((value & 0xFF) << 24) | ((value & 0xFF00) << 8) |
+                ((value >> 8) & 0xFF00) | ((value >> 24) & 0xFF))
 
     # Returns an EncoderDoubleWord object
     def get_subtraction_target(self):
-        # First get the reversed byte array.
-        reverse_byte_array = self.get_byte_array_reverse()
-        # Convert it back to a number, well string
-        reverse_byte_string = ''.join(reverse_byte_array)
-        # Now we convert that base 16 string to an integer
-        reverse_byte_as_int = int(reverse_byte_string, 16)
-        # And we'll do the math in base 10
-        # 0 - targetValue = 0xFFFFFFFF - targetValue + 1
-        # 4294967295 - targetValue + 1
-        target_answer = 4294967295 - reverse_byte_as_int + 1
+        # 0 - targetValue wraps around, just like it does in EAX.  Note that
+        # a target of zero stays zero rather than becoming 0x100000000.
         # Response is another EncoderDoubleWord object.  I figured this
         # would be convenient to use since it has the manipulation methods
-        return EncoderDoubleWordTarget(target_answer)
+        return EncoderDoubleWordTarget((-self.get_reverse()) & 0xFFFFFFFF)
+
+
+# The set of good bytes an encoding may use.  Membership is a lookup in a
+# 256 entry bitmap rather than a scan of a list of strings.  The order the
+# bytes were given in is kept too, because the operand table takes the first
+# pair of bytes that works and which pair that is depends on the order.
+#
+# A profile is built once and handed to the SubtractionEncoder and the
+# solvers in place of an array of good bytes.  The tables the solvers build
+# from it are cached by its key (see get_shared), so every profile with the
+# same bytes in the same order shares them.
+class ByteProfile(object):
+
+    # The bytes can be integers or two character hex strings
+    def __init__(self, goodbytes=()):
+        self.bitmap = bytearray(256)
+        self.order = []
+        for goodbyte in goodbytes:
+            if not isinstance(goodbyte, numbers.Integral):
+                goodbyte = int(goodbyte, 16)
+            if not self.bitmap[goodbyte]:
+                self.bitmap[goodbyte] = 1
+                self.order.append(goodbyte)
+        self.key = tuple(self.order)
+        # Profiles are used in the keys of the operand memo, so the hash is
+        # worked out once
+        self.hash = hash(self.key)
+
+    # Builds the profile from a string of good bytes, e.g. "414243"
+    @classmethod
+    def from_goodbytes(cls, goodbytes):
+        clean_byte_string = EncoderParser(goodbytes).clean()
+        return cls(bytearray(binascii.unhexlify(clean_byte_string)))
+
+    # Builds the profile from a string of bad bytes, e.g. "000a0d".  The good
+    # bytes are every other byte, in ascending order.
+    @classmethod
+    def from_badbytes(cls, badbytes):
+        return ~cls.from_goodbytes(badbytes)
+
+    # Returns the argument as a profile.  A profile is returned as is, an
+    # array of good bytes is turned into one.
+    @classmethod
+    def get_profile(cls, goodbytes):
+        if isinstance(goodbytes, ByteProfile):
+            return goodbytes
+        return cls(goodbytes)
+
+    # Returns the object kept in registry for the good bytes (a ByteProfile or
+    # an array), calling build with the profile if we haven't seen it before.
+    # The tables, searches, analyzers and solvers are built once per set of
+    # good bytes this way and shared from here on.  Two threads may both
+    # build one, but they both get back the one that went in first.
+    @classmethod
+    def get_shared(cls, registry, goodbytes, build):
+        profile = cls.get_profile(goodbytes)
+        shared = registry.get(profile.key)
+        if shared is None:
+            shared = registry.setdefault(profile.key, build(profile))
+        return shared
+
+    def __contains__(self, byte):
+        return bool(self.bitmap[byte])
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __eq__(self, other):
+        return isinstance(other, ByteProfile) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self.hash
+
+    # The bytes of this profile followed by the ones only in the other
+    def union(self, other):
+        other = ByteProfile.get_profile(other)
+        return ByteProfile(self.order +
+                           [byte for byte in other if not self.bitmap[byte]])
+
+    # The bytes of this profile that are also in the other
+    def intersection(self, other):
+        other = ByteProfile.get_profile(other)
+        return ByteProfile([byte for byte in self.order if other.bitmap[byte]])
+
+    # Every byte not in this profile, in ascending order
+    def invert(self):
+        return ByteProfile([byte for byte in range(0, 256)
+                            if not self.bitmap[byte]])
+
+    __or__ = union
+    __and__ = intersection
+    __invert__ = invert
+
+    # Returns the good bytes as an array of strings, e.g. ['41', '42']
+    def get_byte_array(self):
+        return [HEX_BYTES[byte] for byte in self.order]
+
+    def get_operand_table(self):
+        return EncoderOperandTable.get_table(self)
+
+    def get_operand_search(self):
+        return EncoderOperandSearch.get_search(self)
+
+    def get_batch_solver(self):
+        return EncoderBatchSolver.get_solver(self)
+
+
+# Lookup table of operands for a given set of good bytes.  For every target
+# byte (0 - 255), every carry into the column (0 - 2) and every carry out of
+# the column (0 - 2) the table holds the first pair of good bytes (x, y) where
+#
+#   x + x + y + carry_in == target_byte + (256 * carry_out)
+#
+# or None if there is no such pair.  "First" means the first pair found when
+# walking the good bytes in the order they were given, with x as the outer
+# loop, so the table gives exactly the same answer as the brute force search.
+class EncoderOperandTable:
+
+    # Keyed by profile, see ByteProfile.get_shared
+    tables = {}
+
+    def __init__(self, goodbytes_array):
+        # The profile has no duplicates but keeps the original order.  A
+        # duplicate can never produce a pair that wasn't already found by its
+        # first copy.
+        self.profile = ByteProfile.get_profile(goodbytes_array)
+        self.entries = [None] * (256 * 3 * 3)
+        goodbytes = self.profile.order
+
+        # The first pair for each possible sum.  Three bytes can sum to at
+        # most 0x2FD (765).
+        first_pair_by_sum = [None] * 766
+        for x in goodbytes:
+            for y in goodbytes:
+                total = (2 * x) + y
+                if first_pair_by_sum[total] is None:
+                    first_pair_by_sum[total] = (x, y)
+
+        for target_byte in range(0, 256):
+            for carry_in in range(0, 3):
+                for carry_out in range(0, 3):
+                    total = target_byte + (256 * carry_out) - carry_in
+                    if 0 <= total < len(first_pair_by_sum):
+                        self.entries[self.index(target_byte, carry_in,
+                                                carry_out)] = \
+                            first_pair_by_sum[total]
+
+    # Returns a table made from entries that were already worked out, e.g. by
+    # the EncoderTableCache
+    @classmethod
+    def from_entries(cls, profile, entries):
+        table = cls.__new__(cls)
+        table.profile = profile
+        table.entries = entries
+        return table
+
+    @staticmethod
+    def index(target_byte, carry_in, carry_out):
+        return (((target_byte * 3) + carry_in) * 3) + carry_out
+
+    # Returns the (x, y) pair or None if the column can't be solved
+    def lookup(self, target_byte, carry_in, carry_out):
+        return self.entries[self.index(target_byte, carry_in, carry_out)]
+
+    # Returns the (operand_one, operand_two, operand_three) tuple that sums to
+    # the value, the same as EncoderDoubleWordTarget.calculate would find, or
+    # None if there isn't one.  Only integers, no debug output and no errors.
+    def solve(self, value):
+        entries = self.entries
+        operand_one = 0
+        operand_three = 0
+        carry_in = 0
+        for shift in (0, 8, 16, 24):
+            index = self.index((value >> shift) & 0xFF, carry_in, 0)
+            for carry_out in (0, 1, 2):
+                pair = entries[index + carry_out]
+                if pair is not None:
+                    break
+            else:
+                return None
+            operand_one |= pair[0] << shift
+            operand_three |= pair[1] << shift
+            carry_in = carry_out
+        return (operand_one, operand_one, operand_three)
+
+    # Returns the table for the good bytes (a ByteProfile or an array), building
+    # it if we haven't seen this profile before.  An EncoderOperandTable is
+    # returned as is.
+    @classmethod
+    def get_table(cls, goodbytes_array):
+        if isinstance(goodbytes_array, EncoderOperandTable):
+            return goodbytes_array
+        return ByteProfile.get_shared(cls.tables, goodbytes_array,
+                                      EncoderOperandTable)
+
+
+# Finds operands for a target without the restrictions of the
+# EncoderOperandTable, where there are always three operands and the first
+# two are the same.  Here there can be one to four operands made of any of the
+# good bytes.
+#
+# For every number of operands, sums[count][total] holds a tuple of count good
+# bytes that add up to total, or None if no such tuple exists.  Each index is
+# built from the one before it (a sum of four bytes is a sum of three plus
+# one more), so building all of them is cheap.  With the index, each column
+# is a single lookup, and the carries between columns are worked out by
+# trying every carry that the number of operands allows.
+class EncoderOperandSearch:
+
+    # Keyed by profile, see ByteProfile.get_shared
+    searches = {}
+
+    # SUB EAX can be repeated, but four is plenty for any set of good bytes
+    # that the search can work with at all.
+    max_count = 4
+
+    def __init__(self, goodbytes_array):
+        self.profile = ByteProfile.get_profile(goodbytes_array)
+        goodbytes = sorted(self.profile)
+        # No operands can only sum to zero
+        self.sums = [[()]]
+        for count in range(1, self.max_count + 1):
+            previous = self.sums[count - 1]
+            sums = [None] * ((255 * count) + 1)
+            for total in range(0, len(previous)):
+                if previous[total] is None:
+                    continue
+                for goodbyte in goodbytes:
+                    if sums[total + goodbyte] is None:
+                        sums[total + goodbyte] = previous[total] + (goodbyte,)
+            self.sums.append(sums)
+
+    # Returns a search made from sums that were already worked out, e.g. by
+    # the EncoderTableCache
+    @classmethod
+    def from_sums(cls, profile, sums):
+        search = cls.__new__(cls)
+        search.profile = profile
+        search.sums = sums
+        return search
+
+    # Returns a tuple of count operands that sum to the value, or None if
+    # there aren't any.
+    def solve(self, value, count):
+        sums = self.sums[count]
+        # For each column, the carries out of it that can be reached, and the
+        # carry in and bytes that got us there.  With count operands the
+        # carry is at most count - 1.
+        columns = []
+        reachable = {0: None}
+        for shift in (0, 8, 16, 24):
+            target_byte = (value >> shift) & 0xFF
+            column = {}
+            for carry_in in sorted(reachable):
+                for carry_out in range(0, count):
+                    total = target_byte + (256 * carry_out) - carry_in
+                    if carry_out not in column and 0 <= total < len(sums) \
+                            and sums[total] is not None:
+                        column[carry_out] = (carry_in, sums[total])
+            if not column:
+                return None
+            columns.append(column)
+            reachable = column
+
+        # Walk back from the MSB.  The carry out of the MSB is overflow.
+        operands = [0] * count
+        carry = min(reachable)
+        for shift, column in zip((24, 16, 8, 0), reversed(columns)):
+            carry, goodbytes = column[carry]
+            for i in range(0, count):
+                operands[i] |= goodbytes[i] << shift
+        return tuple(operands)
+
+    # Returns the smallest tuple of operands that sum to the value, or None
+    def solve_smallest(self, value):
+        for count in range(1, self.max_count + 1):
+            operands = self.solve(value, count)
+            if operands is not None:
+                return operands
+        return None
+
+    # Returns the search for the good bytes (a ByteProfile or an array),
+    # building it if we haven't seen this profile before.  An
+    # EncoderOperandSearch, or the profile of an EncoderOperandTable, are
+    # fine too.
+    @classmethod
+    def get_search(cls, goodbytes_array):
+        if isinstance(goodbytes_array, EncoderOperandSearch):
+            return goodbytes_array
+        if isinstance(goodbytes_array, EncoderOperandTable):
+            goodbytes_array = goodbytes_array.profile
+        return ByteProfile.get_shared(cls.searches, goodbytes_array,
+                                      EncoderOperandSearch)
+
+
+# A word that the good bytes can't encode, and why.  index is the word's
+# place in the payload, word the word itself and target the value the SUB
+# instructions would have to take away.  column is the byte of the target,
+# least significant first, that no operands could reach, target_byte its
+# value and carries the carries into it that the columns before it left.
+EncoderInfeasibleWord = collections.namedtuple(
+    'EncoderInfeasibleWord',
+    ['index', 'word', 'target', 'column', 'target_byte', 'carries'])
+
+
+def get_infeasible_reason(infeasible):
+    return ("Word {0} (0x{1:08x}) can't be encoded: no operands reach byte "
+            "0x{2:02x} in column {3} of the target 0x{4:08x} with a carry "
+            "in of {5}").format(
+                infeasible.index, infeasible.word, infeasible.target_byte,
+                infeasible.column, infeasible.target,
+                ' or '.join(str(carry) for carry in infeasible.carries))
+
+
+# Works out up front which (target byte, carry in) columns the good bytes can
+# reach, and the carries out of them, for one to four SUB operands.  A word
+# can then be checked in a few lookups, so a whole payload can be checked
+# for words that can't be encoded without encoding any of it.  A word passes
+# if some number of operands gets through all four columns, which is exactly
+# when the encoder can solve it.
+class EncoderFeasibilityAnalyzer(object):
+
+    # Keyed by profile, see ByteProfile.get_shared
+    analyzers = {}
+
+    def __init__(self, goodbytes_array):
+        self.profile = ByteProfile.get_profile(goodbytes_array)
+        sums = EncoderOperandSearch.get_search(self.profile).sums
+        self.max_count = EncoderOperandSearch.max_count
+        # transitions[count][target_byte][carries] is the set of carries out
+        # of a column with count operands, given the set of carries into it.
+        # Sets of carries are bit masks, bit n for a carry of n.
+        self.transitions = [None]
+        for count in range(1, self.max_count + 1):
+            reachable = [[0] * count for i in range(0, 256)]
+            for total in range(0, len(sums[count])):
+                if sums[count][total] is None:
+                    continue
+                for carry_in in range(0, count):
+                    column = total + carry_in
+                    reachable[column & 0xFF][carry_in] |= 1 << (column >> 8)
+            transitions = []
+            for target_byte in range(0, 256):
+                row = [0] * (1 << count)
+                for carries in range(1, 1 << count):
+                    for carry_in in range(0, count):
+                        if carries & (1 << carry_in):
+                            row[carries] |= reachable[target_byte][carry_in]
+                transitions.append(row)
+            self.transitions.append(transitions)
+
+    # Returns True if count operands can reach the (target byte, carry in)
+    # column with the given carry out
+    def is_reachable(self, target_byte, carry_in, carry_out, count=3):
+        if carry_in >= count:
+            return False
+        carries = self.transitions[count][target_byte][1 << carry_in]
+        return bool(carries & (1 << carry_out))
+
+    # Follows the carries through the columns of the value.  Returns the
+    # number of columns that could be reached (4 for all of them) and the
+    # carries into the first one that couldn't.
+    def follow(self, value, count):
+        transitions = self.transitions[count]
+        carries = 1
+        for column in range(0, 4):
+            next_carries = transitions[(value >> (column * 8)) & 0xFF][carries]
+            if not next_carries:
+                return column, carries
+            carries = next_carries & ((1 << count) - 1)
+        return 4, carries
+
+    def is_feasible_value(self, value):
+        for count in range(1, self.max_count + 1):
+            if self.follow(value, count)[0] == 4:
+                return True
+        return False
+
+    # Returns None if the value can be subtracted, otherwise the (column,
+    # target byte, carries in) where the count of operands that got the
+    # furthest got stuck.
+    def check_value(self, value):
+        furthest = None
+        for count in range(1, self.max_count + 1):
+            column, carries = self.follow(value, count)
+            if column == 4:
+                return None
+            if furthest is None or column >= furthest[0]:
+                furthest = (column, (value >> (column * 8)) & 0xFF,
+                            tuple(carry for carry in range(0, count)
+                                  if carries & (1 << carry)))
+        return furthest
+
+    # Checks every word and returns an EncoderInfeasibleWord for each one
+    # that can't be encoded.  With chain, a word also passes if the encoder
+    # can subtract its way to it from the word pushed before it, and with
+    # dedup if it is the same as that word.  The words are
+    # EncoderDoubleWord's in payload order.
+    def scan(self, words, chain=False, dedup=False):
+        infeasible = []
+        previous = None
+        for index in range(len(words) - 1, -1, -1):
+            value = words[index].get_reverse()
+            target = (-value) & 0xFFFFFFFF
+            if dedup and value == previous:
+                continue
+            if chain and previous is not None and \
+                    self.is_feasible_value((previous - value) & 0xFFFFFFFF):
+                previous = value
+                continue
+            reason = self.check_value(target)
+            # The encoder pushes zero in place of a word it can't encode, so
+            # the word after it isn't chained from it or taken as a repeat
+            previous = value if reason is None else None
+            if reason is not None:
+                infeasible.append(EncoderInfeasibleWord(
+                    index, words[index].get_base_ten(), target, *reason))
+        infeasible.reverse()
+        return infeasible
+
+    def is_feasible(self, words, chain=False, dedup=False):
+        return not self.scan(words, chain, dedup)
+
+    # Returns the analyzer for the good bytes (a ByteProfile or an array),
+    # building it if we haven't seen this profile before.
+    @classmethod
+    def get_analyzer(cls, goodbytes_array):
+        return ByteProfile.get_shared(cls.analyzers, goodbytes_array,
+                                      EncoderFeasibilityAnalyzer)
+
+
+# A bounded, least recently used memo of the operands solved for a value.
+# Real payloads repeat the same words over and over (padding, sleds, zeroed
+# structures), so a word only has to be solved the first time.  The keys are
+# (value, ByteProfile, optimize) so a memo can be shared between encoders,
+# including encoders running in different threads.
+class EncoderOperandMemo(object):
+
+    def __init__(self, max_size=65536):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    # Returns the operands for the key, or default if they aren't in the memo
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                operands = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            # Back to the most recently used end
+            self.entries[key] = operands
+            self.hits += 1
+            return operands
+
+    def put(self, key, operands):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = operands
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Keeps the tables the solvers build for a ByteProfile (the operand table and
+# the operand search sums) in files under a cache directory, so the next run
+# with the same profile can skip building them.  The files are memory mapped
+# and decoded in bulk when they are loaded.
+#
+# A file is named after a hash of the profile and the cache version.  Bump
+# the version whenever the tables change and every old file is ignored.  A
+# file that doesn't check out is rebuilt and written again.
+class EncoderTableCache(object):
+
+    version = 1
+    magic = b'SUBENC'
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = self.get_default_directory()
+        self.directory = directory
+        # How many profiles were loaded from the directory, and how many
+        # had to be built
+        self.hits = 0
+        self.misses = 0
+
+    # $XDG_CACHE_HOME/SubtractionEncoder, or ~/.cache/SubtractionEncoder
+    @staticmethod
+    def get_default_directory():
+        base = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+        return os.path.join(base, 'SubtractionEncoder')
+
+    def get_filename(self, profile):
+        digest = hashlib.sha1(struct.pack('<H', self.version) +
+                              bytes(bytearray(profile.key))).hexdigest()
+        return os.path.join(self.directory, digest + '.tables')
+
+    # Returns the operand table and search for the profile.  They come from
+    # memory if this process has already used the profile, then from the
+    # cache directory, and only then are they built (and saved).
+    def get_tables(self, profile):
+        profile = ByteProfile.get_profile(profile)
+        if profile.key in EncoderOperandTable.tables and \
+                profile.key in EncoderOperandSearch.searches:
+            return (EncoderOperandTable.tables[profile.key],
+                    EncoderOperandSearch.searches[profile.key])
+
+        tables = self.load(profile)
+        if tables is None:
+            self.misses += 1
+            tables = (EncoderOperandTable(profile),
+                      EncoderOperandSearch(profile))
+            self.save(profile, tables[0], tables[1])
+        else:
+            self.hits += 1
+        return (EncoderOperandTable.tables.setdefault(profile.key, tables[0]),
+                EncoderOperandSearch.searches.setdefault(profile.key,
+                                                         tables[1]))
+
+    # Returns the (operand table, operand search) stored for the profile, or
+    # None if there isn't a good file for it.
+    def load(self, profile):
+        try:
+            cache_file = open(self.get_filename(profile), 'rb')
+        except (IOError, OSError):
+            return None
+        try:
+            data = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            cache_file.close()
+            return None
+        try:
+            return self.decode(profile, data)
+        except struct.error:
+            return None
+        finally:
+            data.close()
+            cache_file.close()
+
+    def decode(self, profile, data):
+        header = struct.Struct('<6sHH')
+        magic, version, length = header.unpack_from(data, 0)
+        offset = header.size
+        if magic != self.magic or version != self.version or \
+                tuple(bytearray(data[offset:offset + length])) != profile.key:
+            return None
+        offset += length
+
+        # The operand table, one (x, y) pair per entry, 0xFFFF for None
+        count = 256 * 3 * 3
+        packed = struct.unpack_from('<%dH' % count, data, offset)
+        offset += 2 * count
+        entries = [None if entry == 0xFFFF else (entry >> 8, entry & 0xFF)
+                   for entry in packed]
+
+        # The operand search sums, a flag byte then the bytes of the sum
+        sums = [[()]]
+        for operand_count in range(1, EncoderOperandSearch.max_count + 1):
+            size = (255 * operand_count) + 1
+            width = operand_count + 1
+            raw = bytearray(data[offset:offset + (size * width)])
+            if len(raw) != size * width:
+                return None
+            offset += size * width
+            sums.append([tuple(raw[i + 1:i + width]) if raw[i] else None
+                         for i in range(0, size * width, width)])
+
+        return (EncoderOperandTable.from_entries(profile, entries),
+                EncoderOperandSearch.from_sums(profile, sums))
+
+    # Writes the tables for the profile.  The file is written under a
+    # temporary name and renamed, so a reader never sees half a file.
+    def save(self, profile, operand_table, operand_search):
+        data = bytearray(struct.pack('<6sHH', self.magic, self.version,
+                                     len(profile.key)))
+        data.extend(bytearray(profile.key))
+        data.extend(struct.pack('<%dH' % len(operand_table.entries),
+                                *[0xFFFF if entry is None
+                                  else (entry[0] << 8) | entry[1]
+                                  for entry in operand_table.entries]))
+        for operand_count in range(1, EncoderOperandSearch.max_count + 1):
+            for goodbytes in operand_search.sums[operand_count]:
+                if goodbytes is None:
+                    data.extend(bytearray(operand_count + 1))
+                else:
+                    data.append(1)
+                    data.extend(bytearray(goodbytes))
+
+        import tempfile
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            handle, temporary = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(handle, 'wb') as cache_file:
+                cache_file.write(data)
+            os.rename(temporary, self.get_filename(profile))
+        except (IOError, OSError):
+            # A cache we can't write to just means we build the tables
+            # again next time.
+            pass
+
+    # Removes every file in the cache directory
+    def clear(self):
+        if not os.path.isdir(self.directory):
+            return
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.tables'):
+                os.remove(os.path.join(self.directory, filename))
+
+
+# The ByteProfile for each set of good or bad bytes that an encoder running
+# many jobs (the daemon, or a manifest) has seen.  A profile's tables are
+# built, or loaded from the cache directory if there is one, the first time
+# its bytes are seen.
+class EncoderProfiles(object):
+
+    def __init__(self, cache_dir=None):
+        self.profiles = {}
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = EncoderTableCache(cache_dir)
+
+    def __len__(self):
+        return len(self.profiles)
+
+    # Returns the ByteProfile for the job, a dict with goodbytes or badbytes
+    # as a string of hex
+    def get_profile(self, job):
+        if job.get('goodbytes') is not None:
+            key = ('goodbytes', EncoderParser(job['goodbytes']).clean())
+        elif job.get('badbytes') is not None:
+            key = ('badbytes', EncoderParser(job['badbytes']).clean())
+        else:
+            raise ValueError('The job has no goodbytes or badbytes')
+        profile = self.profiles.get(key)
+        if profile is None:
+            if key[0] == 'goodbytes':
+                profile = ByteProfile.from_goodbytes(key[1])
+            else:
+                profile = ByteProfile.from_badbytes(key[1])
+            if self.cache is not None:
+                self.cache.get_tables(profile)
+            profile = self.profiles.setdefault(key, profile)
+        return profile
 
 
 # The EncoderDoubleWordReverse encapsulates the target bytes
@@ -145,16 +939,26 @@ class EncoderDoubleWord:
 # when added together, will equal the double word target.
 class EncoderDoubleWordTarget(EncoderDoubleWord):
 
-    operand_one = []
-    operand_two = []
-    operand_three = []
+    # The operands are kept as a tuple of integers.  They are only turned
+    # into strings when the output is rendered.  calculate always finds three
+    # operands, search finds anywhere from one to four.
+    __slots__ = ('operands',)
 
     def __init__(self, value):
-        # TODO: Need to do a call to super
-        self.value = value
-        self.operand_one = []
-        self.operand_two = []
-        self.operand_three = []
+        super(EncoderDoubleWordTarget, self).__init__(value)
+        self.operands = (0, 0, 0)
+
+    @property
+    def operand_one(self):
+        return self.operands[0]
+
+    @property
+    def operand_two(self):
+        return self.operands[1]
+
+    @property
+    def operand_three(self):
+        return self.operands[2]
 
     def check(self, x, y, target, carry=0):
         if (2 * int(x, 16)) + int(y, 16) + carry == int(target, 16):
@@ -162,121 +966,387 @@ class EncoderDoubleWordTarget(EncoderDoubleWord):
         return False
 
     def calculate(self, goodbytes_array, debug=False):
-        # Start at the LSB and work towards the MSB
-        i = 3
+        # The goodbytes can be handed over as a plain array or as an already
+        # built EncoderOperandTable.  Either way, the table is only built once
+        # per set of good bytes.
+        table = EncoderOperandTable.get_table(goodbytes_array)
+        value = self.value
+
         if debug:
             sys.stdout.write("=== Starting Calculation on Byte " +
                             self.get_all_digits_base_sixteen(pretty=True) +
                             " ===\n")
-            sys.stdout.write("i is " + str(i) + "\n")
 
-        found = False
-        # The carry list will hold the carry for each byte.  Eventhough this
-        # is a four byte, double word, there are five columns.  The zero column
-        # column handles any overflow
+        # The carry works the same as if we were adding by hand.  Start at the
+        # LSB and work towards the MSB.  Whatever carry the current column
+        # produces is added into the next column.  Any carry out of the MSB is
+        # overflow and is discarded.
         #
-        # carry[0] carry[1]       carry[2]       carry[3]       carry[4]
-        #          operand_one[0] operand_one[1] operand_one[2] operand_one[3]
-        #   +      operand_two[0] operand_two[1] operand_two[2] operand_two[3]
-        #   +      operand_thr[0] operand_thr[1] operand_thr[2] operand_thr[3]
+        # carry_in       carry_in       carry_in       carry_in
+        # operand_one[0] operand_one[1] operand_one[2] operand_one[3]
+        # operand_two[0] operand_two[1] operand_two[2] operand_two[3]
+        # operand_thr[0] operand_thr[1] operand_thr[2] operand_thr[3]
         # --------------------------------------------------------------------
-        #          byte_array[0]  byte_array[1]  byte_array[2]  byte_array[3]
-
-        carry = [0,0,0,0,0]
-
-        while(i > -1):
-            # If this is the first time dealing with this byte,
-            # the carry on the next MSB will be zero.
-            if carry[i-1] == 0:
-                target_byte = self.get_byte_array()[i]
-            # However, if this is the second or third (unlikely)
-            # time we are dealing with the byte, the carry will have
-            # been incremented.  Therefore we will convert the byte to
-            # an integer, add 256 (times the carry), and convert
-            # it back to a string representation of the byte.
-            elif carry[i-1] > 0:
-                    target_byte = "{:02x}".format(
-                                  int(self.get_byte_array()[i], 16)
-                                  + (256 * carry[i-1]))
+        # byte_array[0]  byte_array[1]  byte_array[2]  byte_array[3]
+        operand_one = 0
+        operand_three = 0
+        carry_in = 0
+        for shift in (0, 8, 16, 24):
+            target_byte = (value >> shift) & 0xFF
             if debug:
-                sys.stdout.write("The target byte is " + target_byte + "\n")
-            for x in range(0, len(goodbytes_array)):
-                for y in range(0, len(goodbytes_array)):
-                    # If we have found a workable set of values and haven't
-                    # previously found a set, we will add these values to the
-                    # result arrays.  It's possible multiple combinations will
-                    # work, but we just need to capture the first working set.
-                    if self.check(goodbytes_array[x],
-                                goodbytes_array[y],
-                                target_byte, carry[i]) and not found:
-                        self.operand_one.insert(0, goodbytes_array[x])
-                        self.operand_two.insert(0, goodbytes_array[x])
-                        self.operand_three.insert(0, goodbytes_array[y])
-                        if debug:
-                            sys.stdout.write("Op 1: " + goodbytes_array[x]+"\n")
-                            sys.stdout.write("Op 2: " + goodbytes_array[x]+"\n")
-                            sys.stdout.write("Op 3: " + goodbytes_array[y]+"\n")
-
-                        found = True
-                    # Otherwise, just run out the loops.  Yes, this is silly
-                    # but putting this here keeps me sane.
-                    else:
-                        pass
-            if debug:
-                sys.stdout.write("Found: " + str(found)+"\n")
-            # If we found a set, we will move to the next MSB
-            if found:
-                i = i - 1
-                found = False
-            # Otherwise, we need to try again, incrementing the carry
-            elif not found:
+                sys.stdout.write("i is " + str(3 - shift // 8) + "\n")
+                sys.stdout.write("The target byte is " +
+                                 HEX_BYTES[target_byte] + "\n")
+            # First try without a carry out of this column.  If that doesn't
+            # work, we'll borrow one (or two) from the next MSB.
+            pair = None
+            for carry_out in range(0, 3):
+                pair = table.lookup(target_byte, carry_in, carry_out)
+                if pair is not None:
+                    break
                 if debug:
-                     sys.stdout.write("Not found, adding a carry to column: " + str(i-1) +"\n")
-                carry[i-1] = carry[i-1] + 1
+                    sys.stdout.write("Not found, adding a carry to column: " +
+                                     str(2 - shift // 8) + "\n")
 
             # The largest value a set of three bytes could sum is 0x2FD (765)
             # Therefore, if we haven't found a set of three values by now, we
             # won't.  Therefore, throw in the towl.
-            if carry[i-1] > 2:
-                print target_byte
-                raise UnableToFindOperandsError(''.join(target_byte))
+            if pair is None:
+                raise UnableToFindOperandsError(HEX_BYTES[target_byte])
 
+            operand_one |= pair[0] << shift
+            operand_three |= pair[1] << shift
             if debug:
-                sys.stdout.write("i is now " + str(i) +"\n")
+                sys.stdout.write("Op 1: " + HEX_BYTES[pair[0]] + "\n")
+                sys.stdout.write("Op 2: " + HEX_BYTES[pair[0]] + "\n")
+                sys.stdout.write("Op 3: " + HEX_BYTES[pair[1]] + "\n")
+            carry_in = carry_out
+
+        self.operands = (operand_one, operand_one, operand_three)
+
         if debug:
             sys.stdout.write("=== DONE WITH TARGET WORD " +
             self.get_all_digits_base_sixteen(pretty=True) +
             " ===\n")
 
+    # Finds the smallest number of operands (or exactly count operands) that
+    # sum to the target.  Unlike calculate, the operands can all be different
+    # and there can be anywhere from one to four of them.
+    def search(self, goodbytes_array, debug=False, count=None):
+        operand_search = EncoderOperandSearch.get_search(goodbytes_array)
+        if count is None:
+            operands = operand_search.solve_smallest(self.value)
+        else:
+            operands = operand_search.solve(self.value, count)
+        if operands is None:
+            raise UnableToFindOperandsError(
+                self.get_all_digits_base_sixteen(pretty=True))
+        self.operands = operands
+
+        if debug:
+            sys.stdout.write("=== Searched Target Word " +
+                             self.get_all_digits_base_sixteen(pretty=True) +
+                             " ===\n")
+            for operand in operands:
+                sys.stdout.write("Op: 0x{:08x}\n".format(operand))
+
+    # Returns the operands as a tuple of integers
+    def get_operands(self):
+        return self.operands
+
     def get_operand_one(self):
-        return EncoderDoubleWord('0x'+''.join(self.operand_one))
+        return EncoderDoubleWord(self.operand_one)
 
     def get_operand_two(self):
-        return EncoderDoubleWord('0x'+''.join(self.operand_two))
+        return EncoderDoubleWord(self.operand_two)
 
     def get_operand_three(self):
-        return EncoderDoubleWord('0x'+''.join(self.operand_three))
+        return EncoderDoubleWord(self.operand_three)
 
     def verify_result(self):
 
-        test_sum = self.get_operand_one().get_base_ten() + \
-                self.get_operand_two().get_base_ten() + \
-                self.get_operand_three().get_base_ten()
-
-        # If test_sum is > 0xFFFFFFFF (4294967295), we'll go out on a limb
-        # and assume it's due to overflow.  We will then subtract
-        # 0x100000000 as necessary.
-        while test_sum > 4294967296:
-            test_sum = test_sum - 4294967296
+        # Anything over 0xFFFFFFFF is overflow, same as in EAX.
+        test_sum = sum(self.operands) & 0xFFFFFFFF
 
-        if test_sum != self.get_base_ten():
+        if test_sum != self.value:
             raise InvalidResultError(test_sum,
-                                     self.get_base_ten(),
+                                     self.value,
                                      self.get_all_digits_base_sixteen(
                                                     pretty=True),
-                                     self.get_operand_one().get_all_digits_base_sixteen(pretty=True),
-                                     self.get_operand_two().get_all_digits_base_sixteen(pretty=True),
-                                     self.get_operand_three().get_all_digits_base_sixteen(pretty=True))
+                                     *["0x{:08x}".format(operand)
+                                       for operand in self.operands])
+
+
+# A word that keeps its subtraction target, for a payload that is encoded
+# with more than one set of good bytes.  The target only depends on the word,
+# so it is worked out once and every profile solves the same one.
+class EncoderSharedWord(EncoderDoubleWord):
+
+    __slots__ = ('target',)
+
+    def __init__(self, value):
+        super(EncoderSharedWord, self).__init__(value)
+        self.target = EncoderDoubleWord.get_subtraction_target(self)
+
+    def get_subtraction_target(self):
+        return self.target
+
+
+# Solves every word of a payload at once using NumPy.  The words are held in
+# a uint32 array and each byte column is solved for all of the words at the
+# same time by indexing into the EncoderOperandTable, so the answers are the
+# same as the ones EncoderDoubleWordTarget.calculate gives.  NumPy is only
+# needed if this solver is used.
+class EncoderBatchSolver:
+
+    # Keyed by profile, see ByteProfile.get_shared
+    solvers = {}
+
+    def __init__(self, goodbytes_array):
+        import numpy
+        self.numpy = numpy
+        self.operand_table = EncoderOperandTable.get_table(goodbytes_array)
+
+        # The operand table as two (target byte, carry in, carry out) arrays.
+        # -1 marks a column that can't be solved.
+        entries = self.operand_table.entries
+        self.x = numpy.array([-1 if pair is None else pair[0]
+                              for pair in entries],
+                             dtype=numpy.int16).reshape((256, 3, 3))
+        self.y = numpy.array([-1 if pair is None else pair[1]
+                              for pair in entries],
+                             dtype=numpy.int16).reshape((256, 3, 3))
+
+    # Returns the subtraction target of every word, the same as
+    # EncoderDoubleWord.get_subtraction_target.  The targets don't depend on
+    # the good bytes.
+    @staticmethod
+    def get_targets(words):
+        import numpy
+        words = numpy.asarray(words, dtype=numpy.uint32)
+        return numpy.subtract(numpy.uint32(0), words.byteswap())
+
+    # Returns the three operands for every target as three uint32 arrays
+    def solve(self, targets):
+        operand_one, operand_two, operand_three, failed = \
+            self.solve_all(targets)
+        if failed.any():
+            # Let the regular solver raise the error for the first word that
+            # couldn't be encoded, that way the error is the same.
+            index = int(self.numpy.argmax(failed))
+            EncoderDoubleWordTarget(int(targets[index])).calculate(
+                self.operand_table)
+        return operand_one, operand_two, operand_three
+
+    # Same as solve, but rather than raising an error for the targets that
+    # can't be encoded, a fourth boolean array marks them.  Their operands
+    # are meaningless.
+    def solve_all(self, targets):
+        numpy = self.numpy
+        targets = numpy.asarray(targets, dtype=numpy.uint32)
+        operand_one = numpy.zeros(len(targets), dtype=numpy.uint32)
+        operand_three = numpy.zeros(len(targets), dtype=numpy.uint32)
+        carry_in = numpy.zeros(len(targets), dtype=numpy.intp)
+        failed = numpy.zeros(len(targets), dtype=bool)
+
+        for shift in (0, 8, 16, 24):
+            target_byte = ((targets >> shift) & 0xFF).astype(numpy.intp)
+            # Take the smallest carry out that works for each word.  If none
+            # of them do, the word can't be encoded.
+            solvable = self.x[target_byte, carry_in] >= 0
+            carry_out = numpy.argmax(solvable, axis=1)
+            failed |= ~solvable.any(axis=1)
+
+            x = self.x[target_byte, carry_in, carry_out]
+            y = self.y[target_byte, carry_in, carry_out]
+            operand_one |= x.astype(numpy.uint32) << shift
+            operand_three |= y.astype(numpy.uint32) << shift
+            carry_in = carry_out
+
+        solved = ~failed
+        self.verify_result(targets[solved], operand_one[solved],
+                           operand_one[solved], operand_three[solved])
+        return operand_one, operand_one.copy(), operand_three, failed
+
+    # The same sanity check as EncoderDoubleWordTarget.verify_result, for
+    # every word at once
+    def verify_result(self, targets, operand_one, operand_two, operand_three):
+        numpy = self.numpy
+        test_sum = (operand_one.astype(numpy.uint64) + operand_two +
+                    operand_three) & 0xFFFFFFFF
+        mismatch = test_sum != targets
+        if mismatch.any():
+            index = int(numpy.argmax(mismatch))
+            raise InvalidResultError(int(test_sum[index]),
+                                     int(targets[index]),
+                                     "0x{:08x}".format(int(targets[index])),
+                                     "0x{:08x}".format(int(operand_one[index])),
+                                     "0x{:08x}".format(int(operand_two[index])),
+                                     "0x{:08x}".format(
+                                         int(operand_three[index])))
+
+    # Returns the solver for the good bytes, building it if we haven't seen
+    # this set of good bytes before.
+    @classmethod
+    def get_solver(cls, goodbytes_array):
+        table = EncoderOperandTable.get_table(goodbytes_array)
+        return ByteProfile.get_shared(cls.solvers, table.profile,
+                                      lambda _: EncoderBatchSolver(table))
+
+
+# An engine solves subtraction targets the way the EncoderOperandTable does,
+# three operands with the first two the same, and returns None for a target
+# that can't be done that way.  The encoder falls back to the
+# EncoderOperandSearch for those.  New engines subclass this and are added to
+# SubtractionEncoder.engines.
+class EncoderEngine(object):
+
+    name = None
+    # Whether the engine solves a NumPy array of targets at once with
+    # solve_array.  Every engine can also solve one target at a time.
+    batch = False
+
+    def __init__(self, profile, operand_table=None):
+        self.profile = profile
+        if operand_table is None:
+            operand_table = profile.get_operand_table()
+        self.operand_table = operand_table
+
+    # Whether everything the engine needs is installed
+    @classmethod
+    def is_available(cls):
+        return True
+
+    # Returns the (operand_one, operand_two, operand_three) tuple or None
+    def solve(self, value):
+        raise NotImplementedError
+
+
+# The original way of solving a target: for each column, every pair of good
+# bytes is tried in turn until one adds up.  Slow, but it works straight from
+# the good bytes, so it is what the other engines are checked against.
+class EncoderReferenceEngine(EncoderEngine):
+
+    name = 'reference'
+
+    def solve(self, value):
+        goodbytes = self.profile.order
+        operand_one = 0
+        operand_three = 0
+        carry_in = 0
+        for shift in (0, 8, 16, 24):
+            target_byte = (value >> shift) & 0xFF
+            pair = None
+            # First try without a carry out of this column, then borrow one
+            # (or two) from the next MSB.
+            for carry_out in range(0, 3):
+                total = target_byte + (256 * carry_out) - carry_in
+                for x in goodbytes:
+                    for y in goodbytes:
+                        if (2 * x) + y == total:
+                            pair = (x, y)
+                            break
+                    if pair is not None:
+                        break
+                if pair is not None:
+                    break
+            if pair is None:
+                return None
+            operand_one |= pair[0] << shift
+            operand_three |= pair[1] << shift
+            carry_in = carry_out
+        return (operand_one, operand_one, operand_three)
+
+
+# Solves a target with lookups in the EncoderOperandTable
+class EncoderTableEngine(EncoderEngine):
+
+    name = 'table'
+
+    def solve(self, value):
+        return self.operand_table.solve(value)
+
+
+# Solves all of the targets at once with the EncoderBatchSolver.  Needs NumPy.
+class EncoderBatchEngine(EncoderTableEngine):
+
+    name = 'batch'
+    batch = True
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import numpy
+        except ImportError:
+            return False
+        return True
+
+    def get_solver(self):
+        return EncoderBatchSolver.get_solver(self.operand_table)
+
+    @property
+    def numpy(self):
+        return self.get_solver().numpy
+
+    def get_targets(self, words):
+        return self.get_solver().get_targets(words)
+
+    # Returns the three operands for every target as uint32 arrays, and a
+    # boolean array of the targets that couldn't be solved
+    def solve_array(self, targets):
+        return self.get_solver().solve_all(targets)
+
+
+# Runs every target through two engines and raises an
+# EncoderEngineMismatchError if they don't agree, so a new engine can be
+# trusted before it is used on its own.  The answers are the first engine's.
+class EncoderCrossCheckEngine(EncoderEngine):
+
+    def __init__(self, engine, check_engine):
+        self.engine = engine
+        self.check_engine = check_engine
+        self.name = engine.name
+        self.batch = engine.batch
+        self.profile = engine.profile
+        self.operand_table = engine.operand_table
+
+    def solve(self, value):
+        operands = self.engine.solve(value)
+        check_operands = self.check_engine.solve(value)
+        if operands != check_operands:
+            raise EncoderEngineMismatchError(value, self.engine.name,
+                                             operands, self.check_engine.name,
+                                             check_operands)
+        return operands
+
+    @property
+    def numpy(self):
+        return self.engine.numpy
+
+    def get_targets(self, words):
+        return self.engine.get_targets(words)
+
+    def solve_array(self, targets):
+        solved = self.engine.solve_array(targets)
+        if self.check_engine.batch:
+            checked = self.check_engine.solve_array(targets)
+            numpy = self.engine.numpy
+            mismatch = solved[3] != checked[3]
+            for operand, check_operand in zip(solved[:3], checked[:3]):
+                mismatch |= ~solved[3] & (operand != check_operand)
+            mismatched = numpy.nonzero(mismatch)[0]
+        else:
+            mismatched = range(0, len(targets))
+        for i in mismatched:
+            operands = None
+            if not solved[3][i]:
+                operands = tuple(int(operand[i]) for operand in solved[:3])
+            check_operands = self.check_engine.solve(int(targets[i]))
+            if operands != check_operands:
+                raise EncoderEngineMismatchError(
+                    int(targets[i]), self.engine.name, operands,
+                    self.check_engine.name, check_operands)
+        return solved
 
 
 class EncoderParser:
@@ -284,13 +1354,18 @@ class EncoderParser:
     def __init__(self, input_string):
         self.input_string = input_string
 
-    # Remove extraneous input characters.  This method doesn't need to be
-    # called directly.  Happens during the "parse".
-    def clean(self):
+    # Remove extraneous input characters without checking what is left.
+    def strip(self):
         clean_byte_string = self.input_string.replace('\r', '')
         clean_byte_string = clean_byte_string.replace('\n', '')
         clean_byte_string = clean_byte_string.replace(' ', '')
         clean_byte_string = clean_byte_string.replace('\\', '')
+        return clean_byte_string
+
+    # Remove extraneous input characters.  This method doesn't need to be
+    # called directly.  Happens during the "parse".
+    def clean(self):
+        clean_byte_string = self.strip()
 
         # Check if we are missing a nibble.
         if len(clean_byte_string) % 2 > 0:
@@ -304,12 +1379,7 @@ class EncoderParser:
                 for i in range(0, len(self.input_string), n)]
 
     def get_inverted_byte_array(self):
-        self.clean()
-        inverted_byte_array = []
-        for i in range(0, 256):
-            if "{:02x}".format(i) not in self.get_byte_array():
-                inverted_byte_array.append("{:02x}".format(i))
-        return inverted_byte_array
+        return ByteProfile(self.get_byte_array()).invert().get_byte_array()
 
 
 class EncoderInputParser(EncoderParser):
@@ -325,6 +1395,10 @@ class EncoderInputParser(EncoderParser):
             self.input_string = self.input_string + EncoderInstructions.nop_op_code
         return self.input_string
 
+    # The number of words the input will make, once it is cleaned and padded
+    def get_word_count(self):
+        return -(-len(self.strip()) // 8)
+
     # Cleans, pads, and generates a list of EncoderDoubleWord objects
     def parse_words(self):
         words = []
@@ -334,12 +1408,566 @@ class EncoderInputParser(EncoderParser):
         clean_byte_string = self.pad()
         # Create an array of EncoderDoubleWord objects
         for i in range(0, len(clean_byte_string), 8):
-            # We have to prepend the word with 0x to force the initializer to
-            # treat the string as a hex value
-            words.append(EncoderDoubleWord("0x"+clean_byte_string[i:i+8]))
+            words.append(EncoderDoubleWord(int(clean_byte_string[i:i+8], 16)))
 
         return words
 
+    # Cleans, pads, and returns the words as a NumPy uint32 array.  This is
+    # what the EncoderBatchSolver works on.
+    def parse_word_array(self):
+        import numpy
+        self.clean()
+        clean_byte_string = self.pad()
+        return numpy.frombuffer(binascii.unhexlify(clean_byte_string),
+                                dtype='>u4').astype(numpy.uint32)
+
+    # Cleans, pads, and returns the input as raw bytes
+    def get_data(self):
+        self.input_string = self.clean()
+        return binascii.unhexlify(self.pad())
+
+
+# Parses raw binary input rather than a string of hex, e.g. a file that has
+# been memory mapped.  The data is read through a memoryview so it is never
+# copied or turned into hex along the way.
+class EncoderBinaryParser(EncoderParser):
+
+    def __init__(self, data):
+        self.data = memoryview(data)
+
+    # The number of whole double words in the input
+    def get_word_count(self):
+        return len(self.data) // 4
+
+    # The last double word, padded with NOP the same way
+    # EncoderInputParser.pad does, or None if the input is already a whole
+    # number of double words.
+    def get_padded_word(self):
+        remainder = len(self.data) % 4
+        if remainder == 0:
+            return None
+        tail = self.data[len(self.data) - remainder:].tobytes()
+        return tail + binascii.unhexlify(
+            EncoderInstructions.nop_op_code * (4 - remainder))
+
+    # Pads and generates a list of EncoderDoubleWord objects
+    def parse_words(self):
+        values = list(struct.unpack_from('>%dI' % self.get_word_count(),
+                                         self.data))
+        padded_word = self.get_padded_word()
+        if padded_word is not None:
+            values.append(struct.unpack('>I', padded_word)[0])
+        return [EncoderDoubleWord(value) for value in values]
+
+    # Pads and returns the words as a NumPy uint32 array.  This is what the
+    # EncoderBatchSolver works on.
+    def parse_word_array(self):
+        import numpy
+        word_array = numpy.frombuffer(self.data, dtype='>u4',
+                                      count=self.get_word_count())
+        padded_word = self.get_padded_word()
+        if padded_word is not None:
+            word_array = numpy.concatenate(
+                (word_array, numpy.frombuffer(padded_word, dtype='>u4')))
+        return word_array.astype(numpy.uint32)
+
+    # Pads and returns the input as raw bytes
+    def get_data(self):
+        data = self.data[:self.get_word_count() * 4].tobytes()
+        padded_word = self.get_padded_word()
+        if padded_word is not None:
+            data += padded_word
+        return data
+
+    # Lets go of the data, e.g. so a memory map can be closed
+    def release(self):
+        self.data.release()
+
+
+# Returns the parser for a payload given to encode and the functions like it:
+# an EncoderBinaryParser for raw bytes, an EncoderInputParser for a string of
+# hex.
+def get_payload_parser(payload):
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return EncoderBinaryParser(payload)
+    return EncoderInputParser(payload)
+
+
+# Reads the input from a file (or stdin) a chunk at a time instead of all at
+# once.  The words have to be pushed last word first, so the input is cleaned
+# and spooled to a temporary file as raw bytes, which is then read back to
+# front.  Memory use is bounded by the chunk size no matter how large the
+# input is.
+class EncoderStreamParser(EncoderParser):
+
+    def __init__(self, input_file, chunk_size=65536):
+        self.input_file = input_file
+        # Keep the chunks on a double word boundary
+        self.chunk_size = max(4, chunk_size - (chunk_size % 4))
+        self.spool = None
+        self.length = 0
+
+    # Cleans the input and writes it to the spool as bytes, padding with NOP
+    # the same way EncoderInputParser.pad does.  This method doesn't need to
+    # be called directly.  Happens during the "parse".
+    def spool_input(self):
+        import tempfile
+        self.spool = tempfile.TemporaryFile()
+        self.length = 0
+        leftover = ''
+        while True:
+            chunk = self.input_file.read(self.chunk_size)
+            if not chunk:
+                break
+            clean_byte_string = EncoderParser(leftover + chunk).strip()
+            # A byte may be split across two chunks
+            if len(clean_byte_string) % 2 > 0:
+                leftover = clean_byte_string[-1]
+                clean_byte_string = clean_byte_string[:-1]
+            else:
+                leftover = ''
+            self.spool.write(binascii.unhexlify(clean_byte_string))
+            self.length += len(clean_byte_string) // 2
+
+        # Check if we are missing a nibble.
+        if leftover:
+            raise MissingNibbleError(leftover)
+
+        padding = (4 - (self.length % 4)) % 4
+        self.spool.write(binascii.unhexlify(
+            EncoderInstructions.nop_op_code * padding))
+        self.length += padding
+
+    # Yields the raw bytes of the input a chunk at a time, starting at the end
+    # of the input.  Every chunk is a whole number of double words.
+    def iter_chunks_reverse(self):
+        self.spool_input()
+        position = self.length
+        while position > 0:
+            start = max(0, position - self.chunk_size)
+            self.spool.seek(start)
+            chunk = self.spool.read(position - start)
+            position = start
+            yield chunk
+        self.spool.close()
+
+    # Yields EncoderDoubleWord objects, last word first
+    def iter_words_reverse(self):
+        for chunk in self.iter_chunks_reverse():
+            values = struct.unpack('>%dI' % (len(chunk) // 4), chunk)
+            for value in reversed(values):
+                yield EncoderDoubleWord(value)
+
+    # Yields NumPy uint32 arrays of words, last word first.  This is what the
+    # EncoderBatchSolver works on.
+    def iter_word_arrays_reverse(self):
+        import numpy
+        for chunk in self.iter_chunks_reverse():
+            yield numpy.frombuffer(chunk, dtype='>u4')[::-1].astype(
+                numpy.uint32)
+
+
+# Solves a list of words (as integers) and returns the list of operand
+# tuples.  This runs in the worker processes when encoding with more than one
+# job, so it has to live at the module level to be picklable.  Each worker
+# builds its operand table once and keeps it for every chunk it gets.
+def solve_word_chunk(profile, optimize, dedup, collect_errors, engine,
+                     cross_check, chunk):
+    previous, values = chunk
+    encoder = SubtractionEncoder(None, optimize=optimize, dedup=dedup,
+                                 collect_errors=collect_errors,
+                                 cross_check=cross_check)
+    encoder.profile = profile
+    encoder.operand_table = profile.get_operand_table()
+    encoder.operand_search = profile.get_operand_search()
+    encoder.solver = encoder.get_solver(engine)
+    operands = list(encoder.iter_operands([EncoderDoubleWord(value)
+                                           for value in values],
+                                          previous=previous))
+    return operands, encoder.failures
+
+
+# A word that couldn't be encoded.  index is the word's place in the payload
+# (its place in the order the words are pushed while they are being solved),
+# word the word, target the value the SUB instructions had to take away and
+# error the message of the exception.
+EncoderFailure = collections.namedtuple('EncoderFailure',
+                                        ['index', 'word', 'target', 'error'])
+
+
+# The size of the stub an encoding will make, worked out from the operands
+# without building or rendering the program.  size is in bytes, zero_outs is
+# the number of words EAX is zeroed for and sub_counts the number of SUB
+# instructions for each word of the payload, in order.
+EncoderEstimate = collections.namedtuple('EncoderEstimate',
+                                         ['size', 'instructions', 'words',
+                                          'zero_outs', 'sub_counts'])
+
+
+# A single instruction of an EncodedProgram.  The name is one of the
+# instructions in EncoderInstructions (e.g. 'sub_eax').  The operand is an
+# integer, or None for instructions that don't take one.
+EncodedInstruction = collections.namedtuple('EncodedInstruction',
+                                            ['name', 'operand'])
+
+
+# The decoder stub as a list of instructions.  The encoding is only done
+# once, the emitters then render the same program in whatever formats are
+# needed.
+class EncodedProgram(object):
+
+    def __init__(self, instructions=None):
+        if instructions is None:
+            instructions = []
+        self.instructions = list(instructions)
+
+    def __iter__(self):
+        return iter(self.instructions)
+
+    def __len__(self):
+        return len(self.instructions)
+
+    # The instructions without operands never change so they are shared
+    push_esp = EncodedInstruction('push_esp', None)
+    pop_eax = EncodedInstruction('pop_eax', None)
+    zero_out_eax_1 = EncodedInstruction('zero_out_eax_1', None)
+    zero_out_eax_2 = EncodedInstruction('zero_out_eax_2', None)
+    push_eax = EncodedInstruction('push_eax', None)
+
+    # Yields the instructions for a list of (operand_one, operand_two,
+    # operand_three) tuples, one tuple per word.  None in place of a tuple
+    # means the word is the same as the one before it, which EAX still
+    # holds, so it is just pushed again.
+    @classmethod
+    def iter_instructions(cls, operands):
+        yield cls.push_esp
+        yield cls.pop_eax
+        for word_operands in operands:
+            yield from cls.iter_word_instructions(word_operands)
+
+    # The instructions for a single word of iter_instructions
+    @classmethod
+    def iter_word_instructions(cls, word_operands):
+        if word_operands is not None:
+            yield cls.zero_out_eax_1
+            yield cls.zero_out_eax_2
+            for operand in word_operands:
+                yield EncodedInstruction('sub_eax', operand)
+        yield cls.push_eax
+
+    # Same as iter_instructions, but each word comes with a flag that says
+    # whether EAX is zeroed out first.  When it isn't, the operands take EAX
+    # from the previous word to this one.
+    @classmethod
+    def iter_chained_instructions(cls, chained_operands):
+        yield cls.push_esp
+        yield cls.pop_eax
+        for word_operands, zero_out in chained_operands:
+            yield from cls.iter_chained_word_instructions(word_operands,
+                                                          zero_out)
+
+    # The instructions for a single word of iter_chained_instructions
+    @classmethod
+    def iter_chained_word_instructions(cls, word_operands, zero_out):
+        if zero_out:
+            yield cls.zero_out_eax_1
+            yield cls.zero_out_eax_2
+        for operand in word_operands:
+            yield EncodedInstruction('sub_eax', operand)
+        yield cls.push_eax
+
+    @classmethod
+    def from_operands(cls, operands):
+        return cls(cls.iter_instructions(operands))
+
+    @classmethod
+    def from_chained_operands(cls, chained_operands):
+        return cls(cls.iter_chained_instructions(chained_operands))
+
+
+# Runs an encoded stub, as raw bytes, the way an x86 would.  Only the
+# instructions in EncoderInstructions are known, which is all a stub is made
+# of.  The registers are plain integers and the stack is a dict of double
+# words by address, so a stub for a payload of megabytes runs in one pass
+# without building an object per word.
+class EncoderEmulator(object):
+
+    # Where ESP starts.  Any value works, the stub only pushes relative to it.
+    start_esp = 0x0012ff00
+
+    immediate = struct.Struct('<I')
+
+    def __init__(self, esp=None):
+        if esp is None:
+            esp = self.start_esp
+        self.eax = 0
+        self.esp = esp
+        self.memory = {}
+        self.instructions = 0
+
+    # Runs the code and returns what it pushed, i.e. the memory from ESP up
+    # to where ESP started, as bytes.  That is the decoded payload.
+    def run(self, data):
+        data = bytes(data)
+        unpack_from = self.immediate.unpack_from
+        memory = self.memory
+        eax = self.eax
+        esp = start = self.esp
+        position = 0
+        count = 0
+        length = len(data)
+        try:
+            while position < length:
+                op_code = data[position]
+                if op_code == 0x2d:
+                    eax = (eax - unpack_from(data, position + 1)[0]) & \
+                        0xFFFFFFFF
+                    position += 5
+                elif op_code == 0x25:
+                    eax &= unpack_from(data, position + 1)[0]
+                    position += 5
+                elif op_code == 0x50:
+                    esp = (esp - 4) & 0xFFFFFFFF
+                    memory[esp] = eax
+                    position += 1
+                elif op_code == 0x54:
+                    # The value pushed is ESP before the push
+                    memory[(esp - 4) & 0xFFFFFFFF] = esp
+                    esp = (esp - 4) & 0xFFFFFFFF
+                    position += 1
+                elif op_code == 0x58 or op_code == 0x5c:
+                    if esp not in memory:
+                        raise EncoderEmulatorError(
+                            ("The instruction at offset %d pops 0x%08x, " +
+                             "which was never pushed") % (position, esp))
+                    value = memory[esp]
+                    esp = (esp + 4) & 0xFFFFFFFF
+                    if op_code == 0x58:
+                        eax = value
+                    else:
+                        esp = value
+                    position += 1
+                elif op_code == 0x90:
+                    position += 1
+                else:
+                    raise EncoderEmulatorError(
+                        "Unknown op code 0x%02x at offset %d" % (op_code,
+                                                                 position))
+                count += 1
+        except struct.error:
+            # An operand runs off the end
+            raise EncoderEmulatorError(
+                "The instruction at offset %d is cut off" % position)
+        self.eax = eax
+        self.esp = esp
+        self.instructions += count
+        try:
+            values = [memory[address] for address in range(esp, start, 4)]
+        except KeyError:
+            raise EncoderEmulatorError(("ESP ended at 0x%08x, past what " +
+                                        "was pushed") % esp)
+        return struct.pack('<%dI' % len(values), *values)
+
+    # Runs the stub and raises an EncoderEmulatorError unless it pushes the
+    # payload (raw bytes, padded to a whole number of words).
+    @classmethod
+    def verify(cls, data, payload):
+        pushed = cls().run(data)
+        if pushed == payload:
+            return
+        if len(pushed) != len(payload):
+            raise EncoderEmulatorError(
+                "The stub pushed %d bytes rather than %d" % (len(pushed),
+                                                             len(payload)))
+        for index in range(0, len(payload), 4):
+            if pushed[index:index + 4] != payload[index:index + 4]:
+                raise EncoderEmulatorError(
+                    ("Word %d of the payload was pushed as 0x%s rather " +
+                     "than 0x%s") % (index // 4, binascii.hexlify(
+                         pushed[index:index + 4]).decode('ascii'),
+                         binascii.hexlify(
+                             payload[index:index + 4]).decode('ascii')))
+
+
+# Renders the instructions of an EncodedProgram to an output file.  The
+# instructions are written one at a time so a program never has to be held
+# in memory all at once.  New output formats subclass this and are added to
+# SubtractionEncoder.emitters.
+class EncoderEmitter(object):
+
+    # Appended to the file name when more than one format is written
+    extension = 'txt'
+    # Whether the output file takes bytes rather than text
+    binary = False
+
+    def __init__(self, out, variable_name='var'):
+        self.out = out
+        self.variable_name = variable_name
+
+    def start(self):
+        pass
+
+    def write(self, instruction):
+        raise NotImplementedError
+
+    def finish(self):
+        pass
+
+    def emit(self, instructions):
+        self.start()
+        for instruction in instructions:
+            self.write(instruction)
+        self.finish()
+
+
+class EncoderRawEmitter(EncoderEmitter):
+
+    extension = 'raw'
+
+    def write(self, instruction):
+        self.out.write(''.join(EncoderInstructions.get_op_code_bytes(
+            instruction)))
+
+    def finish(self):
+        self.out.write('\n')
+
+
+class EncoderPythonEmitter(EncoderEmitter):
+
+    extension = 'py'
+
+    def start(self):
+        self.line = self.variable_name + ' =  \"\\x'
+        self.pending = []
+
+    # Lines are 16 bytes long, whatever is left over waits for the next
+    # instruction.
+    def write(self, instruction):
+        self.pending.extend(EncoderInstructions.get_op_code_bytes(instruction))
+        while len(self.pending) >= 16:
+            self.out.write(self.line + '\\x'.join(self.pending[:16]) + '\"\n')
+            self.line = self.variable_name + ' += \"\\x'
+            self.pending = self.pending[16:]
+
+    def finish(self):
+        if self.pending:
+            self.out.write(self.line + '\\x'.join(self.pending) + '\"\n')
+
+
+# Writes the program as the bytes themselves rather than text.  The bytes are
+# gathered up and written buffer_size at a time, so a streamed program isn't
+# held in memory.
+class EncoderBinEmitter(EncoderEmitter):
+
+    extension = 'bin'
+    binary = True
+    buffer_size = 65536
+
+    def start(self):
+        self.data = bytearray()
+
+    def write(self, instruction):
+        self.data += EncoderInstructions.get_op_code(instruction)
+        if len(self.data) >= self.buffer_size:
+            self.out.write(self.data)
+            self.data = bytearray()
+
+    def finish(self):
+        if self.data:
+            self.out.write(self.data)
+
+
+class EncoderAsmEmitter(EncoderEmitter):
+
+    extension = 'asm'
+
+    def start(self):
+        self.out.write('[SECTION .text]\n')
+        self.out.write('global _start\n')
+        self.out.write('_start:\n')
+
+    def write(self, instruction):
+        self.out.write(EncoderInstructions.get_asm(instruction) + '\n')
+
+
+# Wall time for each stage of an encoding and counters of what happened
+# along the way.  Hand one to the SubtractionEncoder (or use --stats) to see
+# where the time goes.  The hook, if there is one, is called with the report
+# when the encoding is finished.
+#
+# The stages are profile (building the good bytes and their tables), parse,
+# target (working out the subtraction targets), solve, verify, render
+# (turning the instructions into text or bytes) and write.  Target and
+# verify are only timed word by word; the batch and parallel solvers count
+# all of their time as solve.
+class EncoderStats(object):
+
+    stages = ('profile', 'parse', 'target', 'solve', 'verify', 'render',
+              'write')
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.timings = collections.OrderedDict(
+            (stage, 0.0) for stage in self.stages)
+        self.counters = collections.Counter()
+        # The carries out of each column, least significant byte first.  The
+        # solver tries carry 0 first, so each carry is a retry.
+        self.carry_retries = [0, 0, 0, 0]
+        self.start = time.perf_counter()
+        self.total = None
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] += seconds
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def count_carries(self, operands):
+        carry = 0
+        for column in range(0, 4):
+            shift = column * 8
+            carry = (carry + sum((operand >> shift) & 0xFF
+                                 for operand in operands)) >> 8
+            self.carry_retries[column] += carry
+
+    def get_report(self):
+        counters = dict(self.counters)
+        counters['carry_retries'] = list(self.carry_retries)
+        total = self.total
+        if total is None:
+            total = time.perf_counter() - self.start
+        return {'total': total,
+                'timings': dict(self.timings),
+                'counters': counters}
+
+    def finish(self):
+        self.total = time.perf_counter() - self.start
+        report = self.get_report()
+        if self.hook is not None:
+            self.hook(report)
+        return report
+
+    def write(self, out):
+        import json
+        json.dump(self.get_report(), out, indent=2, sort_keys=True)
+        out.write('\n')
+
+
+# Passes writes through to an output file, timing them as the write stage
+class EncoderStatsFile(object):
+
+    def __init__(self, out, stats):
+        self.out = out
+        self.stats = stats
+
+    def write(self, data):
+        start = time.perf_counter()
+        self.out.write(data)
+        self.stats.add_time('write', time.perf_counter() - start)
+
+    def __getattr__(self, name):
+        return getattr(self.out, name)
+
 
 class SubtractionEncoder:
 
@@ -348,184 +1976,1509 @@ class SubtractionEncoder:
     goodbytes = ''
     output_format = ''
     variable_name = ''
-    goodbytes_array = []
-    badbytes_array = []
-    words = []
-    words_reverse = []
+    goodbytes_array = ()
+    badbytes_array = ()
+    profile = None
+    operand_table = None
+    operand_search = None
+    words = ()
+    words_reverse = ()
+    word_array = None
+    target_array = None
+    output_formats = ()
     filename = None
+    batch = False
+    jobs = 1
+    chain = False
+    optimize = 'speed'
+    cache_dir = None
+    dedup = False
+    memo = None
+    input_file = None
+    stats = None
+    collect_errors = False
+    engine = 'auto'
+    engine_name = None
+    cross_check = None
+    solver = None
+    failures = ()
+    operands = None
+    program = None
+
+    # The emitter for each output format
+    emitters = {'asm': EncoderAsmEmitter,
+                'bin': EncoderBinEmitter,
+                'python': EncoderPythonEmitter,
+                'raw': EncoderRawEmitter}
+
+    # The engines that can solve the words, by name.  auto picks one.
+    engines = {'batch': EncoderBatchEngine,
+               'reference': EncoderReferenceEngine,
+               'table': EncoderTableEngine}
+
+    # auto only uses the batch engine from this many words on, below that
+    # importing NumPy costs more than it saves.  Below this many good bytes
+    # the table misses most words, and both engines fall back to the search
+    # for those, so there is nothing to gain either.
+    auto_batch_words = 4096
+    auto_batch_density = 48
+
+    # The number of words handed to a worker process at a time
+    parallel_chunk_size = 4096
 
     def __init__(self, inputbytes, goodbytes=None, badbytes=None,
-                 output_format='python', variable_name='var', filename=None):
+                 output_format='python', variable_name='var', filename=None,
+                 batch=False, jobs=1, chain=False, optimize='speed',
+                 cache_dir=None, dedup=False, memo=None, input_file=None,
+                 stats=None, collect_errors=False, engine='auto',
+                 cross_check=None):
 
         self.inbytes = inputbytes
+        # A raw binary file to encode in place of inputbytes
+        self.input_file = input_file
         self.badbytes = badbytes
         self.goodbytes = goodbytes
         self.output_format = output_format
+        # More than one format can be asked for at once, e.g. ['asm', 'raw']
+        if output_format is None:
+            self.output_formats = []
+        elif isinstance(output_format, (list, tuple)):
+            self.output_formats = list(output_format)
+        else:
+            self.output_formats = [output_format]
         self.variable_name = variable_name
         self.words = []
         self.words_reverse = []
         self.goodbytes_array = []
         self.badbytes_array = []
+        self.profile = None
+        self.operand_table = None
+        self.operand_search = None
+        self.word_array = None
+        # The targets of word_array, when they are shared between profiles
+        self.target_array = None
         self.filename = filename
+        self.batch = batch
+        self.jobs = jobs
+        self.chain = chain
+        # 'speed' uses the operand table, with three operands per word, and
+        # only searches when the table can't solve a word.  'size' searches
+        # for the fewest operands for every word.
+        self.optimize = optimize
+        # The directory to keep the solver tables in between runs.  None
+        # means they are built in memory every run.
+        self.cache_dir = cache_dir
+        # Push EAX again for a word that is the same as the one before it,
+        # rather than zeroing EAX and subtracting our way back to it.
+        self.dedup = dedup
+        # Operands that have already been solved.  An EncoderOperandMemo can
+        # be shared between encoders.
+        if memo is None:
+            memo = EncoderOperandMemo()
+        self.memo = memo
+        # An EncoderStats to fill in, or None
+        self.stats = stats
+        # Keep going past words that can't be encoded.  They are listed in
+        # failures and a zero is pushed in their place.
+        self.collect_errors = collect_errors
+        # The name of the engine to solve the words with, or auto.  batch is
+        # the same as the batch engine.
+        self.engine = engine
+        # The engine picked for the input, once it is known
+        self.engine_name = None
+        # The name of a second engine that every word is checked against
+        self.cross_check = cross_check
+        # The engine that solves one word at a time
+        self.solver = None
+        self.failures = []
+        # The operands for each word (with the zero out flag when chained)
+        # in the order the words get pushed, once they are solved
+        self.operands = None
+        self.program = None
+
+    # Builds the ByteProfile of good bytes and the operand table and search
+    # for it.  goodbytes can be a ByteProfile that was built ahead of time.
+    def load_goodbytes(self):
+        start = time.perf_counter()
+        if isinstance(self.goodbytes, ByteProfile):
+            self.profile = self.goodbytes
+        elif self.goodbytes is not None:
+            self.profile = ByteProfile.from_goodbytes(self.goodbytes)
+        elif self.badbytes is not None:
+            self.badbytes = EncoderParser(self.badbytes).clean()
+            self.profile = ByteProfile.from_badbytes(self.badbytes)
+        self.goodbytes_array = self.profile.get_byte_array()
+        if self.cache_dir is not None:
+            cache = EncoderTableCache(self.cache_dir)
+            self.operand_table, self.operand_search = \
+                cache.get_tables(self.profile)
+            if self.stats is not None:
+                self.stats.count('table_cache_hits', cache.hits)
+                self.stats.count('table_cache_misses', cache.misses)
+        else:
+            self.operand_table = self.profile.get_operand_table()
+            self.operand_search = self.profile.get_operand_search()
+        self.solver = self.get_solver(self.engine)
+        if self.stats is not None:
+            self.stats.add_time('profile', time.perf_counter() - start)
+
+    # Returns the engine, checked against the cross check engine if there is
+    # one.  auto gets the table engine, which is what every other engine
+    # does for a single word.
+    def get_solver(self, name):
+        if name == 'auto':
+            name = 'table'
+        solver = self.engines[name](self.profile, self.operand_table)
+        if self.cross_check is not None:
+            solver = EncoderCrossCheckEngine(solver, self.engines[
+                self.cross_check](self.profile, self.operand_table))
+        return solver
+
+    # Returns the name of the engine for an input of word_count words (None
+    # if that isn't known).  auto picks the batch engine for large inputs
+    # with dense enough good bytes, when NumPy is installed, and the table
+    # engine otherwise.
+    def choose_engine(self, word_count=None):
+        if self.batch:
+            return 'batch'
+        if self.engine != 'auto':
+            return self.engine
+        if word_count is None or word_count < self.auto_batch_words:
+            return 'table'
+        if self.optimize != 'speed' or self.jobs > 1:
+            return 'table'
+        if self.profile is not None and \
+                len(self.profile) < self.auto_batch_density:
+            return 'table'
+        if not EncoderBatchEngine.is_available():
+            return 'table'
+        return 'batch'
+
+    # Returns the engine that solves whole arrays of words
+    def get_batch_solver(self):
+        if self.solver.batch:
+            return self.solver
+        return self.get_solver('batch')
+
+    # The batch engine works the same way as the operand table, so it is only
+    # used when optimizing for speed.
+    def use_batch(self):
+        if self.engine_name is None:
+            self.engine_name = self.choose_engine()
+        return self.engines[self.engine_name].batch and \
+            self.optimize == 'speed'
 
     def process(self, debug=False):
         # First, let's get an array of good bytes.
-        if self.goodbytes is not None:
-            self.goodbytes_array = EncoderParser(self.goodbytes).get_byte_array()
-        elif self.badbytes is not None:
-            self.badbytes = EncoderParser(self.badbytes).clean()
-            self.goodbytes_array = EncoderParser(self.badbytes).get_inverted_byte_array()
+        self.load_goodbytes()
 
         # Second, we will organize the input to array of EncoderDoubleWord's
-        self.words = EncoderInputParser(self.inbytes).parse_words()
+        # or, for the batch solver, an array of integers.
+        self.parse_input()
+
+        # Encode once, then write every format from the same program
+        if self.output_formats:
+            self.write_program(self.get_program(debug), self.output_formats)
+        if self.stats is not None:
+            self.stats.finish()
+
+    # Encodes the input once for each of the profiles (strings of good bytes
+    # or ByteProfiles).  The input is parsed and the subtraction targets are
+    # worked out once, then each profile only solves and renders.  The
+    # output of profile n goes to FILENAME.<n> (or STDOUT) with the variable
+    # name <variable_name>_<n>.  Returns a list of the failures for each
+    # profile.
+    def process_profiles(self, profiles, debug=False, verify=False):
+        self.parse_input(shared=True)
+
+        variable_name, filename = self.variable_name, self.filename
+        failures = []
+        try:
+            for index, profile in enumerate(profiles):
+                self.use_profile(profile)
+                self.variable_name = '%s_%d' % (variable_name, index)
+                if filename is not None:
+                    self.filename = '%s.%d' % (filename, index)
+                if self.output_formats:
+                    self.write_program(self.get_program(debug),
+                                       self.output_formats)
+                if verify:
+                    self.verify(debug)
+                failures.append(self.failures)
+        finally:
+            self.variable_name, self.filename = variable_name, filename
+        if self.stats is not None:
+            self.stats.finish()
+        return failures
+
+    # Parses inputbytes, or the input file, see parse_payload
+    def parse_input(self, shared=False):
+        start = time.perf_counter()
+        if self.input_file is not None:
+            self.parse_input_file(shared)
+        else:
+            self.parse_payload(EncoderInputParser(self.inbytes), shared)
+        if self.stats is not None:
+            self.stats.add_time('parse', time.perf_counter() - start)
+
+    # Organizes the input from the parser (an EncoderInputParser or an
+    # EncoderBinaryParser) into an array of EncoderDoubleWord's or, for the
+    # batch solver, an array of integers.  With shared, the words are
+    # EncoderSharedWord's, for encoding with more than one profile.
+    def parse_payload(self, parser, shared=False):
+        self.engine_name = self.choose_engine(parser.get_word_count())
+        self.target_array = None
+        if self.use_batch():
+            self.word_array = parser.parse_word_array()
+            self.words = []
+            if shared:
+                self.target_array = EncoderBatchSolver.get_targets(
+                    self.word_array)
+        elif shared:
+            self.words = [EncoderSharedWord(word.value)
+                          for word in parser.parse_words()]
+        else:
+            self.words = parser.parse_words()
         self.words_reverse = self.words[::-1]
-
-        if self.output_format == 'asm':
-            self.process_asm(debug)
-        elif self.output_format == 'python':
-            self.process_python(debug)
-        elif self.output_format == 'raw':
-            self.process_raw(debug)
-
+        self.failures = []
+        self.operands = None
+        self.program = None
+
+    # Switches to another set of good bytes (a string or a ByteProfile) for
+    # the same input.  The input isn't parsed again, only solved again.
+    def use_profile(self, profile):
+        self.goodbytes = profile
+        self.badbytes = None
+        self.load_goodbytes()
+        self.failures = []
+        self.operands = None
+        self.program = None
+
+    # Memory maps the raw binary input file and parses the words straight out
+    # of it.
+    def parse_input_file(self, shared=False):
+        with open(self.input_file, 'rb') as input_file:
+            try:
+                data = mmap.mmap(input_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file can't be mapped
+                data = None
+            parser = EncoderBinaryParser(b'' if data is None else data)
+            try:
+                self.parse_payload(parser, shared)
+            finally:
+                parser.release()
+                if data is not None:
+                    data.close()
+
+    # Checks the input against the good bytes without encoding it.  Returns
+    # an EncoderInfeasibleWord for every word that can't be encoded.
+    def analyze(self):
+        self.load_goodbytes()
+        # The analyzer needs the words, which the batch engine doesn't parse
+        batch, engine = self.batch, self.engine
+        self.batch, self.engine = False, 'table'
+        try:
+            if self.input_file is not None:
+                self.parse_input_file()
+            else:
+                self.parse_payload(EncoderInputParser(self.inbytes))
+        finally:
+            self.batch, self.engine = batch, engine
+        return EncoderFeasibilityAnalyzer.get_analyzer(self.profile).scan(
+            self.words, self.chain, self.dedup)
+
+    # Encodes input read from a file object (e.g. sys.stdin) rather than
+    # from inputbytes.  The input is read, encoded and written out a chunk at
+    # a time so it never has to be held in memory all at once.
+    def process_stream(self, input_file, debug=False, chunk_size=65536):
+        self.load_goodbytes()
+        self.engine_name = self.choose_engine()
+        self.failures = []
+        parser = EncoderStreamParser(input_file, chunk_size)
+        if self.chain:
+            if self.use_batch():
+                chained_operands = self.iter_batch_chained_operands(
+                    parser.iter_word_arrays_reverse())
+            else:
+                chained_operands = self.iter_chained_operands(
+                    parser.iter_words_reverse(), debug)
+            self.write_program(EncodedProgram.iter_chained_instructions(
+                chained_operands), self.output_formats)
+        else:
+            if self.use_batch():
+                operands = self.iter_batch_operands(
+                    parser.iter_word_arrays_reverse())
+            elif self.jobs > 1 and not debug:
+                operands = self.iter_parallel_operands(
+                    parser.iter_words_reverse(), self.parallel_chunk_size)
+            else:
+                operands = self.iter_operands(parser.iter_words_reverse(),
+                                              debug)
+            self.write_program(EncodedProgram.iter_instructions(operands),
+                               self.output_formats)
+
+        self.index_failures(parser.length // 4)
+        if self.stats is not None:
+            self.stats.finish()
+
+    # Returns a tuple of operands that sum to the value, or None if the good
+    # bytes can't do it.
+    def solve_value(self, value):
+        stats = self.stats
+        key = (value, self.profile, self.optimize)
+        # Words are always solved again when cross checking
+        operands = False
+        if self.cross_check is None:
+            operands = self.memo.get(key, False)
+        if operands is not False:
+            if stats is not None:
+                stats.count('memo_hits')
+            return operands
+        if stats is not None:
+            start = time.perf_counter()
+        operands = None
+        if self.optimize == 'speed':
+            operands = self.solver.solve(value)
+        if operands is None:
+            operands = self.operand_search.solve_smallest(value)
+        if stats is not None:
+            stats.add_time('solve', time.perf_counter() - start)
+        self.memo.put(key, operands)
+        return operands
+
+    # Finds the operands for the EncoderDoubleWordTarget and checks them
+    def calculate_target(self, substraction_target, debug=False):
+        stats = self.stats
+        key = (substraction_target.get_base_ten(), self.profile, self.optimize)
+        # The debug output shows the working, so nothing comes from the memo.
+        # Neither does anything when cross checking.
+        operands = None
+        if not debug and self.cross_check is None:
+            operands = self.memo.get(key)
+        if operands is not None:
+            if stats is not None:
+                stats.count('memo_hits')
+            substraction_target.operands = operands
+            return
+        if stats is not None:
+            start = time.perf_counter()
+        if self.optimize == 'speed':
+            operands = self.solver.solve(substraction_target.get_base_ten())
+        # Let's calcualte the operands.  The table only fails for sparse good
+        # bytes, in which case we search.
+        if operands is None:
+            if stats is not None and self.optimize == 'speed':
+                stats.count('table_misses')
+            try:
+                substraction_target.search(self.operand_search, debug)
+            except UnableToFindOperandsError:
+                if stats is not None:
+                    stats.count('failures')
+                raise
+        elif debug:
+            substraction_target.calculate(self.operand_table, debug)
+        else:
+            substraction_target.operands = operands
+        if stats is not None:
+            solved = time.perf_counter()
+            stats.add_time('solve', solved - start)
+        # We'll do a quick sanity check
+        substraction_target.verify_result()
+        if stats is not None:
+            stats.add_time('verify', time.perf_counter() - solved)
+            stats.count('words_solved')
+            stats.count_carries(substraction_target.get_operands())
+        self.memo.put(key, substraction_target.get_operands())
+
+    # Solves the target with calculate_target and returns the operands.  When
+    # collecting errors, a target that can't be solved is added to failures
+    # (at the position the word is pushed) and no operands are returned, so
+    # EAX is zeroed and the zero is pushed in place of the word.
+    def collect_target(self, substraction_target, position, debug=False):
+        if not self.collect_errors:
+            self.calculate_target(substraction_target, debug)
+            return substraction_target.get_operands()
+        try:
+            self.calculate_target(substraction_target, debug)
+        except (UnableToFindOperandsError, InvalidResultError) as error:
+            target = substraction_target.get_base_ten()
+            self.failures.append(EncoderFailure(
+                position, EncoderDoubleWord((-target) & 0xFFFFFFFF).get_reverse(),
+                target, str(error)))
+            return ()
+        return substraction_target.get_operands()
+
+    # The failures are found in the order the words are pushed.  Once all
+    # count words are done, this turns their positions into places in the
+    # payload.
+    def index_failures(self, count):
+        self.failures = sorted(
+            failure._replace(index=count - 1 - failure.index)
+            for failure in self.failures)
+
+    # Yields a tuple of operands for each of the words, in order.  With
+    # dedup, a word that is the same as the one before it (previous for the
+    # first word) yields None.
+    def iter_operands(self, words_reverse, debug=False, previous=None):
+        stats = self.stats
+        for position, word in enumerate(words_reverse):
+            if self.dedup:
+                value = word.get_base_ten()
+                if value == previous:
+                    if stats is not None:
+                        stats.count('repeated')
+                    yield None
+                    continue
+            if stats is None:
+                substraction_target = word.get_subtraction_target()
+            else:
+                start = time.perf_counter()
+                substraction_target = word.get_subtraction_target()
+                stats.add_time('target', time.perf_counter() - start)
+            operands = self.collect_target(substraction_target, position,
+                                           debug)
+            if self.dedup:
+                # After a failure EAX holds zero rather than the word, so the
+                # same word again can't just be pushed again
+                previous = value if operands else None
+            yield operands
+
+    # Same as iter_operands, but the words come in as NumPy arrays which are
+    # solved an array at a time.  The targets of each array can be passed in
+    # if they are already known.
+    def iter_batch_operands(self, word_arrays_reverse,
+                            target_arrays_reverse=None):
+        solver = self.get_batch_solver()
+        if target_arrays_reverse is None:
+            target_arrays_reverse = itertools.repeat(None)
+        previous = None
+        # Whether the last word failed, leaving zero in EAX
+        zeroed = False
+        position = 0
+        for word_array, targets in zip(word_arrays_reverse,
+                                       target_arrays_reverse):
+            if len(word_array) == 0:
+                continue
+            start = time.perf_counter()
+            if targets is None:
+                targets = solver.get_targets(word_array)
+            operand_one, operand_two, operand_three, failed = \
+                solver.solve_array(targets)
+            if self.stats is not None:
+                self.stats.add_time('solve', time.perf_counter() - start)
+                self.stats.count('words_solved', len(word_array))
+            if self.dedup:
+                repeated = solver.numpy.zeros(len(word_array), dtype=bool)
+                repeated[1:] = word_array[1:] == word_array[:-1]
+                repeated[0] = word_array[0] == previous
+                previous = word_array[-1]
+            for i, word_operands in enumerate(zip(operand_one.tolist(),
+                                                  operand_two.tolist(),
+                                                  operand_three.tolist())):
+                if self.dedup and repeated[i] and not zeroed:
+                    yield None
+                    continue
+                if failed[i]:
+                    word_operands = self.collect_target(
+                        EncoderDoubleWordTarget(int(targets[i])),
+                        position + i)
+                zeroed = not word_operands
+                yield word_operands
+            position += len(word_array)
+
+    # Same as iter_operands, but the words are split into contiguous chunks
+    # which are solved by a pool of self.jobs worker processes.  The operands
+    # still come out in order.  Only a couple of chunks per worker are handed
+    # out ahead of the one being yielded, so a stream is still only read as
+    # fast as it is written out.
+    def iter_parallel_operands(self, words_reverse, chunk_size):
+        import multiprocessing
+        pool = multiprocessing.Pool(self.jobs)
+        try:
+            chunks = self.iter_value_chunks(words_reverse, chunk_size)
+            solve = functools.partial(solve_word_chunk, self.profile,
+                                      self.optimize, self.dedup,
+                                      self.collect_errors, self.engine_name,
+                                      self.cross_check)
+            # Each chunk's values are kept with its result, as the words may
+            # come from a generator
+            pending = collections.deque(
+                (chunk[1], pool.apply_async(solve, (chunk,)))
+                for chunk in itertools.islice(chunks, 2 * self.jobs))
+            position = 0
+            zeroed = False
+            while pending:
+                start = time.perf_counter()
+                values, result = pending.popleft()
+                result = result.get()
+                if self.stats is not None:
+                    self.stats.add_time('solve', time.perf_counter() - start)
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    pending.append((chunk[1],
+                                    pool.apply_async(solve, (chunk,))))
+                operands, failures = result
+                for failure in failures:
+                    self.failures.append(failure._replace(
+                        index=position + failure.index))
+                for i, word_operands in enumerate(operands):
+                    if word_operands is None and zeroed:
+                        # The worker only knew the word before its chunk, not
+                        # that it failed and left zero in EAX
+                        word = EncoderDoubleWord(values[i])
+                        word_operands = self.collect_target(
+                            word.get_subtraction_target(), position + i)
+                    zeroed = word_operands == ()
+                    yield word_operands
+                position += len(operands)
+        finally:
+            pool.terminate()
+            pool.join()
+
+    # Groups the words into lists of at most chunk_size integers.  Each list
+    # comes with the integer before it (None for the first) for dedup.
+    def iter_value_chunks(self, words, chunk_size):
+        previous = None
+        chunk = []
+        for word in words:
+            chunk.append(word.get_base_ten())
+            if len(chunk) == chunk_size:
+                yield previous, chunk
+                previous = chunk[-1]
+                chunk = []
+        if chunk:
+            yield previous, chunk
+
+    # When optimizing for size, zeroing EAX (two instructions) is worth it
+    # if it saves more than two SUB instructions over chaining.
+    def prefer_zero_out(self, substraction_target, chained_operands):
+        if self.optimize != 'size':
+            return False
+        operands = self.solve_value(substraction_target.get_base_ten())
+        return operands is not None and \
+            len(operands) + 2 < len(chained_operands)
+
+    # Yields a (operands, zero_out) tuple for each of the words, in order.
+    # After a PUSH EAX, EAX still holds the word that was pushed, so rather
+    # than zeroing EAX we try to subtract our way from the previous word to
+    # this one.  Only if that can't be done with the good bytes is EAX zeroed
+    # out.  The first word is always zeroed since we don't know what is in
+    # EAX, unless previous says what it holds.
+    def iter_chained_operands(self, words_reverse, debug=False, previous=None):
+        for position, word in enumerate(words_reverse):
+            # The value EAX has to hold for the push, e.g. 0x04030201 for the
+            # word 0x01020304
+            value = word.get_reverse()
+            if self.dedup and value == previous:
+                yield (), False
+                continue
+            substraction_target = word.get_subtraction_target()
+            if previous is not None:
+                chained_target = EncoderDoubleWordTarget(
+                    (previous - value) & 0xFFFFFFFF)
+                operands = self.solve_value(chained_target.get_base_ten())
+                if operands is not None and \
+                        not self.prefer_zero_out(substraction_target,
+                                                 operands):
+                    chained_target.operands = operands
+                    chained_target.verify_result()
+                    previous = value
+                    yield operands, False
+                    continue
+
+            operands = self.collect_target(substraction_target, position,
+                                           debug)
+            # After a failure EAX holds zero rather than the word, so the
+            # next word is zeroed too rather than chained.  That way the word
+            # can be put right later without touching the ones around it.
+            previous = value if operands else None
+            yield operands, True
+
+    # Same as iter_chained_operands, but the words come in as NumPy arrays
+    # which are solved an array at a time, see iter_batch_operands.
+    def iter_batch_chained_operands(self, word_arrays_reverse,
+                                    target_arrays_reverse=None):
+        solver = self.get_batch_solver()
+        numpy = solver.numpy
+        if target_arrays_reverse is None:
+            target_arrays_reverse = itertools.repeat(None)
+        previous = None
+        position = 0
+        for word_array, targets in zip(word_arrays_reverse,
+                                       target_arrays_reverse):
+            if len(word_array) == 0:
+                continue
+            values = word_array.byteswap()
+            # EAX before each word is the previous word.  The first word of
+            # the input has nothing to go from.
+            if previous is None:
+                previous_values = numpy.concatenate((values[:1], values[:-1]))
+            else:
+                previous_values = numpy.concatenate(([previous], values[:-1]))
+            start = time.perf_counter()
+            differences = numpy.subtract(previous_values, values)
+            chained = solver.solve_array(differences)
+            if targets is None:
+                targets = solver.get_targets(word_array)
+            zeroed = solver.solve_array(targets)
+            if self.stats is not None:
+                self.stats.add_time('solve', time.perf_counter() - start)
+
+            # Whether EAX holds the word before this one, see
+            # iter_chained_operands
+            chainable = previous is not None
+            for i in range(0, len(word_array)):
+                if (i > 0 or previous is not None) and chainable:
+                    if self.dedup and differences[i] == 0:
+                        yield (), False
+                        continue
+                    if not chained[3][i]:
+                        yield (int(chained[0][i]), int(chained[1][i]),
+                               int(chained[2][i])), False
+                        continue
+                    # The table couldn't do it, but a search might
+                    operands = self.solve_value(int(differences[i]))
+                    if operands is not None:
+                        yield operands, False
+                        continue
+
+                chainable = True
+                if not zeroed[3][i]:
+                    yield (int(zeroed[0][i]), int(zeroed[1][i]),
+                           int(zeroed[2][i])), True
+                else:
+                    operands = self.collect_target(EncoderDoubleWordTarget(
+                        (-int(values[i])) & 0xFFFFFFFF), position + i)
+                    chainable = bool(operands)
+                    yield operands, True
+            previous = values[-1] if chainable else None
+            position += len(word_array)
+
+    # The targets of the words in the order they get pushed, for the batch
+    # solver, if they are shared
+    def get_target_arrays_reverse(self):
+        if self.target_array is None:
+            return None
+        return [self.target_array[::-1]]
+
+    # Returns a list of (operands, zero_out) tuples, one per word, in the
+    # order the words get pushed.
+    def get_chained_operands(self, debug=False):
+        if self.use_batch():
+            return list(self.iter_batch_chained_operands(
+                [self.word_array[::-1]], self.get_target_arrays_reverse()))
+        return list(self.iter_chained_operands(self.words_reverse, debug))
+
+    # Returns a list of operand tuples, one per word, in the order the words
+    # get pushed.
+    def get_operands(self, debug=False):
+        if self.use_batch():
+            return list(self.iter_batch_operands(
+                [self.word_array[::-1]], self.get_target_arrays_reverse()))
+        if self.jobs > 1 and not debug:
+            # Give every worker at least one chunk
+            chunk_size = -(-len(self.words_reverse) // self.jobs)
+            return list(self.iter_parallel_operands(
+                self.words_reverse,
+                max(1, min(chunk_size, self.parallel_chunk_size))))
+        return list(self.iter_operands(self.words_reverse, debug))
+
+    # Solves the words, if they haven't been already, and returns the
+    # operands for each word in the order they get pushed.
+    def solve(self, debug=False):
+        if self.operands is None:
+            self.failures = []
+            if self.chain:
+                self.operands = self.get_chained_operands(debug)
+            else:
+                self.operands = self.get_operands(debug)
+            self.index_failures(len(self.operands))
+        return self.operands
+
+    # Returns an EncoderEstimate of the stub for the input.  The words are
+    # solved but nothing is rendered, so this is much cheaper than
+    # get_program and the same EncodedProgram is built from it after.
+    def estimate(self, debug=False):
+        size = 2
+        instructions = 2
+        zero_outs = 0
+        sub_counts = []
+        if self.chain:
+            for word_operands, zero_out in self.solve(debug):
+                sub_counts.append(len(word_operands))
+                if zero_out:
+                    zero_outs += 1
+        else:
+            for word_operands in self.solve(debug):
+                if word_operands is None:
+                    sub_counts.append(0)
+                else:
+                    sub_counts.append(len(word_operands))
+                    zero_outs += 1
+        subs = sum(sub_counts)
+        # AND EAX is five bytes and there are two of them, SUB EAX is five
+        # bytes and PUSH EAX is one
+        size += (10 * zero_outs) + (5 * subs) + len(sub_counts)
+        instructions += (2 * zero_outs) + subs + len(sub_counts)
+        return EncoderEstimate(size, instructions, len(sub_counts), zero_outs,
+                               sub_counts[::-1])
+
+    # Returns the EncodedProgram for the input.  The words are only solved
+    # the first time.
+    def get_program(self, debug=False):
+        if self.program is not None:
+            return self.program
+        self.solve(debug)
+        if self.chain:
+            self.program = EncodedProgram.from_chained_operands(self.operands)
+        else:
+            self.program = EncodedProgram.from_operands(self.operands)
+        return self.program
+
+    # Solves the words that failed again with another set of good bytes (a
+    # string or a ByteProfile), leaving every other word as it is.  The words
+    # that still fail stay in failures, which is returned.  Call get_program
+    # for the new program.
+    def retry(self, goodbytes):
+        if self.operands is None:
+            self.get_program()
+        encoder = SubtractionEncoder(None, goodbytes, output_format=None,
+                                     optimize=self.optimize, memo=self.memo,
+                                     cache_dir=self.cache_dir,
+                                     collect_errors=True, engine=self.engine,
+                                     cross_check=self.cross_check)
+        encoder.load_goodbytes()
+        failures = []
+        count = len(self.operands)
+        for failure in self.failures:
+            operands = encoder.collect_target(
+                EncoderDoubleWordTarget(failure.target), failure.index)
+            if not operands:
+                failures.append(encoder.failures.pop())
+                continue
+            position = count - 1 - failure.index
+            if self.chain:
+                self.operands[position] = (operands, True)
+            else:
+                self.operands[position] = operands
+        self.failures = failures
+        self.program = None
+        return self.failures
+
+    # The payload as raw bytes, padded to a whole number of words
+    def get_payload_bytes(self):
+        if self.use_batch():
+            return self.word_array.astype('>u4').tobytes()
+        return struct.pack('>%dI' % len(self.words),
+                           *[word.value for word in self.words])
+
+    # Runs the encoded stub in the EncoderEmulator and raises an
+    # EncoderEmulatorError unless it pushes the payload.  A word that failed,
+    # when collecting errors, is expected to be pushed as zero.
+    def verify(self, debug=False):
+        program = self.get_program(debug)
+        start = time.perf_counter()
+        payload = self.get_payload_bytes()
+        if self.failures:
+            payload = bytearray(payload)
+            for failure in self.failures:
+                payload[failure.index * 4:failure.index * 4 + 4] = bytes(4)
+        EncoderEmulator.verify(b''.join(
+            [EncoderInstructions.get_op_code(instruction)
+             for instruction in program]), bytes(payload))
+        if self.stats is not None:
+            self.stats.add_time('verify', time.perf_counter() - start)
 
     def get_output_bytes(self, debug=False):
         byte_list = []
-        byte_list.append(EncoderInstructions.push_esp_op_code)
-        byte_list.append(EncoderInstructions.pop_eax_op_code)
-        for i in range(0, len(self.words_reverse)):
-            byte_list.extend(EncoderInstructions.zero_out_eax_1_op_code_bytes)
-            byte_list.extend(EncoderInstructions.zero_out_eax_2_op_code_bytes)
-            # Let's calcualte the operands
-            substraction_target = self.words_reverse[i].get_subtraction_target()
-            substraction_target.calculate(self.goodbytes_array, debug)
-            # We'll do a quick sanity check
-            substraction_target.verify_result()
-            # Assign the operands to objects for readability
-            operand_one = substraction_target.get_operand_one()
-            operand_two = substraction_target.get_operand_two()
-            operand_three = substraction_target.get_operand_three()
-
-            byte_list.append(EncoderInstructions.sub_eax_op_code)
-            byte_list.extend(operand_one.get_byte_array_reverse())
-            byte_list.append(EncoderInstructions.sub_eax_op_code)
-            byte_list.extend(operand_two.get_byte_array_reverse())
-            byte_list.append(EncoderInstructions.sub_eax_op_code)
-            byte_list.extend(operand_three.get_byte_array_reverse())
-            byte_list.append(EncoderInstructions.push_eax_op_code)
+        for instruction in self.get_program(debug):
+            byte_list.extend(EncoderInstructions.get_op_code_bytes(instruction))
         return byte_list
 
+    # Returns the file to write the format to.  When more than one format is
+    # written, each one gets its own file named after the format's extension.
+    def get_filename(self, output_format, output_formats):
+        if self.filename is None or len(output_formats) < 2:
+            return self.filename
+        return self.filename + '.' + self.emitters[output_format].extension
+
+    # Renders the instructions in each of the formats to their files, or
+    # STDOUT if there is no file.  The instructions are only walked once.
+    def write_program(self, instructions, output_formats):
+        stats = self.stats
+        files = []
+        emitters = []
+        try:
+            for output_format in output_formats:
+                emitter = self.emitters[output_format]
+                filename = self.get_filename(output_format, output_formats)
+                if filename is None and emitter.binary:
+                    sys.stdout.flush()
+                    out = getattr(sys.stdout, 'buffer', sys.stdout)
+                elif filename is None:
+                    out = sys.stdout
+                else:
+                    out = open(filename, 'wb' if emitter.binary else 'w')
+                    files.append(out)
+                if stats is not None:
+                    out = EncoderStatsFile(out, stats)
+                emitters.append(emitter(out, self.variable_name))
+
+            if stats is None:
+                for emitter in emitters:
+                    emitter.start()
+                for instruction in instructions:
+                    for emitter in emitters:
+                        emitter.write(instruction)
+                for emitter in emitters:
+                    emitter.finish()
+                return
+
+            # The instructions may still be being solved as they come in, so
+            # only the time in the emitters counts as rendering.
+            render = 0.0
+            write = stats.timings['write']
+            start = time.perf_counter()
+            for emitter in emitters:
+                emitter.start()
+            render += time.perf_counter() - start
+            for instruction in instructions:
+                if instruction is EncodedProgram.push_eax:
+                    stats.count('words')
+                elif instruction.name == 'zero_out_eax_1':
+                    stats.count('zero_outs')
+                elif instruction.name == 'sub_eax':
+                    stats.count('sub_instructions')
+                start = time.perf_counter()
+                for emitter in emitters:
+                    emitter.write(instruction)
+                render += time.perf_counter() - start
+            start = time.perf_counter()
+            for emitter in emitters:
+                emitter.finish()
+            render += time.perf_counter() - start
+            stats.add_time('render',
+                           render - (stats.timings['write'] - write))
+        finally:
+            for out in files:
+                out.close()
+
+    def process_raw(self, debug=False):
+        self.write_program(self.get_program(debug), ['raw'])
+
+    def process_python(self, debug=False):
+        self.write_program(self.get_program(debug), ['python'])
 
+    def process_asm(self, debug=False):
+        self.write_program(self.get_program(debug), ['asm'])
 
-    def process_raw(self,debug=False):
-        old_stdout = sys.stdout
-        byte_list = self.get_output_bytes(debug)
-        if self.filename is not None:
-            sys.stdout = open(self.filename,'w')
-
-        for i in range(0, len(byte_list)):
-            sys.stdout.write(byte_list[i])
-
-        sys.stdout.write('\n')
-        if self.filename is not None:
-            sys.stdout.close()
-            sys.stdout = old_stdout
-
-    def process_python(self,debug=False):
-        old_stdout = sys.stdout
-        byte_list = self.get_output_bytes(debug)
-        if self.filename is not None:
-            sys.stdout = open(self.filename,'w')
-
-
-        new_byte_list = [byte_list[i:i+16] for i in range(0, len(byte_list), 16)]
-
-        for i in range(0, len(new_byte_list)):
-            if i == 0:
-                sys.stdout.write(self.variable_name
-                                 + ' =  \"\\x'
-                                 + '\\x'.join(new_byte_list[i])
-                                 + '\"\n')
-            else:
-                sys.stdout.write(self.variable_name
-                                 + ' += \"\\x'
-                                 + '\\x'.join(new_byte_list[i])
-                                 + '\"\n')
-
-        if self.filename is not None:
-            sys.stdout.close()
-            sys.stdout = old_stdout
 
+# The result of encode.  It holds the EncodedProgram and renders it in any of
+# the output formats, as a value or to an output file that is passed in.
+class EncodedResult(object):
 
-    def process_asm(self, debug=False):
-        old_stdout = sys.stdout
-
-        if self.filename is not None:
-            sys.stdout = open(self.filename,'w')
-
-        sys.stdout.write('[SECTION .text]\n')
-        sys.stdout.write('global _start\n')
-        sys.stdout.write('_start:\n')
-        sys.stdout.write(EncoderInstructions.push_esp+'\n')
-        sys.stdout.write(EncoderInstructions.pop_eax+'\n')
-        for i in range(0, len(self.words_reverse)):
-            # Print the zero out EAX instructions
-            sys.stdout.write(EncoderInstructions.zero_out_eax_1+'\n')
-            sys.stdout.write(EncoderInstructions.zero_out_eax_2+'\n')
-            # Let's calcualte the operands
-            substraction_target = self.words_reverse[i].get_subtraction_target()
-            substraction_target.calculate(self.goodbytes_array,debug)
-            # We'll do a quick sanity check
-            substraction_target.verify_result()
-            # Assign the operands to objects for readability
-            operand_one = substraction_target.get_operand_one()
-            operand_two = substraction_target.get_operand_two()
-            operand_three = substraction_target.get_operand_three()
-            # Print the instructions
-            sys.stdout.write(EncoderInstructions.sub_eax + operand_one.get_all_digits_base_sixteen(pretty=True)+'\n')
-            sys.stdout.write(EncoderInstructions.sub_eax + operand_two.get_all_digits_base_sixteen(pretty=True) + '\n')
-            sys.stdout.write(EncoderInstructions.sub_eax +                             operand_three.get_all_digits_base_sixteen(pretty=True) + '\n')
-            # Print out the instruction to push to the stack
-            sys.stdout.write(EncoderInstructions.push_eax + '\n')
-
-        if self.filename is not None:
-            sys.stdout.close()
-            sys.stdout = old_stdout
+    def __init__(self, program, variable_name='var', failures=(), data=None):
+        self.program = program
+        self.variable_name = variable_name
+        # The EncoderFailure for each word that couldn't be encoded, when
+        # encode was asked to collect errors
+        self.failures = list(failures)
+        # The bytes of the program, if they are already known
+        self.data = data
+
+    def __iter__(self):
+        return iter(self.program)
+
+    # The encoded stub as raw bytes
+    def get_bytes(self):
+        if self.data is not None:
+            return self.data
+        return b''.join([EncoderInstructions.get_op_code(instruction)
+                         for instruction in self.program])
+
+    # Writes the program to the output file in the format
+    def write(self, out, output_format='bin'):
+        SubtractionEncoder.emitters[output_format](
+            out, self.variable_name).emit(self.program)
+
+    # Returns the program in the format, as bytes for the binary formats and
+    # text for the rest
+    def render(self, output_format):
+        if SubtractionEncoder.emitters[output_format].binary:
+            out = io.BytesIO()
+        else:
+            out = io.StringIO()
+        self.write(out, output_format)
+        return out.getvalue()
+
+
+# Encodes the payload with the good bytes and returns an EncodedResult.  The
+# payload is raw bytes, or a string of hex.  profile is a ByteProfile or a
+# string of good bytes.  Nothing is written anywhere and no global state is
+# changed, so this can be called from many threads at once.  With
+# collect_errors, the words that can't be encoded are in the result's failures
+# rather than raised.
+def encode(payload, profile, chain=False, optimize='speed', dedup=False,
+           batch=False, memo=None, variable_name='var', collect_errors=False,
+           engine='auto', cross_check=None):
+    encoder = SubtractionEncoder(None, profile, output_format=None,
+                                 variable_name=variable_name, batch=batch,
+                                 chain=chain, optimize=optimize, dedup=dedup,
+                                 memo=memo, collect_errors=collect_errors,
+                                 engine=engine, cross_check=cross_check)
+    encoder.load_goodbytes()
+    encoder.parse_payload(get_payload_parser(payload))
+    return EncodedResult(encoder.get_program(), variable_name,
+                         encoder.failures)
+
+
+# Encodes one payload after another, where each is an edit of the last (a new
+# address, port or offset patched in).  Only the words that changed are solved
+# and turned into instructions and bytes again, and the result is the same as
+# encode would give for the new payload.
+#
+# The words are their own fingerprints.  The instructions for a word only
+# depend on its value and, when chaining or deduping, on the word pushed
+# before it, so a changed word and the word pushed after it are all that are
+# done again.  A payload with a different number of words is done from
+# scratch.
+class EncoderIncremental(object):
+
+    def __init__(self, profile, chain=False, optimize='speed', dedup=False,
+                 memo=None, variable_name='var'):
+        self.encoder = SubtractionEncoder(None, profile, output_format=None,
+                                          variable_name=variable_name,
+                                          chain=chain, optimize=optimize,
+                                          dedup=dedup, memo=memo)
+        self.encoder.load_goodbytes()
+        self.variable_name = variable_name
+        # The last payload as raw bytes, padded to a whole number of words
+        self.data = None
+        # For each word, in the order they get pushed, the instructions and
+        # the bytes of those instructions
+        self.instructions = []
+        self.pieces = []
+        # The number of words done again by the last encode
+        self.changed = 0
+
+    # The payload (raw bytes, or a string of hex) as raw bytes, padded with
+    # NOP by its parser
+    @staticmethod
+    def get_data(payload):
+        return get_payload_parser(payload).get_data()
+
+    # Yields the index of each word that differs between old and new, which
+    # are the same length, looking only at the halves that differ.  Comparing
+    # bytes is done in C, so the time goes with the number of changes.
+    @classmethod
+    def iter_changed(cls, old, new, start, end):
+        if old[start:end] == new[start:end]:
+            return
+        if end - start == 4:
+            yield start // 4
+            return
+        middle = start + (end - start) // 8 * 4
+        yield from cls.iter_changed(old, new, start, middle)
+        yield from cls.iter_changed(old, new, middle, end)
+
+    # Solves the word at position (in the order the words get pushed) and
+    # returns its instructions
+    def solve_word(self, data, count, position):
+        encoder = self.encoder
+        offset = (count - 1 - position) * 4
+        word = EncoderDoubleWord(struct.unpack_from('>I', data, offset)[0])
+        previous = None
+        if position > 0 and (encoder.chain or encoder.dedup):
+            previous = EncoderDoubleWord(
+                struct.unpack_from('>I', data, offset + 4)[0])
+        if encoder.chain:
+            if previous is not None:
+                previous = previous.get_reverse()
+            word_operands, zero_out = next(encoder.iter_chained_operands(
+                [word], previous=previous))
+            return list(EncodedProgram.iter_chained_word_instructions(
+                word_operands, zero_out))
+        if previous is not None:
+            previous = previous.get_base_ten()
+        word_operands = next(encoder.iter_operands([word], previous=previous))
+        return list(EncodedProgram.iter_word_instructions(word_operands))
+
+    # Encodes the payload and returns an EncodedResult.  If a word can't be
+    # encoded the exception is raised and the last payload is kept.
+    def encode(self, payload):
+        data = self.get_data(payload)
+        count = len(data) // 4
+        if self.data is None or len(self.data) != len(data):
+            positions = range(0, count)
+        else:
+            positions = set()
+            for index in self.iter_changed(self.data, data, 0, len(data)):
+                position = count - 1 - index
+                positions.add(position)
+                if self.encoder.chain or self.encoder.dedup:
+                    positions.add(position + 1)
+            positions = sorted(position for position in positions
+                               if position < count)
+
+        solved = [(position, self.solve_word(data, count, position))
+                  for position in positions]
+        if len(self.instructions) != count:
+            self.instructions = [None] * count
+            self.pieces = [None] * count
+        for position, instructions in solved:
+            self.instructions[position] = instructions
+            self.pieces[position] = b''.join(
+                [EncoderInstructions.get_op_code(instruction)
+                 for instruction in instructions])
+        self.data = data
+        self.changed = len(solved)
+        return self.get_result()
+
+    # The EncodedResult for the last payload
+    def get_result(self):
+        start = [EncodedProgram.push_esp, EncodedProgram.pop_eax]
+        program = EncodedProgram(itertools.chain(
+            start, itertools.chain.from_iterable(self.instructions)))
+        data = b''.join(itertools.chain(
+            [EncoderInstructions.get_op_code(instruction)
+             for instruction in start], self.pieces))
+        return EncodedResult(program, self.variable_name, data=data)
+
+
+# Encodes the payload once for each of the profiles (ByteProfiles or strings
+# of good bytes) and returns a list of EncodedResults, one per profile.  The
+# payload is only parsed and turned into subtraction targets once.  The
+# options are the same as encode's.
+def encode_profiles(payload, profiles, chain=False, optimize='speed',
+                    dedup=False, batch=False, memo=None, variable_name='var',
+                    collect_errors=False, engine='auto', cross_check=None):
+    encoder = SubtractionEncoder(None, None, output_format=None,
+                                 variable_name=variable_name, batch=batch,
+                                 chain=chain, optimize=optimize, dedup=dedup,
+                                 memo=memo, collect_errors=collect_errors,
+                                 engine=engine, cross_check=cross_check)
+    encoder.parse_payload(get_payload_parser(payload), shared=True)
+    results = []
+    for profile in profiles:
+        encoder.use_profile(profile)
+        results.append(EncodedResult(encoder.get_program(), variable_name,
+                                     encoder.failures))
+    return results
+
+
+# Returns an EncoderEstimate of the stub encode would return, without
+# building or rendering it.  The arguments are the same as encode's.
+def estimate(payload, profile, chain=False, optimize='speed', dedup=False,
+             batch=False, memo=None, collect_errors=False, engine='auto'):
+    encoder = SubtractionEncoder(None, profile, output_format=None,
+                                 batch=batch, chain=chain, optimize=optimize,
+                                 dedup=dedup, memo=memo,
+                                 collect_errors=collect_errors, engine=engine)
+    encoder.load_goodbytes()
+    encoder.parse_payload(get_payload_parser(payload))
+    return encoder.estimate()
+
+
+# Describes an EncoderEstimate in a line, e.g. "140 bytes, 44 instructions,
+# 6 words (6 zeroed), SUB instructions per word: 3 x 6"
+def get_estimate_summary(estimate):
+    counts = collections.Counter(estimate.sub_counts)
+    return '%d bytes, %d instructions, %d words (%d zeroed), SUB ' \
+        'instructions per word: %s' % (
+            estimate.size, estimate.instructions, estimate.words,
+            estimate.zero_outs, ', '.join('%d x %d' % (subs, counts[subs])
+                                          for subs in sorted(counts)))
+
+
+# Runs a list of encoding jobs in one process, so starting Python, building
+# the tables for a set of good bytes and the operand memo are paid for once
+# rather than once per job.  A manifest is a JSON list of jobs (or an object
+# with the list under "jobs"), or a CSV file with a header row:
+#
+#   [{"input_file": "stage1.bin", "badbytes": "000a0d", "format": "bin",
+#     "filename": "stage1.enc"}, ...]
+#
+# Each job has its input, as input_file (a raw binary file) or input (a
+# string of hex), one of goodbytes or badbytes, and the filename to write to.
+# format (one, or a list, or in CSV separated by spaces), variablename,
+# chain, optimize, dedup, engine and keep_going are optional and default to
+# the defaults passed in.  Relative paths are relative to the manifest.
+class EncoderManifest(object):
+
+    default_options = {'format': ['python'], 'variablename': 'var',
+                       'chain': False, 'optimize': 'speed', 'dedup': False,
+                       'engine': 'auto', 'keep_going': False}
+
+    # The options that are flags, which come out of a CSV file as strings
+    flags = ('chain', 'dedup', 'keep_going')
+
+    # Set in each worker process by start_manifest_worker
+    worker = None
+
+    def __init__(self, defaults=None, cache_dir=None, directory='.',
+                 memo_size=1 << 20):
+        self.defaults = dict(self.default_options, **(defaults or {}))
+        self.cache_dir = cache_dir
+        self.directory = directory
+        self.profiles = EncoderProfiles(cache_dir)
+        self.memo = EncoderOperandMemo(memo_size)
+
+    # Reads the jobs from a JSON or CSV manifest, by its extension
+    @staticmethod
+    def load(path):
+        import csv
+        import json
+        with open(path, 'r', newline='') as manifest_file:
+            if path.lower().endswith('.csv'):
+                # An empty cell is the same as leaving the option out
+                return [dict((key, value) for key, value in row.items()
+                             if key and value is not None and value.strip())
+                        for row in csv.DictReader(manifest_file)]
+            jobs = json.load(manifest_file)
+        if isinstance(jobs, dict):
+            jobs = jobs.get('jobs', [])
+        return jobs
+
+    # Returns the job with the defaults filled in and the CSV strings turned
+    # into flags and lists.  A job's own goodbytes or badbytes replace both
+    # of the defaults.
+    def get_options(self, job):
+        options = dict(self.defaults)
+        if 'goodbytes' in job or 'badbytes' in job:
+            options.pop('goodbytes', None)
+            options.pop('badbytes', None)
+        options.update(job)
+        for flag in self.flags:
+            if isinstance(options[flag], str):
+                options[flag] = get_flag(options[flag])
+        if isinstance(options['format'], str):
+            options['format'] = options['format'].replace(',', ' ').split()
+        return options
+
+    def get_path(self, path):
+        return os.path.join(self.directory, path)
+
+    # Encodes the job at index and writes its output.  Returns the job's
+    # entry in the summary, which has its status ('ok' or 'failed'), the
+    # error if it failed and the time it took.
+    def run_job(self, index, job):
+        start = time.perf_counter()
+        summary = {'job': index, 'input': job.get('input_file', '<input>'),
+                   'filename': job.get('filename')}
+        try:
+            options = self.get_options(job)
+            if options.get('filename') is None:
+                raise ValueError('The job has no filename')
+            for output_format in options['format']:
+                if output_format not in SubtractionEncoder.emitters:
+                    raise ValueError('Unknown format ' + repr(output_format))
+            input_file = options.get('input_file')
+            if input_file is not None:
+                input_file = self.get_path(input_file)
+            elif options.get('input') is None:
+                raise ValueError('The job has no input or input_file')
+            profile = self.profiles.get_profile(options)
+            encoder = SubtractionEncoder(
+                options.get('input'), profile, None, options['format'],
+                options['variablename'], self.get_path(options['filename']),
+                chain=options['chain'],
+                optimize=options['optimize'], dedup=options['dedup'],
+                memo=self.memo, input_file=input_file,
+                collect_errors=options['keep_going'],
+                engine=options['engine'])
+            encoder.process()
+            summary['words'] = len(encoder.operands)
+            summary['size'] = encoder.estimate().size
+            summary['failures'] = len(encoder.failures)
+            summary['status'] = 'failed' if encoder.failures else 'ok'
+            if encoder.failures:
+                summary['error'] = '%d words couldn\'t be encoded' % len(
+                    encoder.failures)
+        except Exception as error:
+            summary['status'] = 'failed'
+            summary['error'] = type(error).__name__ + ': ' + str(error)
+        summary['seconds'] = time.perf_counter() - start
+        return summary
+
+    # Runs the jobs and returns the summary of each, in order.  With more
+    # than one process, the jobs are shared out between them and each
+    # process keeps its own profiles and memo.
+    def run(self, jobs, processes=1):
+        if processes < 2 or len(jobs) < 2:
+            return [self.run_job(index, job) for index, job in enumerate(jobs)]
+        import multiprocessing
+        with multiprocessing.Pool(processes, start_manifest_worker,
+                                  (self.defaults, self.cache_dir,
+                                   self.directory)) as pool:
+            return pool.starmap(run_manifest_job, enumerate(jobs), 1)
+
+
+# Sets up the EncoderManifest for a worker process of EncoderManifest.run
+def start_manifest_worker(defaults, cache_dir, directory):
+    EncoderManifest.worker = EncoderManifest(defaults, cache_dir, directory)
+
+
+def run_manifest_job(index, job):
+    return EncoderManifest.worker.run_job(index, job)
+
+
+# Turns the value of a flag into a bool.  Any string that isn't one of the
+# false ones (e.g. "False") is true.
+def get_flag(value):
+    return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+
+
+# Runs the jobs in the --manifest, prints a line for each and writes the
+# summary.  Returns the exit status, 1 if any job failed.
+def run_manifest(parser, args):
+    import json
+    defaults = {'format': args.format, 'variablename': args.variablename,
+                'chain': args.chain, 'optimize': args.optimize,
+                'dedup': args.dedup, 'engine': args.engine,
+                'keep_going': args.keep_going}
+    for name in ('goodbytes', 'badbytes'):
+        value = getattr(args, name)
+        if value is not None and len(value) > 1:
+            parser.error('--manifest takes one set of good or bad bytes')
+        elif value is not None:
+            defaults[name] = value[0]
+    manifest = EncoderManifest(defaults,
+                               None if args.no_cache else args.cache_dir,
+                               os.path.dirname(args.manifest))
+    start = time.perf_counter()
+    summaries = manifest.run(EncoderManifest.load(args.manifest), args.jobs)
+    seconds = time.perf_counter() - start
+    failed = 0
+    for summary in summaries:
+        sys.stdout.write('Job %d %s %.3fs %s -> %s%s\n' % (
+            summary['job'], summary['status'], summary['seconds'],
+            summary['input'], summary['filename'],
+            ': ' + summary['error'] if 'error' in summary else ''))
+        if summary['status'] != 'ok':
+            failed += 1
+    sys.stdout.write('%d of %d jobs failed in %.3fs\n' % (
+        failed, len(summaries), seconds))
+    if args.summary is not None:
+        with open(args.summary, 'w') as summary_file:
+            json.dump({'jobs': summaries, 'failed': failed,
+                       'seconds': seconds}, summary_file, indent=2,
+                      sort_keys=True)
+    return 1 if failed else 0
 
 
 def main():
+    import argparse
     parser = argparse.ArgumentParser(description='Encode instructions' +
                                      ' using the SubtractionEncoder')
 
-    parser.add_argument('--input',
-                        help='The string of input bytes',
-                        required=True)
-    group = parser.add_mutually_exclusive_group(required=True)
+    input_group = parser.add_mutually_exclusive_group(required=True)
+    input_group.add_argument('--input',
+                             help='The string of input bytes')
+    input_group.add_argument('--input-file',
+                             help='A raw binary file of input bytes')
+    input_group.add_argument('--stream',
+                             help='A file to read the string of input bytes' +
+                             ' from a chunk at a time, - for STDIN')
+    input_group.add_argument('--manifest',
+                             help='A JSON or CSV file listing jobs to encode,' +
+                             ' each with its own input, good or bad bytes,' +
+                             ' format and filename.  The other options are' +
+                             ' the defaults for the jobs.')
+    group = parser.add_mutually_exclusive_group()
     group.add_argument('--goodbytes',
-                       help='The string of allowed bytes')
+                       help='The string of allowed bytes.  Give more than' +
+                       ' one to encode the input for each of them, see' +
+                       ' --filename',
+                       nargs='+')
     group.add_argument('--badbytes',
-                       help='The string of disallowed bytes')
+                       help='The string of disallowed bytes.  Give more than' +
+                       ' one to encode the input for each of them, see' +
+                       ' --filename',
+                       nargs='+')
     parser.add_argument('--variablename',
                         help='The name of the variable to output',
                         default='var')
     parser.add_argument('--format',
-                        help='The output format',
-                        choices=['asm', 'raw', 'python'],
-                        default='python')
+                        help='The output format.  More than one format can' +
+                        ' be given, each is written to FILENAME.<extension>',
+                        choices=['asm', 'bin', 'raw', 'python'],
+                        nargs='+',
+                        default=['python'])
     parser.add_argument('--filename',
-                        help='The output file name.  Default is STDOUT')
+                        help='The output file name.  Default is STDOUT.' +
+                        '  With more than one set of good or bad bytes, the' +
+                        ' output for set n goes to FILENAME.<n>, with the' +
+                        ' variable name VARIABLENAME_<n>')
     parser.add_argument('--debug',
-                        help='Show additional output.',
-                        default=False)
+                        help='Show additional output.  Takes an optional' +
+                        ' true or false.',
+                        nargs='?',
+                        const=True,
+                        default=False,
+                        type=get_flag)
+    parser.add_argument('--analyze',
+                        help='Report every word the good bytes can\'t' +
+                        ' encode, without encoding anything.',
+                        action='store_true')
+    parser.add_argument('--estimate',
+                        help='Print the size of the stub, the number of' +
+                        ' instructions and the SUB instructions per word,' +
+                        ' without rendering it.',
+                        action='store_true')
+    parser.add_argument('--verify',
+                        help='Run the encoded stub in an emulator and check' +
+                        ' that it pushes the payload.  Not used with' +
+                        ' --stream.',
+                        action='store_true')
+    parser.add_argument('--keep-going',
+                        help='Encode every word that can be, pushing zero for' +
+                        ' the ones that can\'t, and report all of the' +
+                        ' failures at the end.',
+                        action='store_true')
+    parser.add_argument('--stats',
+                        help='Write a JSON report of the time spent in each' +
+                        ' stage, and counters, to STATS.  Default is STDERR',
+                        nargs='?',
+                        const='-')
+    parser.add_argument('--batch',
+                        help='Solve all of the words at once with NumPy.' +
+                        '  Much faster for large inputs.  The same as' +
+                        ' --engine batch.',
+                        action='store_true')
+    parser.add_argument('--engine',
+                        help='How to solve the words.  auto uses batch for' +
+                        ' large inputs when NumPy is installed, and table' +
+                        ' otherwise.  reference is slow but works straight' +
+                        ' from the good bytes.',
+                        choices=['auto'] + sorted(SubtractionEncoder.engines),
+                        default='auto')
+    parser.add_argument('--cross-check',
+                        help='Solve every word with this engine as well, and' +
+                        ' stop if the two disagree.',
+                        choices=sorted(SubtractionEncoder.engines))
+    parser.add_argument('--chain',
+                        help='Subtract from the previous word rather than' +
+                        ' zeroing EAX for every word, where the good bytes' +
+                        ' allow it.  Makes the output smaller.',
+                        action='store_true')
+    parser.add_argument('--optimize',
+                        help='speed uses three SUB instructions per word.' +
+                        '  size uses as few as it can, from one to four.',
+                        choices=['speed', 'size'],
+                        default='speed')
+    parser.add_argument('--dedup',
+                        help='Push EAX again for a word that is the same as ' +
+                        'the one before it, rather than encoding it again.',
+                        action='store_true')
+    parser.add_argument('--cache-dir',
+                        help='Where to keep the solver tables between runs.' +
+                        '  Default is ' + EncoderTableCache.get_default_directory(),
+                        default=EncoderTableCache.get_default_directory())
+    parser.add_argument('--no-cache',
+                        help='Build the solver tables without the cache.',
+                        action='store_true')
+    parser.add_argument('--jobs',
+                        help='The number of processes to solve the words' +
+                        ' with, or with --manifest to run the jobs with.' +
+                        '  Not used with --chain, --batch or --debug, except' +
+                        ' with --manifest.',
+                        type=int,
+                        default=1)
+    parser.add_argument('--summary',
+                        help='Write a JSON summary of the --manifest jobs,' +
+                        ' with the status and time of each, to SUMMARY.')
 
     args = parser.parse_args()
-    substraction_encoder = SubtractionEncoder(args.input, args.goodbytes,
-                                              args.badbytes, args.format,
-                                              args.variablename, args.filename)
-    substraction_encoder.process(args.debug)
+    if args.manifest is not None:
+        sys.exit(run_manifest(parser, args))
+    if args.goodbytes is None and args.badbytes is None:
+        parser.error('one of the arguments --goodbytes --badbytes is ' +
+                     'required')
+    if args.goodbytes is not None:
+        profiles = args.goodbytes
+    else:
+        profiles = [ByteProfile.from_badbytes(EncoderParser(badbytes).clean())
+                    for badbytes in args.badbytes]
+    if len(profiles) > 1 and (args.analyze or args.stream is not None):
+        parser.error('--analyze and --stream take one set of good or bad ' +
+                     'bytes')
+    if args.estimate and args.stream is not None:
+        parser.error('--estimate doesn\'t work with --stream')
+
+    substraction_encoder = SubtractionEncoder(args.input, profiles[0],
+                                              None, args.format,
+                                              args.variablename, args.filename,
+                                              args.batch, args.jobs,
+                                              args.chain, args.optimize,
+                                              None if args.no_cache
+                                              else args.cache_dir,
+                                              args.dedup,
+                                              input_file=args.input_file,
+                                              collect_errors=args.keep_going,
+                                              engine=args.engine,
+                                              cross_check=args.cross_check)
+    if args.stats is not None:
+        substraction_encoder.stats = EncoderStats()
+
+    if args.analyze:
+        infeasible = substraction_encoder.analyze()
+        for word in infeasible:
+            sys.stdout.write(get_infeasible_reason(word) + '\n')
+        sys.stdout.write('%d of %d words can\'t be encoded\n' % (
+            len(infeasible), len(substraction_encoder.words)))
+        sys.exit(1 if infeasible else 0)
+    if args.estimate:
+        substraction_encoder.parse_input(shared=len(profiles) > 1)
+        failures = []
+        for index, profile in enumerate(profiles):
+            substraction_encoder.use_profile(profile)
+            summary = get_estimate_summary(
+                substraction_encoder.estimate(args.debug))
+            if len(profiles) > 1:
+                summary = 'Profile %d: %s' % (index, summary)
+            sys.stdout.write(summary + '\n')
+            failures.append(substraction_encoder.failures)
+    elif len(profiles) > 1:
+        failures = substraction_encoder.process_profiles(profiles,
+                                                         args.debug,
+                                                         args.verify)
+    elif args.stream is None:
+        substraction_encoder.process(args.debug)
+        if args.verify:
+            substraction_encoder.verify(args.debug)
+    elif args.stream == '-':
+        substraction_encoder.process_stream(sys.stdin, args.debug)
+    else:
+        with open(args.stream, 'r') as input_file:
+            substraction_encoder.process_stream(input_file, args.debug)
+
+    if args.stats == '-':
+        substraction_encoder.stats.write(sys.stderr)
+    elif args.stats is not None:
+        with open(args.stats, 'w') as stats_file:
+            substraction_encoder.stats.write(stats_file)
+
+    if len(profiles) == 1 and not args.estimate:
+        failures = [substraction_encoder.failures]
+    failed = 0
+    for index, profile_failures in enumerate(failures):
+        for failure in profile_failures:
+            if len(profiles) > 1:
+                sys.stderr.write('Profile %d: ' % index)
+            sys.stderr.write('Word %d (0x%08x): %s\n' % (
+                failure.index, failure.word, failure.error))
+        failed += len(profile_failures)
+    if failed:
+        sys.stderr.write('%d words couldn\'t be encoded\n' % failed)
+        sys.exit(1)
 
 if __name__ == "__main__":
-    sys.stdout.write('The encoder of last resort when all others fail...\n')
-    sys.stdout.write('At the moment, this is only for x86 instruction set.\n')
-    sys.stdout.write('The ASM output is Intel notation.\n')
-    sys.stdout.write('@kevensen\n')
+    # The banner goes to STDERR, the output can go to STDOUT (e.g. a binary
+    # stub redirected to a file)
+    sys.stderr.write('The encoder of last resort when all others fail...\n')
+    sys.stderr.write('At the moment, this is only for x86 instruction set.\n')
+    sys.stderr.write('The ASM output is Intel notation.\n')
+    sys.stderr.write('@kevensen\n')
     main()
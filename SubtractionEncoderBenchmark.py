@@ -0,0 +1,317 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import string
+import subprocess
+import sys
+import time
+
+from SubtractionEncoder import ByteProfile
+from SubtractionEncoder import EncoderInputParser
+from SubtractionEncoder import EncoderOperandMemo
+from SubtractionEncoder import SubtractionEncoder
+
+
+# Bumped whenever the benchmarks change in a way that makes old results
+# meaningless to compare against
+BENCHMARK_VERSION = 1
+
+# The payload sizes, in bytes
+SIZES = [4, 64, 1024, 16384, 262144, 1048576]
+
+# The payload sizes for the startup benchmarks.  The payload goes on the
+# command line, so they stay small.
+STARTUP_SIZES = [4, 64, 1024]
+
+# The good bytes, from dense to alphanumeric only
+DENSITIES = {
+    'dense': ''.join("{:02x}".format(i) for i in range(1, 256)),
+    'printable': ''.join("{:02x}".format(i) for i in range(0x20, 0x7f)),
+    'alphanumeric': ''.join("{:02x}".format(ord(c)) for c in
+                            string.ascii_letters + string.digits),
+}
+
+
+HEX = ["{:02x}".format(i) for i in range(0, 256)]
+
+
+# Returns a random payload of size bytes as a string of hex.  The same size
+# always gets the same payload.
+def get_payload(size):
+    generator = random.Random(size)
+    return ''.join(HEX[generator.randint(0, 255)] for i in range(size))
+
+
+def get_encoder(payload, goodbytes, memo=None):
+    encoder = SubtractionEncoder(payload, goodbytes, output_format=None,
+                                 filename=os.devnull, memo=memo)
+    encoder.load_goodbytes()
+    return encoder
+
+
+# Each benchmark takes the payload and the good bytes, does whatever set up
+# it needs, and returns the function to time.
+
+def bench_parse_words(payload, goodbytes):
+    return lambda: EncoderInputParser(payload).parse_words()
+
+
+# The solver on its own, one word at a time.  calculate only uses the operand
+# table, so it goes through calculate_target which falls back to the search
+# for the words the table can't do, the same as process does.  The memo is
+# turned off so every word is really solved.
+def bench_calculate(payload, goodbytes):
+    encoder = get_encoder(payload, goodbytes, EncoderOperandMemo(0))
+    targets = [word.get_subtraction_target()
+               for word in EncoderInputParser(payload).parse_words()]
+
+    def run():
+        for target in targets:
+            encoder.calculate_target(target)
+    return run
+
+
+# Only the rendering, the words are solved before the clock starts
+def bench_get_output_bytes(payload, goodbytes):
+    encoder = get_encoder(payload, goodbytes)
+    encoder.process()
+    encoder.get_program()
+    return encoder.get_output_bytes
+
+
+def bench_process(output_format):
+    def bench(payload, goodbytes):
+        def run():
+            encoder = get_encoder(payload, goodbytes)
+            encoder.process()
+            getattr(encoder, 'process_' + output_format)()
+        return run
+    return bench
+
+
+BENCHMARKS = [
+    ('parse_words', bench_parse_words),
+    ('calculate', bench_calculate),
+    ('get_output_bytes', bench_get_output_bytes),
+    ('process_raw', bench_process('raw')),
+    ('process_python', bench_process('python')),
+    ('process_asm', bench_process('asm')),
+]
+
+
+# The startup benchmarks start a new Python for every run, to see how much of
+# encoding a small payload from the command line goes on starting Python and
+# importing, rather than on encoding.  startup_python is the floor.
+def bench_startup(get_command):
+    def bench(payload, goodbytes):
+        command = get_command(payload, goodbytes)
+        directory = os.path.dirname(os.path.abspath(__file__))
+
+        def run():
+            subprocess.check_call(command, cwd=directory,
+                                  stdout=subprocess.DEVNULL)
+        # The first run fills the table cache, the same as the first run of
+        # the encoder with these good bytes would
+        run()
+        return run
+    return bench
+
+
+# The same as the subtraction-encoder command setup.py installs.  Running
+# SubtractionEncoder.py as a script compiles all of it every time, where an
+# import uses the cached bytecode.  The tables are kept in cache_dir, or the
+# encoder's default cache directory.
+def get_cli_command(payload, goodbytes, cache_dir=None):
+    command = [sys.executable, '-c', 'import sys; from SubtractionEncoder'
+               ' import main; sys.exit(main())', '--input', payload,
+               '--goodbytes', goodbytes, '--format', 'raw']
+    if cache_dir is not None:
+        command += ['--cache-dir', cache_dir]
+    return command
+
+
+def get_startup_benchmarks(cache_dir=None):
+    return [
+        ('startup_python', bench_startup(
+            lambda payload, goodbytes: [sys.executable, '-c', 'pass'])),
+        ('startup_import', bench_startup(
+            lambda payload, goodbytes: [sys.executable, '-c',
+                                        'import SubtractionEncoder'])),
+        ('startup_cli', bench_startup(
+            lambda payload, goodbytes: get_cli_command(payload, goodbytes,
+                                                       cache_dir))),
+    ]
+
+
+STARTUP_BENCHMARKS = get_startup_benchmarks()
+
+
+# Runs the function until it has taken at least min_time, and at least once,
+# and returns the best time for a single run and the number of runs.
+def time_function(function, min_time):
+    best = None
+    runs = 0
+    total = 0.0
+    while runs == 0 or total < min_time:
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        runs += 1
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, runs
+
+
+def run_benchmarks(names=None, sizes=None, densities=None, min_time=0.2,
+                   out=None, benchmarks=BENCHMARKS):
+    results = []
+    for name, bench in benchmarks:
+        if names and name not in names:
+            continue
+        for density in sorted(densities or DENSITIES):
+            goodbytes = DENSITIES[density]
+            # Build the tables before the clock starts, they are shared
+            # by every run
+            ByteProfile.from_goodbytes(goodbytes).get_operand_table()
+            ByteProfile.from_goodbytes(goodbytes).get_operand_search()
+            for size in sizes or SIZES:
+                payload = get_payload(size)
+                seconds, runs = time_function(bench(payload, goodbytes),
+                                              min_time)
+                result = {'name': name, 'density': density, 'size': size,
+                          'seconds': seconds, 'runs': runs,
+                          'bytes_per_second': size / seconds}
+                results.append(result)
+                if out is not None:
+                    out.write('%-16s %-12s %8d B %12.6f s %14.0f B/s\n' % (
+                        name, density, size, seconds, size / seconds))
+                    out.flush()
+    return {'version': BENCHMARK_VERSION,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results}
+
+
+def get_key(result):
+    return (result['name'], result['density'], result['size'])
+
+
+# Returns a list of (density, size, fraction) for the startup results, where
+# fraction is how much of startup_cli was spent starting Python and importing
+# the encoder.
+def get_startup_overhead(results):
+    seconds = dict((get_key(result), result['seconds'])
+                   for result in results['results'])
+    overheads = []
+    for name, density, size in sorted(seconds):
+        if name == 'startup_cli' and \
+                ('startup_import', density, size) in seconds:
+            overheads.append((density, size, seconds[
+                ('startup_import', density, size)] / seconds[
+                    (name, density, size)]))
+    return overheads
+
+
+# Compares the results against a baseline and returns a list of (key,
+# baseline seconds, seconds, ratio) for every benchmark in both, and a list
+# of the ones that got slower by more than the threshold (0.1 is 10%).
+def compare(baseline, results, threshold=0.1):
+    if baseline.get('version') != results.get('version'):
+        raise ValueError('The baseline is from version %s of the benchmarks,'
+                         ' these results are from version %s' % (
+                             baseline.get('version'), results.get('version')))
+    baseline_seconds = dict((get_key(result), result['seconds'])
+                            for result in baseline['results'])
+    changes = []
+    regressions = []
+    for result in results['results']:
+        key = get_key(result)
+        if key not in baseline_seconds:
+            continue
+        ratio = result['seconds'] / baseline_seconds[key]
+        change = (key, baseline_seconds[key], result['seconds'], ratio)
+        changes.append(change)
+        if ratio > 1.0 + threshold:
+            regressions.append(change)
+    return changes, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the' +
+                                     ' SubtractionEncoder')
+    parser.add_argument('--output',
+                        help='The file to write the results to, as JSON')
+    parser.add_argument('--baseline',
+                        help='A file of results to compare against')
+    parser.add_argument('--threshold',
+                        help='How much slower than the baseline counts as a' +
+                        ' regression.  Default is 0.1, i.e. 10%%',
+                        type=float,
+                        default=0.1)
+    parser.add_argument('--benchmark',
+                        help='The benchmarks to run.  Default is all of them',
+                        choices=[name for name, bench in BENCHMARKS +
+                                 STARTUP_BENCHMARKS],
+                        nargs='+')
+    parser.add_argument('--startup',
+                        help='Run the startup benchmarks, which start a new' +
+                        ' Python for every run, in place of the others.',
+                        action='store_true')
+    parser.add_argument('--cache-dir',
+                        help='Where the startup benchmarks keep the solver' +
+                        ' tables.  Default is the encoder\'s default.')
+    parser.add_argument('--size',
+                        help='The payload sizes to run, in bytes.  Default' +
+                        ' is ' + ', '.join(str(size) for size in SIZES) +
+                        ', or ' + ', '.join(str(size) for size in
+                                            STARTUP_SIZES) +
+                        ' with --startup',
+                        type=int,
+                        nargs='+')
+    parser.add_argument('--density',
+                        help='The good bytes to run with',
+                        choices=sorted(DENSITIES),
+                        nargs='+')
+    parser.add_argument('--min-time',
+                        help='The least time to spend on each benchmark, in' +
+                        ' seconds.',
+                        type=float,
+                        default=0.2)
+    args = parser.parse_args()
+
+    if args.startup:
+        results = run_benchmarks(args.benchmark, args.size or STARTUP_SIZES,
+                                 args.density, args.min_time, sys.stdout,
+                                 get_startup_benchmarks(args.cache_dir))
+        for density, size, fraction in get_startup_overhead(results):
+            sys.stdout.write('%-16s %-12s %8d B %5.1f%% starting Python and'
+                             ' importing\n' % ('startup_cli', density, size,
+                                               fraction * 100))
+    else:
+        results = run_benchmarks(args.benchmark, args.size, args.density,
+                                 args.min_time, sys.stdout)
+    if args.output is not None:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+    if args.baseline is None:
+        return 0
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    changes, regressions = compare(baseline, results, args.threshold)
+    for key, before, after, ratio in changes:
+        sys.stdout.write('%-16s %-12s %8d B %12.6f s -> %12.6f s %+7.1f%%%s\n'
+                         % (key + (before, after, (ratio - 1.0) * 100,
+                                   '  REGRESSION' if ratio > 1.0 +
+                                   args.threshold else '')))
+    sys.stdout.write('%d of %d benchmarks regressed\n' % (len(regressions),
+                                                         len(changes)))
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
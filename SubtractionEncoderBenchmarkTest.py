@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+from SubtractionEncoderBenchmark import BENCHMARK_VERSION
+from SubtractionEncoderBenchmark import compare
+from SubtractionEncoderBenchmark import get_payload
+from SubtractionEncoderBenchmark import get_startup_benchmarks
+from SubtractionEncoderBenchmark import get_startup_overhead
+from SubtractionEncoderBenchmark import run_benchmarks
+
+
+class SubtractionEncoderBenchmarkTest(unittest.TestCase):
+
+    def get_results(self, seconds):
+        return {'version': BENCHMARK_VERSION,
+                'results': [{'name': 'calculate', 'density': 'dense',
+                             'size': size, 'seconds': seconds[size]}
+                            for size in seconds]}
+
+    def test_get_payload(self):
+        self.assertEqual(len(get_payload(1024)), 2048)
+        self.assertEqual(get_payload(64), get_payload(64))
+
+    def test_run_benchmarks(self):
+        results = run_benchmarks(sizes=[4, 64], densities=['alphanumeric'],
+                                 min_time=0)
+        self.assertEqual(len(results['results']), 6 * 2)
+        for result in results['results']:
+            self.assertGreater(result['seconds'], 0)
+
+    def test_run_startup_benchmarks(self):
+        # The encoder's tables go in a directory of our own rather than the
+        # user's cache
+        directory = tempfile.mkdtemp()
+        try:
+            results = run_benchmarks(
+                sizes=[4], densities=['alphanumeric'], min_time=0,
+                benchmarks=get_startup_benchmarks(directory))
+            self.assertTrue(os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual([result['name'] for result in results['results']],
+                         ['startup_python', 'startup_import', 'startup_cli'])
+        overheads = get_startup_overhead(results)
+        self.assertEqual([overhead[:2] for overhead in overheads],
+                         [('alphanumeric', 4)])
+
+    def test_compare(self):
+        baseline = self.get_results({4: 1.0, 64: 1.0, 1024: 1.0})
+        results = self.get_results({4: 1.05, 64: 1.5, 16384: 1.0})
+        changes, regressions = compare(baseline, results, 0.1)
+        self.assertEqual(len(changes), 2)
+        self.assertEqual([change[0] for change in regressions],
+                         [('calculate', 'dense', 64)])
+
+    def test_compare_version(self):
+        baseline = self.get_results({4: 1.0})
+        baseline['version'] = BENCHMARK_VERSION - 1
+        with self.assertRaises(ValueError):
+            compare(baseline, self.get_results({4: 1.0}))
+
+if __name__ == '__main__':
+    unittest.main()
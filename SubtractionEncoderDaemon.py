@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+
+import argparse
+import asyncio
+import binascii
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from SubtractionEncoder import EncoderOperandMemo
+from SubtractionEncoder import EncoderProfiles
+from SubtractionEncoder import SubtractionEncoder
+from SubtractionEncoder import encode
+
+
+# Raised by the EncoderClient when the daemon couldn't encode a job
+class EncoderDaemonError(Exception):
+    pass
+
+
+# A long running encoder.  Jobs come in over a Unix socket or a TCP port,
+# one JSON object per line, and the result goes back the same way:
+#
+#   {"id": 1, "payload": "31c050...", "goodbytes": "2021...",
+#    "format": "raw", "chain": false, "optimize": "speed", "dedup": false,
+#    "variablename": "var"}
+#
+#   {"id": 1, "output": "54582d..."}  or  {"id": 1, "error": "..."}
+#
+# Only the payload and one of goodbytes or badbytes are required.  The bin
+# format comes back as a string of hex.  Results for a connection can come
+# back in any order, which is what the id is for.
+#
+# The profiles, the solver tables and the operand memo are kept from one job
+# to the next, so only the first job for a set of good bytes pays for them.
+class EncoderDaemon(object):
+
+    # The longest line a job can be.  Payloads are hex, so a lot longer
+    # than the StreamReader default.
+    line_limit = 1 << 26
+
+    def __init__(self, cache_dir=None, jobs=4, memo_size=1 << 20):
+        self.profiles = EncoderProfiles(cache_dir)
+        self.memo = EncoderOperandMemo(memo_size)
+        self.executor = concurrent.futures.ThreadPoolExecutor(jobs)
+        self.requests = 0
+        self.server = None
+        # The task handling each open connection, by its writer
+        self.connections = {}
+
+    # Encodes a job and returns the response.  This runs on the thread pool.
+    def run_job(self, job):
+        response = {'id': None}
+        try:
+            response['id'] = job.get('id')
+            output_format = job.get('format', 'python')
+            if output_format not in SubtractionEncoder.emitters:
+                raise ValueError('Unknown format ' + repr(output_format))
+            result = encode(job['payload'], self.profiles.get_profile(job),
+                            chain=job.get('chain', False),
+                            optimize=job.get('optimize', 'speed'),
+                            dedup=job.get('dedup', False),
+                            memo=self.memo,
+                            variable_name=job.get('variablename', 'var'))
+            output = result.render(output_format)
+            if isinstance(output, bytes):
+                output = binascii.hexlify(output).decode('ascii')
+            response['output'] = output
+        except Exception as error:
+            response['error'] = type(error).__name__ + ': ' + str(error)
+        return response
+
+    def send(self, writer, response):
+        if not writer.is_closing():
+            writer.write(json.dumps(response).encode('utf-8') + b'\n')
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_event_loop()
+        self.connections[writer] = asyncio.current_task()
+        pending = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.requests += 1
+                try:
+                    job = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    job = None
+                if not isinstance(job, dict):
+                    self.send(writer, {'id': None, 'error': 'Bad request'})
+                    continue
+                future = loop.run_in_executor(self.executor, self.run_job, job)
+                future.add_done_callback(
+                    lambda done: self.send(writer, done.result()))
+                pending.add(future)
+                pending = set(future for future in pending
+                              if not future.done())
+                await writer.drain()
+            if pending:
+                await asyncio.wait(pending)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            del self.connections[writer]
+            writer.close()
+
+    # Starts listening on the Unix socket at path, or on host and port
+    async def start(self, path=None, host='127.0.0.1', port=None):
+        if path is not None:
+            self.server = await asyncio.start_unix_server(
+                self.handle, path, limit=self.line_limit)
+        else:
+            self.server = await asyncio.start_server(
+                self.handle, host, port, limit=self.line_limit)
+        return self.server
+
+    def get_port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self, path=None, host='127.0.0.1', port=None):
+        await self.start(path, host, port)
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        # Hang up on the clients and let the jobs they already sent finish
+        connections = list(self.connections.items())
+        for writer, task in connections:
+            writer.close()
+        await asyncio.gather(*[task for writer, task in connections],
+                             return_exceptions=True)
+        self.executor.shutdown()
+
+
+# Talks to an EncoderDaemon.  Any number of encode calls can be waiting at
+# once, they are all sent down the one connection without waiting for the
+# ones before them.
+class EncoderClient(object):
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.futures = {}
+        self.next_id = 0
+        self.listener = asyncio.ensure_future(self.listen())
+
+    @classmethod
+    async def connect(cls, path=None, host='127.0.0.1', port=None):
+        if path is not None:
+            reader, writer = await asyncio.open_unix_connection(
+                path, limit=EncoderDaemon.line_limit)
+        else:
+            reader, writer = await asyncio.open_connection(
+                host, port, limit=EncoderDaemon.line_limit)
+        return cls(reader, writer)
+
+    async def listen(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                response = json.loads(line.decode('utf-8'))
+                future = self.futures.pop(response.get('id'), None)
+                if future is None or future.done():
+                    continue
+                if 'error' in response:
+                    future.set_exception(EncoderDaemonError(response['error']))
+                else:
+                    future.set_result(response['output'])
+        finally:
+            for future in self.futures.values():
+                if not future.done():
+                    future.set_exception(
+                        EncoderDaemonError('Connection closed'))
+            self.futures.clear()
+
+    # Encodes the payload (raw bytes or a string of hex) and returns the
+    # output in the format, bytes for bin and text for the rest.  The other
+    # options are the same as the job fields above.
+    async def encode(self, payload, goodbytes=None, badbytes=None,
+                     output_format='python', **options):
+        if isinstance(payload, (bytes, bytearray, memoryview)):
+            payload = binascii.hexlify(payload).decode('ascii')
+        self.next_id += 1
+        job = dict(options, id=self.next_id, payload=payload,
+                   format=output_format)
+        if goodbytes is not None:
+            job['goodbytes'] = goodbytes
+        else:
+            job['badbytes'] = badbytes
+        future = asyncio.get_event_loop().create_future()
+        self.futures[self.next_id] = future
+        self.writer.write(json.dumps(job).encode('utf-8') + b'\n')
+        await self.writer.drain()
+        output = await future
+        if SubtractionEncoder.emitters[output_format].binary:
+            return binascii.unhexlify(output)
+        return output
+
+    async def close(self):
+        self.writer.close()
+        await self.listener
+
+
+# Times count jobs through a daemon running in this process, all sent at once
+# down one connection.  Returns requests per second.
+async def benchmark_daemon(job, count):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'daemon.sock')
+    daemon = EncoderDaemon()
+    await daemon.start(path)
+    try:
+        client = await EncoderClient.connect(path)
+        # The first job warms up the profile, as it would be in a daemon
+        # that has been running a while
+        await client.encode(**job)
+        start = time.time()
+        await asyncio.gather(*[client.encode(**job) for i in range(count)])
+        elapsed = time.time() - start
+        await client.close()
+    finally:
+        await daemon.close()
+        os.remove(path)
+        os.rmdir(directory)
+    return count / elapsed
+
+
+# Times count runs of the command line encoder, one process each.  Returns
+# requests per second.
+def benchmark_cli(job, count):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'SubtractionEncoder.py')
+    command = [sys.executable, script, '--input', job['payload'],
+               '--format', job['output_format'], '--no-cache']
+    if job.get('goodbytes') is not None:
+        command += ['--goodbytes', job['goodbytes']]
+    else:
+        command += ['--badbytes', job['badbytes']]
+    start = time.time()
+    for i in range(count):
+        subprocess.check_call(command, stdout=subprocess.DEVNULL)
+    return count / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the SubtractionEncoder' +
+                                     ' as a daemon')
+    parser.add_argument('--socket',
+                        help='The Unix socket to listen on')
+    parser.add_argument('--host',
+                        help='The address to listen on when there is no' +
+                        ' socket.  Default is 127.0.0.1',
+                        default='127.0.0.1')
+    parser.add_argument('--port',
+                        help='The TCP port to listen on when there is no' +
+                        ' socket.  Default is 7878',
+                        type=int,
+                        default=7878)
+    parser.add_argument('--jobs',
+                        help='The number of threads to encode with.',
+                        type=int,
+                        default=4)
+    parser.add_argument('--cache-dir',
+                        help='Where to keep the solver tables between runs.',
+                        default=None)
+    parser.add_argument('--benchmark',
+                        help='Compare requests per second through the daemon' +
+                        ' against running the command line encoder, with' +
+                        ' this string of input bytes.')
+    parser.add_argument('--goodbytes',
+                        help='The string of allowed bytes for --benchmark')
+    parser.add_argument('--requests',
+                        help='The number of requests for --benchmark.',
+                        type=int,
+                        default=1000)
+    args = parser.parse_args()
+
+    if args.benchmark is not None:
+        goodbytes = args.goodbytes
+        if goodbytes is None:
+            goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+        job = {'payload': args.benchmark, 'goodbytes': goodbytes,
+               'output_format': 'raw'}
+        daemon_rate = asyncio.run(benchmark_daemon(job, args.requests))
+        cli_rate = benchmark_cli(job, max(1, min(args.requests // 100, 20)))
+        sys.stdout.write('daemon: %.1f requests/s\n' % daemon_rate)
+        sys.stdout.write('cli:    %.1f requests/s\n' % cli_rate)
+        sys.stdout.write('speedup: %.1fx\n' % (daemon_rate / cli_rate))
+        return
+
+    daemon = EncoderDaemon(args.cache_dir, args.jobs)
+    try:
+        asyncio.run(daemon.serve_forever(args.socket, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
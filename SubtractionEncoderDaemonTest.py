@@ -0,0 +1,95 @@
+import asyncio
+import binascii
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from SubtractionEncoder import ByteProfile
+from SubtractionEncoder import encode
+from SubtractionEncoderDaemon import EncoderClient
+from SubtractionEncoderDaemon import EncoderDaemon
+from SubtractionEncoderDaemon import EncoderDaemonError
+
+
+class EncoderDaemonTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'daemon.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    # Runs the coroutine function against a daemon on a Unix socket, or on
+    # TCP when tcp is set.  It is handed a connected client.
+    def run_daemon(self, test, tcp=False):
+        async def run():
+            daemon = EncoderDaemon()
+            if tcp:
+                await daemon.start(port=0)
+                client = await EncoderClient.connect(port=daemon.get_port())
+            else:
+                await daemon.start(self.path)
+                client = await EncoderClient.connect(self.path)
+            try:
+                return await test(client)
+            finally:
+                await client.close()
+                await daemon.close()
+        return asyncio.run(run())
+
+    def test_pipelined(self):
+        payloads = [self.payload * (i + 1) for i in range(0, 20)]
+
+        async def test(client):
+            return await asyncio.gather(*[
+                client.encode(payload, self.goodbytes, output_format='raw',
+                              chain=bool(i % 2))
+                for i, payload in enumerate(payloads)])
+
+        expected = [encode(payload, self.goodbytes,
+                           chain=bool(i % 2)).render('raw')
+                    for i, payload in enumerate(payloads)]
+        self.assertEqual(self.run_daemon(test), expected)
+
+    def test_bin_over_tcp(self):
+        async def test(client):
+            return await client.encode(binascii.unhexlify(self.payload),
+                                       badbytes='000a0d', output_format='bin')
+
+        self.assertEqual(self.run_daemon(test, tcp=True),
+                         encode(self.payload, ByteProfile.from_badbytes(
+                             '000a0d')).get_bytes())
+
+    def test_error(self):
+        async def test(client):
+            with self.assertRaises(EncoderDaemonError):
+                await client.encode(self.payload, '4142', output_format='raw')
+            # The connection is still good after a failed job
+            return await client.encode(self.payload, self.goodbytes,
+                                       output_format='asm')
+
+        self.assertEqual(self.run_daemon(test),
+                         encode(self.payload, self.goodbytes).render('asm'))
+
+    # A line that isn't a JSON object gets an error back, rather than no
+    # answer at all
+    def test_bad_request(self):
+        async def test(client):
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            writer.write(b'[1]\n"x"\nnot json\n')
+            responses = [json.loads(await asyncio.wait_for(reader.readline(),
+                                                           10))
+                         for i in range(3)]
+            writer.close()
+            return responses
+
+        self.assertEqual(self.run_daemon(test),
+                         [{'id': None, 'error': 'Bad request'}] * 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,50 @@
+import binascii
+import io
+import os
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
+from SubtractionEncoder import ByteProfile
+from SubtractionEncoder import EncodedProgram
+from SubtractionEncoder import EncoderBatchSolver
+from SubtractionEncoder import EncoderBinEmitter
+from SubtractionEncoder import EncoderBinaryParser
 from SubtractionEncoder import EncoderDoubleWord
+from SubtractionEncoder import EncoderDoubleWordTarget
 from SubtractionEncoder import EncoderDoubleWordTooLargeError
 from SubtractionEncoder import EncoderDoubleWordTooSmallError
+from SubtractionEncoder import EncoderEmulator
+from SubtractionEncoder import EncoderEmulatorError
+from SubtractionEncoder import EncoderEngineMismatchError
+from SubtractionEncoder import EncoderReferenceEngine
+from SubtractionEncoder import EncoderTableEngine
+from SubtractionEncoder import EncoderFeasibilityAnalyzer
+from SubtractionEncoder import EncoderIncremental
 from SubtractionEncoder import EncoderInputParser
+from SubtractionEncoder import EncoderManifest
+from SubtractionEncoder import EncoderOperandMemo
+from SubtractionEncoder import EncoderOperandSearch
+from SubtractionEncoder import EncoderOperandTable
+from SubtractionEncoder import EncoderStats
+from SubtractionEncoder import EncoderStreamParser
+from SubtractionEncoder import EncoderTableCache
 from SubtractionEncoder import MissingNibbleError
+from SubtractionEncoder import SubtractionEncoder
+from SubtractionEncoder import UnableToFindOperandsError
+from SubtractionEncoder import encode
+from SubtractionEncoder import encode_profiles
+from SubtractionEncoder import estimate
+from SubtractionEncoder import get_flag
+from SubtractionEncoder import get_payload_parser
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class EncoderDoubleWordTest(unittest.TestCase):
 
@@ -72,6 +113,24 @@ class EncoderDoubleWordTest(unittest.TestCase):
         self.assertEqual(testAnswer.get_byte_array()[2], "44")
         self.assertEqual(testAnswer.get_byte_array()[3], "56")
 
+    def test_get_reverse(self):
+        testWord = EncoderDoubleWord(0x01020304)
+        self.assertEqual(testWord.get_reverse(), 0x04030201)
+        self.assertEqual(testWord.get_int_array(), [1, 2, 3, 4])
+        self.assertEqual(testWord.get_int_array_reverse(), [4, 3, 2, 1])
+        self.assertEqual(testWord.get_all_digits_base_sixteen_reverse(),
+                         '04030201')
+
+    def test_get_target_answer_zero(self):
+        testAnswer = EncoderDoubleWord(0).get_subtraction_target()
+        self.assertEqual(testAnswer.get_base_ten(), 0)
+        testAnswer.calculate(["{:02x}".format(i) for i in range(1, 256)])
+        testAnswer.verify_result()
+
+    def test_slots(self):
+        with self.assertRaises(AttributeError):
+            EncoderDoubleWord(10).other = 1
+
 class EncoderInputParserTest(unittest.TestCase):
 
     def test_clean(self):
@@ -90,7 +149,7 @@ class EncoderInputParserTest(unittest.TestCase):
     def test_missing_nibble(self):
         parser = EncoderInputParser("\r123")
         with self.assertRaises(MissingNibbleError):
-            parser.parse()
+            parser.parse_words()
 
     def test_pad(self):
         parser = EncoderInputParser("12")
@@ -106,12 +165,1150 @@ class EncoderInputParserTest(unittest.TestCase):
 
     def test_parse(self):
         parser = EncoderInputParser("12345678AA")
-        result = parser.parse()
+        result = parser.parse_words()
         self.assertTrue(len(result) == 2)
         self.assertTrue('90' not in result[0].get_base_sixteen())
         self.assertTrue(result[1].get_base_sixteen().endswith("909090"))
         self.assertTrue(result[0].get_base_ten() == 305419896)
         self.assertTrue(result[1].get_base_ten() == 2861600912)
 
+class ByteProfileTest(unittest.TestCase):
+
+    def test_from_goodbytes(self):
+        profile = ByteProfile.from_goodbytes("42 41\n4A42")
+        self.assertEqual(list(profile), [0x42, 0x41, 0x4a])
+        self.assertTrue(0x4a in profile)
+        self.assertFalse(0x43 in profile)
+        self.assertEqual(profile.get_byte_array(), ['42', '41', '4a'])
+
+    def test_from_badbytes(self):
+        profile = ByteProfile.from_badbytes("000a0d")
+        self.assertEqual(len(profile), 253)
+        self.assertFalse(0x0a in profile)
+        self.assertEqual(profile.get_byte_array(),
+                         EncoderInputParser("000a0d").get_inverted_byte_array())
+
+    def test_set_algebra(self):
+        one = ByteProfile([1, 2, 3])
+        two = ByteProfile(['03', '04'])
+        self.assertEqual(list(one | two), [1, 2, 3, 4])
+        self.assertEqual(list(one & two), [3])
+        self.assertEqual(len(~one), 253)
+        self.assertEqual(~~one, ByteProfile([1, 2, 3]))
+
+    def test_tables_are_shared(self):
+        profile = ByteProfile.from_goodbytes("414243")
+        self.assertTrue(profile.get_operand_table() is
+                        EncoderOperandTable.get_table(['41', '42', '43']))
+
+    def test_encoder(self):
+        goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+        operands = []
+        for profile in (goodbytes, ByteProfile.from_goodbytes(goodbytes)):
+            encoder = SubtractionEncoder("31c05068", profile,
+                                         output_format=None)
+            encoder.process()
+            operands.append(encoder.get_operands())
+        self.assertEqual(operands[0], operands[1])
+
+class EncoderStreamParserTest(unittest.TestCase):
+
+    def test_matches_parse_words(self):
+        words = EncoderInputParser("12345678AABBCCDDEE").parse_words()
+        # A small chunk size splits the bytes and the whitespace over chunks
+        parser = EncoderStreamParser(io.StringIO(u"1 2345678A\nABBCCDD EE"),
+                                     chunk_size=5)
+        self.assertEqual([word.get_base_ten()
+                          for word in parser.iter_words_reverse()],
+                         [word.get_base_ten() for word in words[::-1]])
+
+    def test_process_stream(self):
+        payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80"
+        goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            for output_format in ('asm', 'python', 'raw'):
+                SubtractionEncoder(payload, goodbytes, None, output_format,
+                                   'var', filename).process()
+                with open(filename) as output:
+                    expected = output.read()
+                SubtractionEncoder(None, goodbytes, None, output_format,
+                                   'var', filename).process_stream(
+                                       io.StringIO(payload), chunk_size=8)
+                with open(filename) as output:
+                    self.assertEqual(output.read(), expected)
+        finally:
+            os.remove(filename)
+
+    # A streamed binary stub is written as it goes, not held until the end
+    def test_process_stream_bin(self):
+        payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd8000" * 800
+        goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+
+        class RecordingFile(io.BytesIO):
+            def __init__(self):
+                io.BytesIO.__init__(self)
+                self.sizes = []
+
+            def write(self, data):
+                self.sizes.append(len(data))
+                return io.BytesIO.write(self, data)
+        out = RecordingFile()
+        stdout = sys.stdout
+        sys.stdout = out
+        try:
+            SubtractionEncoder(None, goodbytes, None, 'bin').process_stream(
+                io.StringIO(payload))
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(out.getvalue(),
+                         encode(payload, goodbytes).get_bytes())
+        self.assertGreater(len(out.sizes), 1)
+        self.assertLess(max(out.sizes), 2 * EncoderBinEmitter.buffer_size)
+
+class EncoderBinaryParserTest(unittest.TestCase):
+
+    payload = "12345678AABBCCDDEE"
+
+    def test_matches_parse_words(self):
+        words = EncoderInputParser(self.payload).parse_words()
+        parser = EncoderBinaryParser(binascii.unhexlify(self.payload))
+        self.assertEqual([word.get_base_ten() for word in parser.parse_words()],
+                         [word.get_base_ten() for word in words])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_matches_parse_word_array(self):
+        word_array = EncoderInputParser(self.payload).parse_word_array()
+        parser = EncoderBinaryParser(binascii.unhexlify(self.payload))
+        self.assertEqual(parser.parse_word_array().tolist(),
+                         word_array.tolist())
+
+    def test_payload_parser(self):
+        data = binascii.unhexlify(self.payload)
+        self.assertIsInstance(get_payload_parser(data), EncoderBinaryParser)
+        self.assertIsInstance(get_payload_parser(self.payload),
+                              EncoderInputParser)
+        padded = binascii.unhexlify("12345678AABBCCDDEE909090")
+        self.assertEqual(get_payload_parser(memoryview(data)).get_data(),
+                         padded)
+        self.assertEqual(get_payload_parser(self.payload).get_data(), padded)
+
+    def test_input_file(self):
+        payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80"
+        goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+        directory = tempfile.mkdtemp()
+        input_filename = os.path.join(directory, 'payload')
+        filename = os.path.join(directory, 'out')
+        try:
+            with open(input_filename, 'wb') as input_file:
+                input_file.write(binascii.unhexlify(payload))
+            encoder = SubtractionEncoder(payload, goodbytes, None, 'raw',
+                                         'var', filename + '.raw')
+            encoder.process()
+            SubtractionEncoder(None, goodbytes, None, ['raw', 'bin'], 'var',
+                               filename, input_file=input_filename).process()
+            with open(filename + '.raw') as output:
+                raw = output.read()
+            with open(filename + '.bin', 'rb') as output:
+                data = output.read()
+            self.assertEqual(raw.strip().lower(),
+                             binascii.hexlify(data).decode('ascii'))
+            self.assertEqual(bytearray(data),
+                             bytearray(binascii.unhexlify(
+                                 ''.join(encoder.get_output_bytes()))))
+        finally:
+            shutil.rmtree(directory)
+
+class SubtractionEncoderParallelTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd8000" * 4
+
+    def get_operands(self, jobs):
+        encoder = SubtractionEncoder(self.payload, self.goodbytes,
+                                     output_format=None, jobs=jobs)
+        encoder.parallel_chunk_size = 5
+        encoder.process()
+        return encoder.get_operands()
+
+    def test_matches_serial(self):
+        self.assertEqual(self.get_operands(3), self.get_operands(1))
+
+    # The words are only read a few chunks ahead of the operands taken out,
+    # so a stream isn't read in all at once
+    def test_reads_ahead_a_few_chunks(self):
+        words = EncoderInputParser(self.payload * 10).parse_words()
+        read = []
+
+        def iter_words():
+            for word in words:
+                read.append(word)
+                yield word
+        encoder = SubtractionEncoder(None, self.goodbytes, output_format=None,
+                                     jobs=2)
+        encoder.load_goodbytes()
+        encoder.engine_name = 'table'
+        operands = encoder.iter_parallel_operands(iter_words(), 2)
+        next(operands)
+        self.assertLessEqual(len(read), (2 * 2 + 1) * 2 + 1)
+        self.assertEqual(len(list(operands)) + 1, len(words))
+
+    def test_unable_to_find_operands(self):
+        encoder = SubtractionEncoder("c3c3c3c3", "4142", output_format=None,
+                                     jobs=2)
+        encoder.process()
+        with self.assertRaises(UnableToFindOperandsError):
+            encoder.get_operands()
+
+class EncodedProgramTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80"
+
+    def test_from_operands(self):
+        program = EncodedProgram.from_operands([(1, 2, 3), (4, 5, 6)])
+        self.assertEqual(len(program), 2 + 6 + 6)
+        self.assertEqual([instruction.operand for instruction in program
+                          if instruction.name == 'sub_eax'],
+                         [1, 2, 3, 4, 5, 6])
+
+    def test_multiple_formats(self):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'out')
+        try:
+            expected = {}
+            for output_format in ('asm', 'python', 'raw'):
+                SubtractionEncoder(self.payload, self.goodbytes, None,
+                                   output_format, 'var', filename).process()
+                with open(filename) as output:
+                    expected[output_format] = output.read()
+
+            encoder = SubtractionEncoder(self.payload, self.goodbytes, None,
+                                         ['asm', 'python', 'raw'], 'var',
+                                         filename)
+            encoder.process()
+            for output_format, extension in (('asm', 'asm'), ('python', 'py'),
+                                             ('raw', 'raw')):
+                with open(filename + '.' + extension) as output:
+                    self.assertEqual(output.read(), expected[output_format])
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+class EncoderEmulatorTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80" * 3
+
+    def test_pushes_the_payload(self):
+        expected = binascii.unhexlify(self.payload + "909090")
+        for kwargs in ({}, {'chain': True}, {'dedup': True},
+                       {'optimize': 'size'}):
+            stub = encode(self.payload, self.goodbytes, **kwargs).get_bytes()
+            self.assertEqual(EncoderEmulator().run(stub), expected)
+
+    def test_prologue(self):
+        emulator = EncoderEmulator(0x1000)
+        # PUSH ESP; POP EAX leaves ESP where it was with EAX holding it
+        self.assertEqual(emulator.run(b'\x54\x58'), b'')
+        self.assertEqual((emulator.eax, emulator.esp), (0x1000, 0x1000))
+
+    def test_verify(self):
+        stub = bytearray(encode(self.payload, self.goodbytes).get_bytes())
+        payload = binascii.unhexlify(self.payload + "909090")
+        EncoderEmulator.verify(bytes(stub), payload)
+        # The last SUB of the first word pushed, the last word of the payload
+        stub[19] ^= 1
+        with self.assertRaises(EncoderEmulatorError) as context:
+            EncoderEmulator.verify(bytes(stub), payload)
+        self.assertIn('Word 17', str(context.exception))
+        for bad in (b'\xcc', b'\x2d\x00', b'\x58'):
+            with self.assertRaises(EncoderEmulatorError):
+                EncoderEmulator().run(bad)
+
+    def test_encoder_verify(self):
+        for kwargs in ({}, {'chain': True}, {'jobs': 2}):
+            encoder = SubtractionEncoder(self.payload, self.goodbytes,
+                                         output_format=None, **kwargs)
+            encoder.process()
+            encoder.verify()
+        # The words that failed are pushed as zero
+        encoder = SubtractionEncoder("3d3c3c3cc3c3c3c3", "4142",
+                                     output_format=None, collect_errors=True)
+        encoder.process()
+        encoder.verify()
+
+
+class SubtractionEncoderChainTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80" * 3
+
+    # Follows EAX through the program and returns what gets pushed
+    def run_program(self, program):
+        eax = None
+        pushed = []
+        for instruction in program:
+            if instruction.name == 'zero_out_eax_1':
+                eax = 0x554E4D4A
+            elif instruction.name == 'zero_out_eax_2':
+                eax &= 0x2A313235
+            elif instruction.name == 'sub_eax':
+                eax = (eax - instruction.operand) & 0xFFFFFFFF
+            elif instruction.name == 'push_eax':
+                pushed.append(eax)
+        return pushed
+
+    def get_program(self, **kwargs):
+        encoder = SubtractionEncoder(self.payload, self.goodbytes,
+                                     output_format=None, chain=True, **kwargs)
+        encoder.process()
+        return encoder.get_program()
+
+    def test_pushes_the_payload(self):
+        program = self.get_program()
+        words = EncoderInputParser(self.payload).parse_words()[::-1]
+        self.assertEqual(self.run_program(program),
+                         [word.get_reverse() for word in words])
+        # Only the first word needs EAX zeroed with these good bytes
+        self.assertEqual(len([instruction for instruction in program
+                              if instruction.name == 'zero_out_eax_1']), 1)
+
+    def test_falls_back_to_zero_out(self):
+        # Both words can be encoded from zero using 0x41 and 0x42, but the
+        # difference between them, 0x03030303, can't
+        encoder = SubtractionEncoder("3d3c3c3c3a393939", "4142",
+                                     output_format=None, chain=True)
+        encoder.process()
+        self.assertEqual([zero_out for operands, zero_out
+                          in encoder.get_chained_operands()], [True, True])
+
+    def test_stream(self):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'out')
+        try:
+            SubtractionEncoder(self.payload, self.goodbytes, None, 'raw',
+                               'var', filename, chain=True).process()
+            with open(filename) as output:
+                expected = output.read()
+            SubtractionEncoder(None, self.goodbytes, None, 'raw', 'var',
+                               filename, chain=True).process_stream(
+                                   io.StringIO(self.payload), chunk_size=8)
+            with open(filename) as output:
+                self.assertEqual(output.read(), expected)
+        finally:
+            os.remove(filename)
+            os.rmdir(directory)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch(self):
+        self.assertEqual(list(self.get_program(batch=True)),
+                         list(self.get_program()))
+
+class EncoderOperandSearchTest(unittest.TestCase):
+
+    def test_solve_smallest(self):
+        search = EncoderOperandSearch(['01', '02', '04', '7f', '80'])
+        self.assertEqual(search.solve_smallest(0x7f800401), (0x7f800401,))
+        operands = search.solve_smallest(0x00000000)
+        self.assertEqual(len(operands), 2)
+        self.assertEqual(sum(operands) & 0xFFFFFFFF, 0)
+
+    def test_distinct_operands(self):
+        # 0x07 can't be made as x + x + y from these, but 1 + 2 + 4 works
+        target = EncoderDoubleWordTarget(0x07070707)
+        self.assertEqual(EncoderOperandTable(['01', '02', '04']).solve(
+            0x07070707), None)
+        target.search(['01', '02', '04'])
+        target.verify_result()
+        self.assertEqual(len(target.get_operands()), 3)
+
+    def test_count(self):
+        search = EncoderOperandSearch(['01', '02', '04'])
+        self.assertEqual(search.solve(0x07070707, 2), None)
+        operands = search.solve(0x07070707, 4)
+        self.assertEqual(len(operands), 4)
+        self.assertEqual(sum(operands) & 0xFFFFFFFF, 0x07070707)
+
+    def test_optimize(self):
+        goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+        payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80"
+        lengths = {}
+        for optimize in ('speed', 'size'):
+            encoder = SubtractionEncoder(payload, goodbytes,
+                                         output_format=None,
+                                         optimize=optimize)
+            encoder.process()
+            lengths[optimize] = len(encoder.get_output_bytes())
+        self.assertTrue(lengths['size'] < lengths['speed'])
+
+    def test_speed_falls_back_to_search(self):
+        encoder = SubtractionEncoder("f9f8f8f8", "010204", output_format=None)
+        encoder.process()
+        operands = encoder.get_operands()[0]
+        self.assertEqual(sum(operands) & 0xFFFFFFFF, 0x07070707)
+
+class EncoderOperandTableTest(unittest.TestCase):
+
+    goodbytes = ['41', '42', '61', '31', '7a']
+
+    def test_matches_brute_force(self):
+        table = EncoderOperandTable(self.goodbytes)
+        target = EncoderDoubleWordTarget(0)
+        for target_byte in range(0, 256):
+            for carry_in in range(0, 3):
+                for carry_out in range(0, 3):
+                    expected = None
+                    for x in self.goodbytes:
+                        for y in self.goodbytes:
+                            if expected is None and target.check(
+                                    x, y, "{:02x}".format(
+                                        target_byte + 256 * carry_out),
+                                    carry_in):
+                                expected = (int(x, 16), int(y, 16))
+                    self.assertEqual(table.lookup(target_byte, carry_in,
+                                                  carry_out), expected)
+
+    def test_solve(self):
+        table = EncoderOperandTable(self.goodbytes)
+        self.assertEqual(table.solve(0), None)
+        operands = table.solve(0x41414141 * 3)
+        self.assertEqual(sum(operands) & 0xFFFFFFFF, 0x41414141 * 3)
+
+    def test_table_is_shared(self):
+        self.assertTrue(EncoderOperandTable.get_table(self.goodbytes) is
+                        EncoderOperandTable.get_table(list(self.goodbytes)))
+
+    def test_calculate(self):
+        alphanumeric = ["{:02x}".format(i) for i in range(0, 256)
+                        if chr(i) in string.ascii_letters + string.digits]
+        # 0x22334456 == 0x5461656e + 0x5461656e + 0x7970797a
+        target = EncoderDoubleWord('0xAABBCCDD').get_subtraction_target()
+        target.calculate(alphanumeric)
+        target.verify_result()
+        self.assertEqual(target.get_operand_one().get_base_ten(), 0x5461656e)
+        self.assertEqual(target.get_operand_two().get_base_ten(), 0x5461656e)
+        self.assertEqual(target.get_operand_three().get_base_ten(), 0x7970797a)
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class EncoderBatchSolverTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd8000"
+
+    def get_operands(self, batch):
+        encoder = SubtractionEncoder(self.payload, self.goodbytes,
+                                     output_format=None, batch=batch)
+        encoder.process()
+        return encoder.get_operands()
+
+    def test_matches_calculate(self):
+        self.assertEqual(self.get_operands(True), self.get_operands(False))
+
+    def test_get_targets(self):
+        solver = EncoderBatchSolver.get_solver(['41'])
+        targets = solver.get_targets([0x01020304, 0xAABBCCDD, 0])
+        self.assertEqual(targets.tolist(), [0xFBFCFDFF, 0x22334456, 0])
+
+    def test_unable_to_find_operands(self):
+        solver = EncoderBatchSolver.get_solver(['41', '42'])
+        with self.assertRaises(UnableToFindOperandsError):
+            solver.solve([0xC3C3C3C3, 0x00000000])
+
+class EncoderEngineTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80" * 3
+
+    def test_reference_matches_table(self):
+        for profile in (ByteProfile.from_goodbytes(self.goodbytes),
+                        ByteProfile.from_goodbytes("4142"),
+                        ByteProfile.from_goodbytes("7e7d20"),
+                        ByteProfile.from_badbytes("000a0d")):
+            reference = EncoderReferenceEngine(profile)
+            table = EncoderTableEngine(profile)
+            for value in range(0, 0x100000000, 0x01010101 * 5 + 4321):
+                self.assertEqual(reference.solve(value), table.solve(value))
+
+    def test_engines_match(self):
+        expected = encode(self.payload, self.goodbytes).get_bytes()
+        for engine in sorted(SubtractionEncoder.engines):
+            if not SubtractionEncoder.engines[engine].is_available():
+                continue
+            self.assertEqual(encode(self.payload, self.goodbytes,
+                                    engine=engine,
+                                    cross_check='reference').get_bytes(),
+                             expected)
+            encode(self.payload, self.goodbytes, chain=True, engine=engine,
+                   cross_check='table')
+
+    def test_cross_check_mismatch(self):
+        class BrokenEngine(EncoderTableEngine):
+            name = 'broken'
+
+            def solve(self, value):
+                operands = EncoderTableEngine.solve(self, value)
+                if value & 0xFF == 0xcf:
+                    return (operands[0], operands[1] + 1, operands[2] - 1)
+                return operands
+
+        engines = dict(SubtractionEncoder.engines, broken=BrokenEngine)
+        encoder = SubtractionEncoder(self.payload, self.goodbytes,
+                                     output_format=None, engine='broken',
+                                     cross_check='reference')
+        encoder.engines = engines
+        encoder.process()
+        with self.assertRaises(EncoderEngineMismatchError) as context:
+            encoder.get_program()
+        self.assertIn('0x97af3fcf', str(context.exception))
+
+    def test_auto(self):
+        encoder = SubtractionEncoder(self.payload, self.goodbytes,
+                                     output_format=None)
+        encoder.load_goodbytes()
+        self.assertEqual(encoder.choose_engine(10), 'table')
+        self.assertEqual(encoder.choose_engine(None), 'table')
+        large = encoder.auto_batch_words
+        self.assertEqual(encoder.choose_engine(large),
+                         'batch' if numpy is not None else 'table')
+        encoder.optimize = 'size'
+        self.assertEqual(encoder.choose_engine(large), 'table')
+        encoder = SubtractionEncoder(self.payload, "4142", output_format=None)
+        encoder.load_goodbytes()
+        self.assertEqual(encoder.choose_engine(large), 'table')
+
+
+class EncoderFeasibilityAnalyzerTest(unittest.TestCase):
+
+    def test_matches_search(self):
+        for goodbytes in (['41', '42'], ['01', '02', '04'],
+                          ["{:02x}".format(i) for i in range(0x30, 0x3a)]):
+            analyzer = EncoderFeasibilityAnalyzer(goodbytes)
+            search = EncoderOperandSearch(goodbytes)
+            for value in range(0, 0x100000000, 0x01010101 * 7 + 12345):
+                self.assertEqual(analyzer.is_feasible_value(value),
+                                 search.solve_smallest(value) is not None)
+
+    def test_is_reachable(self):
+        analyzer = EncoderFeasibilityAnalyzer(['41', '42'])
+        # 0x41 + 0x41 + 0x42 == 0xc4
+        self.assertTrue(analyzer.is_reachable(0xc4, 0, 0))
+        self.assertTrue(analyzer.is_reachable(0xc5, 1, 0))
+        self.assertFalse(analyzer.is_reachable(0xc4, 0, 1))
+        self.assertFalse(analyzer.is_reachable(0x00, 0, 0))
+
+    def test_scan(self):
+        # Both words can be encoded from zero using 0x41 and 0x42, the word
+        # in between can't
+        words = EncoderInputParser("3d3c3c3c" + "c3c3c3c3" +
+                                   "3a393939").parse_words()
+        infeasible = EncoderFeasibilityAnalyzer(['41', '42']).scan(words)
+        self.assertEqual([word.index for word in infeasible], [1])
+        self.assertEqual(infeasible[0].word, 0xc3c3c3c3)
+        self.assertEqual(infeasible[0].target, 0x3c3c3c3d)
+        self.assertEqual(infeasible[0].column, 0)
+        self.assertEqual(infeasible[0].target_byte, 0x3d)
+        self.assertEqual(infeasible[0].carries, (0,))
+
+    def test_analyze_matches_encoding(self):
+        goodbytes = ''.join("{:02x}".format(ord(c)) for c in
+                            string.ascii_uppercase + string.digits)
+        payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80" * 4
+        encoder = SubtractionEncoder(payload, goodbytes, output_format=None)
+        infeasible = encoder.analyze()
+        indexes = [word.index for word in infeasible]
+        self.assertTrue(indexes)
+        for i, word in enumerate(encoder.words):
+            target = word.get_subtraction_target()
+            if i in indexes:
+                with self.assertRaises(UnableToFindOperandsError):
+                    encoder.calculate_target(target)
+            else:
+                encoder.calculate_target(target)
+
+        # Chaining can only help
+        encoder = SubtractionEncoder(payload, goodbytes, output_format=None,
+                                     chain=True)
+        self.assertTrue(set(word.index for word in encoder.analyze()) <=
+                        set(indexes))
+
+    def test_scan_matches_keep_going(self):
+        # A few good bytes, so that plenty of words fail, and repeated words
+        # for dedup
+        goodbytes = ['01', '02', '04', '41']
+        words = ["11111111", "3c3c3c3c", "c3c3c3c3", "3d3c3c3c", "05070301",
+                 "80402010", "0f0f0f0f"]
+        payload = ''.join(words[(i * 5) % 7 if i % 3 else (i * 3) % 7]
+                          for i in range(40))
+        analyzer = EncoderFeasibilityAnalyzer(goodbytes)
+        parsed = EncoderInputParser(payload).parse_words()
+        for chain in (False, True):
+            for dedup in (False, True):
+                failures = encode(payload, ''.join(goodbytes), chain=chain,
+                                  dedup=dedup, collect_errors=True).failures
+                self.assertTrue(failures)
+                self.assertEqual(
+                    [word.index for word in analyzer.scan(parsed, chain,
+                                                          dedup)],
+                    [failure.index for failure in failures])
+
+    # An input that big, with that many good bytes, would get the batch
+    # engine, which doesn't parse the words the analyzer checks
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_analyze_large_input_file(self):
+        # Only even bytes, so half of the words can't be encoded
+        goodbytes = ''.join("{:02x}".format(i) for i in range(2, 0x62, 2))
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'payload.bin')
+            with open(path, 'wb') as payload_file:
+                payload_file.write(binascii.unhexlify(
+                    "31c050682f2f7368682f62696e89e3505389e1b00bcd8000" *
+                    (SubtractionEncoder.auto_batch_words // 5)))
+            counts = []
+            for engine in ('table', 'auto', 'batch'):
+                encoder = SubtractionEncoder(None, goodbytes,
+                                             output_format=None,
+                                             input_file=path, engine=engine)
+                counts.append((len(encoder.analyze()), len(encoder.words)))
+        finally:
+            shutil.rmtree(directory)
+        self.assertGreater(counts[0][0], 0)
+        self.assertEqual(counts[0][1], SubtractionEncoder.auto_batch_words //
+                         5 * 6)
+        self.assertEqual(counts, [counts[0]] * 3)
+
+
+class EncoderOperandMemoTest(unittest.TestCase):
+
+    def test_least_recently_used(self):
+        memo = EncoderOperandMemo(2)
+        memo.put(1, (1,))
+        memo.put(2, (2,))
+        self.assertEqual(memo.get(1), (1,))
+        memo.put(3, (3,))
+        self.assertNotIn(2, memo)
+        self.assertEqual(memo.get(1), (1,))
+        self.assertEqual(memo.get(2, False), False)
+        self.assertEqual((memo.hits, memo.misses), (2, 1))
+
+    def test_shared_between_encoders(self):
+        goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+        memo = EncoderOperandMemo()
+        outputs = []
+        for i in range(0, 2):
+            encoder = SubtractionEncoder("90909090" * 4 + "31c05068", goodbytes,
+                                         output_format=None, memo=memo)
+            encoder.process()
+            outputs.append(encoder.get_output_bytes())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(len(memo), 2)
+        self.assertEqual(memo.misses, 2)
+
+
+class SubtractionEncoderDedupTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c05068" + "90909090" * 4 + "00000000" * 3 + "90909090"
+
+    def get_program(self, **kwargs):
+        encoder = SubtractionEncoder(self.payload, self.goodbytes,
+                                     output_format=None, dedup=True, **kwargs)
+        encoder.process()
+        return encoder.get_program()
+
+    def test_pushes_the_payload(self):
+        words = EncoderInputParser(self.payload).parse_words()[::-1]
+        expected = [word.get_reverse() for word in words]
+        run_program = SubtractionEncoderChainTest.run_program
+        for kwargs in ({}, {'chain': True}, {'jobs': 2}):
+            self.assertEqual(run_program(self, self.get_program(**kwargs)),
+                             expected)
+
+    def test_repeated_words_are_pushed_again(self):
+        # Five of the nine words are the same as the word before them
+        self.assertEqual(len(self.get_program()), 2 + (4 * 6) + 5)
+
+    def test_jobs_across_chunks(self):
+        encoder = SubtractionEncoder(self.payload, self.goodbytes,
+                                     output_format=None, dedup=True, jobs=2)
+        encoder.parallel_chunk_size = 2
+        encoder.process()
+        self.assertEqual(encoder.get_program().instructions,
+                         self.get_program().instructions)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch(self):
+        for chain in (False, True):
+            self.assertEqual(self.get_program(chain=chain).instructions,
+                             self.get_program(chain=chain,
+                                              batch=True).instructions)
+
+
+class SubtractionEncoderKeepGoingTest(unittest.TestCase):
+
+    # The first and third words can be encoded using 0x41 and 0x42, the
+    # second and fourth can't
+    payload = "3d3c3c3c" + "c3c3c3c3" + "3a393939" + "c4c3c3c3"
+
+    def get_encoder(self, **kwargs):
+        encoder = SubtractionEncoder(self.payload, "4142", output_format=None,
+                                     collect_errors=True, **kwargs)
+        encoder.process()
+        encoder.get_program()
+        return encoder
+
+    def test_failures(self):
+        run_program = SubtractionEncoderChainTest.run_program
+        for kwargs in ({}, {'chain': True}, {'jobs': 2}):
+            encoder = self.get_encoder(**kwargs)
+            self.assertEqual([failure.index for failure in encoder.failures],
+                             [1, 3])
+            self.assertEqual(encoder.failures[0].word, 0xc3c3c3c3)
+            self.assertEqual(encoder.failures[0].target, 0x3c3c3c3d)
+            # A zero is pushed in place of each failed word
+            self.assertEqual(run_program(self, encoder.get_program()),
+                             [0, 0x3939393a, 0, 0x3c3c3c3d])
+
+    def test_dedup_after_failure(self):
+        # EAX holds zero after the first word fails, so the same word again
+        # has to fail too rather than be pushed again
+        run_program = SubtractionEncoderChainTest.run_program
+        kwargs_list = [{}, {'jobs': 2}]
+        if numpy is not None:
+            kwargs_list.append({'batch': True})
+        for kwargs in kwargs_list:
+            encoder = SubtractionEncoder("c3c3c3c3" * 3 + "3d3c3c3c", "4142",
+                                         output_format=None, dedup=True,
+                                         collect_errors=True, **kwargs)
+            # One word per worker, so the repeat crosses into another chunk
+            encoder.parallel_chunk_size = 1
+            encoder.process()
+            program = encoder.get_program()
+            self.assertEqual([failure.index for failure in encoder.failures],
+                             [0, 1, 2])
+            self.assertEqual(run_program(self, program),
+                             [0x3c3c3c3d, 0, 0, 0])
+
+    def test_stream_dedup_after_failure(self):
+        # The same across chunks when the words are read from a stream
+        payload = "c3c3c3c3" * 3 + "3d3c3c3c"
+        encoder = SubtractionEncoder(None, "4142", None, 'raw', 'var',
+                                     os.devnull, dedup=True, jobs=2,
+                                     collect_errors=True)
+        encoder.parallel_chunk_size = 1
+        encoder.process_stream(io.StringIO(payload), chunk_size=8)
+        self.assertEqual([failure.index for failure in encoder.failures],
+                         [0, 1, 2])
+
+    def test_retry(self):
+        run_program = SubtractionEncoderChainTest.run_program
+        words = EncoderInputParser(self.payload).parse_words()[::-1]
+        goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+        for kwargs in ({}, {'chain': True}):
+            encoder = self.get_encoder(**kwargs)
+            self.assertEqual(encoder.retry(goodbytes), [])
+            self.assertEqual(run_program(self, encoder.get_program()),
+                             [word.get_reverse() for word in words])
+
+    def test_raises_without_collect_errors(self):
+        with self.assertRaises(UnableToFindOperandsError) as context:
+            encode(self.payload, "4142")
+        self.assertIn('unable to find', str(context.exception))
+        result = encode(self.payload, "4142", collect_errors=True)
+        self.assertEqual(len(result.failures), 2)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_batch(self):
+        for chain in (False, True):
+            self.assertEqual(
+                self.get_encoder(chain=chain).get_program().instructions,
+                self.get_encoder(chain=chain, batch=True).get_program(
+                ).instructions)
+            self.assertEqual(self.get_encoder(chain=chain).failures,
+                             self.get_encoder(chain=chain,
+                                              batch=True).failures)
+
+
+class EncodeTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80"
+
+    def test_matches_process(self):
+        encoder = SubtractionEncoder(self.payload, self.goodbytes,
+                                     output_format=None)
+        encoder.process()
+        expected = binascii.unhexlify(''.join(encoder.get_output_bytes()))
+        self.assertEqual(encode(self.payload, self.goodbytes).get_bytes(),
+                         expected)
+        result = encode(binascii.unhexlify(self.payload),
+                        ByteProfile.from_goodbytes(self.goodbytes))
+        self.assertEqual(result.get_bytes(), expected)
+        self.assertEqual(result.render('bin'), expected)
+
+    def test_render(self):
+        result = encode(self.payload, self.goodbytes, variable_name='buf')
+        python = result.render('python')
+        self.assertTrue(python.startswith('buf =  "\\x54\\x58'))
+        self.assertTrue(result.render('asm').startswith('[SECTION .text]'))
+        self.assertEqual(result.render('raw').strip().lower(),
+                         binascii.hexlify(result.get_bytes()).decode('ascii'))
+
+    def test_threads(self):
+        profiles = [self.goodbytes, ByteProfile.from_badbytes('000a0d'),
+                    ''.join("{:02x}".format(i) for i in range(0x7e, 0x1f, -1))]
+        payloads = [self.payload * (i + 1) for i in range(0, 8)]
+        jobs = [(payload, profile, chain) for payload in payloads
+                for profile in profiles for chain in (False, True)]
+        expected = [encode(payload, profile, chain=chain).get_bytes()
+                    for payload, profile, chain in jobs]
+        results = [None] * len(jobs)
+
+        def worker(offset):
+            for i in range(offset, len(jobs), 8):
+                payload, profile, chain = jobs[i]
+                results[i] = encode(payload, profile, chain=chain).get_bytes()
+
+        threads = [threading.Thread(target=worker, args=(offset,))
+                   for offset in range(0, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, expected)
+
+
+class EncodeProfilesTest(unittest.TestCase):
+
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80" * 2
+    profiles = [''.join("{:02x}".format(i) for i in range(0x20, 0x7f)),
+                ByteProfile.from_badbytes('000a0d'),
+                ''.join("{:02x}".format(i) for i in range(0x7e, 0x1f, -1))]
+
+    def test_matches_encode(self):
+        for kwargs in ({}, {'chain': True}, {'dedup': True},
+                       {'optimize': 'size'}):
+            results = encode_profiles(self.payload, self.profiles, **kwargs)
+            self.assertEqual([result.get_bytes() for result in results],
+                             [encode(self.payload, profile,
+                                     **kwargs).get_bytes()
+                              for profile in self.profiles])
+
+    # With the batch engine the targets are worked out once, not once per
+    # profile
+    @unittest.skipIf(numpy is None, 'NumPy is not installed')
+    def test_batch_shares_targets(self):
+        get_targets = EncoderBatchSolver.get_targets
+        calls = []
+
+        def count_targets(words):
+            calls.append(len(words))
+            return get_targets(words)
+        for chain in (False, True):
+            del calls[:]
+            EncoderBatchSolver.get_targets = staticmethod(count_targets)
+            try:
+                results = encode_profiles(self.payload, self.profiles,
+                                          chain=chain, batch=True)
+            finally:
+                EncoderBatchSolver.get_targets = staticmethod(get_targets)
+            self.assertEqual(calls, [12])
+            self.assertEqual([result.get_bytes() for result in results],
+                             [encode(self.payload, profile,
+                                     chain=chain).get_bytes()
+                              for profile in self.profiles])
+
+    def test_failures(self):
+        results = encode_profiles("3d3c3c3cc3c3c3c3",
+                                  ["4142", self.profiles[0]],
+                                  collect_errors=True)
+        self.assertEqual([len(result.failures) for result in results], [1, 0])
+
+    def test_process_profiles(self):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'out')
+        try:
+            encoder = SubtractionEncoder(self.payload, None, None, 'python',
+                                         'buf', filename)
+            encoder.process_profiles(self.profiles)
+            for index, profile in enumerate(self.profiles):
+                with open('%s.%d' % (filename, index)) as output:
+                    self.assertEqual(output.read(), encode(
+                        self.payload, profile,
+                        variable_name='buf_%d' % index).render('python'))
+        finally:
+            shutil.rmtree(directory)
+
+
+class EstimateTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c05068" + "90909090" * 3 + \
+        "2f2f7368682f62696e89e3505389e1b00bcd80"
+
+    def test_matches_encode(self):
+        for goodbytes, kwargs in ((self.goodbytes, {}),
+                                  (self.goodbytes, {'chain': True}),
+                                  (self.goodbytes, {'dedup': True}),
+                                  (self.goodbytes, {'optimize': 'size',
+                                                    'chain': True,
+                                                    'dedup': True}),
+                                  ("4142", {'collect_errors': True})):
+            result = estimate(self.payload, goodbytes, **kwargs)
+            encoded = encode(self.payload, goodbytes, **kwargs)
+            self.assertEqual(result.size, len(encoded.get_bytes()))
+            self.assertEqual(result.instructions, len(encoded.program))
+            self.assertEqual(result.words, 9)
+            sub_counts = []
+            subs = 0
+            for instruction in encoded.program:
+                if instruction.name == 'sub_eax':
+                    subs += 1
+                elif instruction.name == 'push_eax':
+                    sub_counts.append(subs)
+                    subs = 0
+            self.assertEqual(result.sub_counts, sub_counts[::-1])
+
+    def test_raises(self):
+        with self.assertRaises(UnableToFindOperandsError):
+            estimate(self.payload, "4142")
+
+
+class EncoderIncrementalTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80" * 4
+
+    def test_matches_encode(self):
+        edits = [(8, "7f000001"), (0, "90"), (90, "cc"), (40, "682f2f73")]
+        for kwargs in ({}, {'chain': True}, {'dedup': True},
+                       {'chain': True, 'optimize': 'size'}):
+            incremental = EncoderIncremental(self.goodbytes, **kwargs)
+            payload = self.payload
+            for offset, patch in edits:
+                payload = payload[:offset] + patch + \
+                    payload[offset + len(patch):]
+                result = incremental.encode(payload)
+                expected = encode(payload, self.goodbytes, **kwargs)
+                self.assertEqual(result.get_bytes(), expected.get_bytes())
+                self.assertEqual(result.render('python'),
+                                 expected.render('python'))
+
+    def test_only_changed_words(self):
+        incremental = EncoderIncremental(self.goodbytes)
+        incremental.encode(self.payload)
+        self.assertEqual(incremental.changed, 23)
+        incremental.encode(self.payload)
+        self.assertEqual(incremental.changed, 0)
+        # Two bytes across the boundary between two words
+        incremental.encode(self.payload[:6] + "ffff" + self.payload[10:])
+        self.assertEqual(incremental.changed, 2)
+        # A different length is done from scratch
+        incremental.encode(self.payload + "90")
+        self.assertEqual(incremental.changed, 24)
+
+    def test_chain_redoes_the_next_word(self):
+        incremental = EncoderIncremental(self.goodbytes, chain=True)
+        incremental.encode(self.payload)
+        incremental.encode(self.payload[:-8] + "41414141")
+        self.assertEqual(incremental.changed, 2)
+
+
+class EncoderManifestTest(unittest.TestCase):
+
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80"
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'payload.bin'), 'wb') as out:
+            out.write(binascii.unhexlify(self.payload))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def read(self, filename):
+        with open(os.path.join(self.directory, filename), 'rb') as result:
+            return result.read()
+
+    def test_jobs_match_encode(self):
+        jobs = [{'input_file': 'payload.bin', 'goodbytes': self.goodbytes,
+                 'format': 'bin', 'filename': 'one.bin'},
+                {'input': self.payload, 'goodbytes': self.goodbytes,
+                 'format': ['bin'], 'chain': True, 'filename': 'two.bin'}]
+        manifest = EncoderManifest(directory=self.directory)
+        for processes in (1, 2):
+            summaries = manifest.run(jobs, processes)
+            self.assertEqual([summary['status'] for summary in summaries],
+                             ['ok', 'ok'])
+            self.assertEqual(self.read('one.bin'),
+                             encode(self.payload, self.goodbytes).get_bytes())
+            self.assertEqual(self.read('two.bin'), encode(
+                self.payload, self.goodbytes, chain=True).get_bytes())
+        # Both jobs have the same good bytes, so share one profile
+        self.assertEqual(len(manifest.profiles), 1)
+
+    def test_failed_job_does_not_stop_the_rest(self):
+        jobs = [{'input': self.payload, 'goodbytes': '4142',
+                 'filename': 'one.py'},
+                {'input': self.payload, 'filename': 'two.py'},
+                {'input': self.payload, 'goodbytes': self.goodbytes,
+                 'filename': 'three.py'}]
+        summaries = EncoderManifest(directory=self.directory).run(jobs)
+        self.assertEqual([summary['status'] for summary in summaries],
+                         ['failed', 'failed', 'ok'])
+        self.assertIn('UnableToFindOperandsError', summaries[0]['error'])
+        self.assertIn('goodbytes', summaries[1]['error'])
+        self.assertEqual(summaries[2]['words'], 6)
+
+    def test_job_bytes_replace_defaults(self):
+        manifest = EncoderManifest({'goodbytes': '4142'},
+                                   directory=self.directory)
+        jobs = [{'input': self.payload, 'badbytes': '000a0d',
+                 'filename': 'one.py'},
+                {'input': self.payload, 'filename': 'two.py'}]
+        self.assertNotIn('goodbytes', manifest.get_options(jobs[0]))
+        self.assertEqual(manifest.get_options(jobs[1])['goodbytes'], '4142')
+        summaries = manifest.run(jobs)
+        self.assertEqual([summary['status'] for summary in summaries],
+                         ['ok', 'failed'])
+
+    def test_load_csv(self):
+        path = os.path.join(self.directory, 'manifest.csv')
+        with open(path, 'w') as manifest_file:
+            manifest_file.write('input_file,badbytes,format,filename,chain\n'
+                                'payload.bin,000a0d,raw asm,out,yes\n'
+                                'payload.bin,00,python,out.py,\n')
+        jobs = EncoderManifest.load(path)
+        self.assertEqual(jobs[1], {'input_file': 'payload.bin',
+                                   'badbytes': '00', 'format': 'python',
+                                   'filename': 'out.py'})
+        options = EncoderManifest().get_options(jobs[0])
+        self.assertEqual(options['format'], ['raw', 'asm'])
+        self.assertTrue(options['chain'])
+        summaries = EncoderManifest(directory=self.directory).run(jobs)
+        self.assertEqual([summary['status'] for summary in summaries],
+                         ['ok', 'ok'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory,
+                                                    'out.asm')))
+
+
+class CommandLineTest(unittest.TestCase):
+
+    # The banner mustn't end up in a binary stub written to STDOUT
+    def test_bin_to_stdout(self):
+        payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80"
+        directory = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.check_output(
+            [sys.executable, os.path.join(directory, 'SubtractionEncoder.py'),
+             '--input', payload, '--badbytes', '000a0d', '--format', 'bin',
+             '--no-cache'], stderr=subprocess.DEVNULL)
+        self.assertEqual(output, encode(
+            payload, ByteProfile.from_badbytes('000a0d')).get_bytes())
+
+
+class ImportTest(unittest.TestCase):
+
+    # Importing the encoder, which every run of the command line does,
+    # leaves the modules only some options need until they are used
+    def test_import_is_light(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c', 'import sys, SubtractionEncoder; print(" "'
+             '.join(sorted(set(sys.modules) & {"argparse", "csv", "json", '
+             '"multiprocessing", "numpy", "tempfile"})))'],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output.strip(), b'')
+
+
+class EncoderStatsTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+    payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd80" + "90" * 9
+
+    def test_report(self):
+        reports = []
+        stats = EncoderStats(reports.append)
+        SubtractionEncoder(self.payload, self.goodbytes, None, 'raw', 'var',
+                           os.devnull, stats=stats).process()
+        self.assertEqual(len(reports), 1)
+        counters = reports[0]['counters']
+        # 32 bytes, the last two words are both NOPs
+        self.assertEqual(counters['words'], 8)
+        self.assertEqual(counters['words_solved'], 7)
+        self.assertEqual(counters['memo_hits'], 1)
+        self.assertEqual(counters['sub_instructions'], 8 * 3)
+        self.assertEqual(len(counters['carry_retries']), 4)
+        self.assertEqual(sorted(reports[0]['timings']),
+                         sorted(EncoderStats.stages))
+        for stage in EncoderStats.stages:
+            self.assertGreater(reports[0]['timings'][stage], 0)
+
+    def test_count_carries(self):
+        stats = EncoderStats()
+        # 0xff + 0xff + 0x02 carries 2 out of the first column, which then
+        # carries 1 out of the second
+        stats.count_carries([0x0000ffff, 0x000000ff, 0x00000002])
+        self.assertEqual(stats.carry_retries, [2, 1, 0, 0])
+
+    def test_get_flag(self):
+        for value in ('True', 'true', '1', 'yes'):
+            self.assertTrue(get_flag(value))
+        for value in ('False', 'false', '0', 'no', 'off'):
+            self.assertFalse(get_flag(value))
+
+
+class EncoderTableCacheTest(unittest.TestCase):
+
+    goodbytes = ''.join("{:02x}".format(i) for i in range(0x20, 0x7f))
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = EncoderTableCache(self.directory)
+        self.profile = ByteProfile.from_goodbytes(self.goodbytes)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load_matches_build(self):
+        self.assertIsNone(self.cache.load(self.profile))
+        self.cache.save(self.profile, EncoderOperandTable(self.profile),
+                        EncoderOperandSearch(self.profile))
+        table, search = self.cache.load(self.profile)
+        self.assertEqual(table.entries,
+                         EncoderOperandTable(self.profile).entries)
+        self.assertEqual(search.sums, EncoderOperandSearch(self.profile).sums)
+
+    def test_version_invalidates(self):
+        self.cache.save(self.profile, EncoderOperandTable(self.profile),
+                        EncoderOperandSearch(self.profile))
+        self.cache.version += 1
+        self.assertIsNone(self.cache.load(self.profile))
+
+    def test_corrupt_file_is_ignored(self):
+        with open(self.cache.get_filename(self.profile), 'wb') as cache_file:
+            cache_file.write(b'SUBENC')
+        self.assertIsNone(self.cache.load(self.profile))
+
+    def test_clear(self):
+        self.cache.save(self.profile, EncoderOperandTable(self.profile),
+                        EncoderOperandSearch(self.profile))
+        self.cache.clear()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_encoder_output(self):
+        payload = "31c050682f2f7368682f62696e89e3505389e1b00bcd8000"
+        outputs = []
+        for cache_dir in (None, self.directory, self.directory):
+            encoder = SubtractionEncoder(payload, self.goodbytes,
+                                         output_format=None,
+                                         cache_dir=cache_dir)
+            encoder.process()
+            outputs.append(encoder.get_output_bytes())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(outputs[0], outputs[2])
+
 if __name__ == '__main__':
     unittest.main()
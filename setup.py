@@ -0,0 +1,18 @@
+#!/usr/bin/python3
+
+from setuptools import setup
+
+setup(name='SubtractionEncoder',
+      version='1.0',
+      description='The x86 encoder of last resort, which builds the payload' +
+      ' on the stack from AND, SUB and PUSH instructions',
+      url='https://github.com/fedoraredteam/PySubtractionEncoder',
+      author='@kevensen',
+      python_requires='>=3.7',
+      py_modules=['SubtractionEncoder', 'SubtractionEncoderBenchmark',
+                  'SubtractionEncoderDaemon'],
+      extras_require={'batch': ['numpy']},
+      entry_points={'console_scripts': [
+          'subtraction-encoder=SubtractionEncoder:main',
+          'subtraction-encoder-daemon=SubtractionEncoderDaemon:main',
+          'subtraction-encoder-benchmark=SubtractionEncoderBenchmark:main']})